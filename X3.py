@@ -1,12 +1,17 @@
+import asyncio
 import datetime
 import hashlib
+import math
+import time
 import uuid
-from typing import Optional, Tuple
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, List, Optional, Set, Tuple
 
 import urllib3
 import aiohttp
 
-from config import PANEL_API_TOKEN, PANEL_URL
+from config import PANEL_API_TOKEN, PANEL_URL, PANEL_FETCH_CONCURRENCY, PANEL_CACHE_TTL, PANEL_BULK_CONCURRENCY, \
+    PANEL_BULK_RETRIES
 from config_bd.utils import AsyncSQL
 from logging_config import logger
 import random
@@ -14,6 +19,82 @@ import string
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+PANEL_PAGE_SIZE = 1000  # размер страницы /api/users
+PANEL_MAX_PAGES = 100  # предохранитель от бесконечного обхода
+PANEL_DELTA_LIMIT = 50  # больше изменённых юзеров – дешевле перекачать панель целиком
+PANEL_PAGE_RETRIES = 2  # повторов упавшей страницы /api/users
+PANEL_BULK_CHUNK = 500  # uuid в одном запросе к bulk-эндпоинтам панели
+
+# Bulk-эндпоинты панели: одинаковое изменение сразу для списка uuid
+PANEL_BULK_ENDPOINTS = {
+    'squads': '/api/users/bulk/update-squads',
+    'expire_at': '/api/users/bulk/update',
+}
+
+
+class PanelFetchError(Exception):
+    """Страницу пользователей панели не удалось получить даже после повторов."""
+
+
+class PanelSnapshot:
+    """Снимок пользователей панели с индексами по telegramId, username и uuid."""
+
+    def __init__(self, users: List[dict]):
+        self.users: List[dict] = []
+        self.fetched_at = time.monotonic()
+        self.by_telegram_id: Dict[int, dict] = {}
+        self.by_username: Dict[str, dict] = {}
+        self.by_uuid: Dict[str, dict] = {}
+        self._positions: Dict[str, int] = {}
+        for user in users:
+            self.upsert(user)
+
+    def age(self) -> float:
+        return time.monotonic() - self.fetched_at
+
+    def upsert(self, user: dict):
+        """Добавляет пользователя в снимок или заменяет существующую запись (по uuid)."""
+        user_uuid = user.get('uuid')
+        if user_uuid in self._positions:
+            self.users[self._positions[user_uuid]] = user
+        else:
+            if user_uuid:
+                self._positions[user_uuid] = len(self.users)
+            self.users.append(user)
+        if user_uuid:
+            self.by_uuid[user_uuid] = user
+        if user.get('username'):
+            self.by_username[user['username']] = user
+        if user.get('telegramId') is not None:
+            self.by_telegram_id[int(user['telegramId'])] = user
+
+
+class PanelChange:
+    """
+    Изменение одного пользователя панели для X3.bulk_apply; задаётся ровно одно из:
+    days — продлить на столько дней, expire_at — точная дата окончания (UTC), squads — новые activeInternalSquads.
+    """
+
+    def __init__(self, username: str, user_id: Optional[int] = None, days: Optional[int] = None,
+                 expire_at: Optional[datetime.datetime] = None, squads: Optional[List[str]] = None,
+                 uuid: Optional[str] = None):
+        self.username = username
+        self.user_id = user_id
+        self.days = days
+        self.expire_at = expire_at
+        self.squads = squads
+        self.uuid = uuid
+
+    def bulk_key(self) -> Optional[Tuple]:
+        """Ключ группировки для bulk-эндпоинта; None — изменение выполняется только поштучно."""
+        if self.uuid is None:
+            return None
+        if self.squads is not None:
+            return 'squads', tuple(self.squads)
+        if self.expire_at is not None:
+            return 'expire_at', self.expire_at.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+        return None
+
 
 class X3:
     def __init__(self):
@@ -34,6 +115,11 @@ class X3:
         self.working_host = self.target_url
         self.is_authenticated = True
 
+        self._snapshot: Optional[PanelSnapshot] = None
+        self._snapshot_lock = asyncio.Lock()
+        self._dirty_usernames: Set[str] = set()
+        self._bulk_unsupported: Set[str] = set()  # bulk-эндпоинты, на которые панель ответила 404
+
     async def _get_session(self) -> aiohttp.ClientSession:
         """Возвращает активную сессию aiohttp, создавая её при необходимости."""
         if self._session is None or self._session.closed:
@@ -72,76 +158,87 @@ class X3:
             logger.error(f"Ошибка подключения: {e}")
             return False
 
-    async def list(self, start):
-        try:
-            params = self.params
-            params['size'] = 1000
-            params['start'] = start
-            session = await self._get_session()
-            async with session.get(
-                    f'{self.target_url}/api/users',
-                    params=params,
-                    timeout=aiohttp.ClientTimeout(total=15)
-            ) as resp:
-                if resp.status == 200:
-                    logger.info(f'Получены юзеры с {start}')
-                    return await resp.json()
-                else:
+    async def list(self, start, size: int = PANEL_PAGE_SIZE) -> dict:
+        """
+        Страница /api/users. При ошибке повторяет запрос до PANEL_PAGE_RETRIES раз, затем бросает PanelFetchError:
+        пустая страница вместо упавшей дала бы выгрузку и снимок панели с дырами.
+        """
+        # Копируем параметры: страницы запрашиваются параллельно
+        params = dict(self.params)
+        params['size'] = size
+        params['start'] = start
+        for attempt in range(PANEL_PAGE_RETRIES + 1):
+            try:
+                session = await self._get_session()
+                async with session.get(
+                        f'{self.target_url}/api/users',
+                        params=params,
+                        timeout=aiohttp.ClientTimeout(total=15)
+                ) as resp:
+                    if resp.status == 200:
+                        logger.info(f'Получены юзеры с {start}')
+                        return await resp.json()
                     logger.error(f"HTTP {resp.status}: {await resp.text()}")
-                    return {'response': {'users': []}}
-        except Exception as e:
-            logger.error(f"Ошибка запроса: {e}")
-            return {'response': {'users': []}}
+            except Exception as e:
+                logger.error(f"Ошибка запроса: {e}")
+            if attempt < PANEL_PAGE_RETRIES:
+                await asyncio.sleep(2 ** attempt)
+        raise PanelFetchError(f"Не удалось получить пользователей панели начиная с {start}")
 
     def _generate_password(self, length=12):
         """Генерирует случайный пароль"""
         chars = string.ascii_letters + string.digits
         return ''.join(random.choice(chars) for _ in range(length))
 
+    def _new_user_payload(self, day, user_id_str, user_id) -> Tuple[dict, datetime.datetime]:
+        """Данные POST /api/users для нового клиента и его дата окончания (UTC)."""
+        client_id = self.generate_client_id(user_id)
+        if 'white' in user_id_str:
+            client_id = self.generate_client_id(user_id * 100)
+        current_time = datetime.datetime.utcnow()
+        expire_time = current_time + datetime.timedelta(days=day)
+        vless_uuid = str(uuid.uuid1())
+
+        if 'white' in user_id_str:
+            squad_1 = ['41d180d4-4f4c-46d7-81f0-76f45356e777']
+            squad_2 = ['db73ace8-663b-4ef4-91da-0bfa7abe6e90']
+            squad = random.choice([squad_1, squad_2])
+            trafficLimitStrategy = "MONTH"
+            trafficLimitBytes = 80530636800
+            hwidDeviceLimit = 1
+        else:
+            squad_1 = ['6ba41467-be68-438c-ad6e-5a02f7df826c']
+            squad_2 = ['c6973051-58b7-484c-b669-6a123cda465b']
+            squad_3 = ['a867561f-8736-4f67-8970-e20fddd00e5e']
+            squad_4 = ['29b73cd8-8a68-41cd-99c7-5d30dbac4c71']
+            squad_5 = ['d108d4a0-a121-4b52-baee-a97243208179']
+            squad = random.choice([squad_1, squad_2, squad_3, squad_4, squad_5])
+            trafficLimitStrategy = "NO_RESET"
+            trafficLimitBytes = 0
+            hwidDeviceLimit = 3
+
+        data = {
+            "username": user_id_str,
+            "status": "ACTIVE",
+            "shortUuid": client_id,
+            "trojanPassword": self._generate_password(),
+            "vlessUuid": vless_uuid,
+            "ssPassword": self._generate_password(),
+            "trafficLimitStrategy": trafficLimitStrategy,
+            "trafficLimitBytes": trafficLimitBytes,
+            "expireAt": expire_time.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
+            "createdAt": current_time.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
+            "hwidDeviceLimit": hwidDeviceLimit,
+            "telegramId": int(user_id),
+            "description": "New user",
+            "activeInternalSquads": squad
+        }
+        return data, expire_time
+
     async def addClient(self, day, user_id_str, user_id):
         """Добавляет нового клиента"""
         try:
-            client_id = self.generate_client_id(user_id)
-            if 'white' in user_id_str:
-                client_id = self.generate_client_id(user_id * 100)
-            current_time = datetime.datetime.utcnow()
-            expire_time = current_time + datetime.timedelta(days=day)
-            vless_uuid = str(uuid.uuid1())
-
-            if 'white' in user_id_str:
-                squad_1 = ['41d180d4-4f4c-46d7-81f0-76f45356e777']
-                squad_2 = ['db73ace8-663b-4ef4-91da-0bfa7abe6e90']
-                squad = random.choice([squad_1, squad_2])
-                trafficLimitStrategy = "MONTH"
-                trafficLimitBytes = 80530636800
-                hwidDeviceLimit = 1
-            else:
-                squad_1 = ['6ba41467-be68-438c-ad6e-5a02f7df826c']
-                squad_2 = ['c6973051-58b7-484c-b669-6a123cda465b']
-                squad_3 = ['a867561f-8736-4f67-8970-e20fddd00e5e']
-                squad_4 = ['29b73cd8-8a68-41cd-99c7-5d30dbac4c71']
-                squad_5 = ['d108d4a0-a121-4b52-baee-a97243208179']
-                squad = random.choice([squad_1, squad_2, squad_3, squad_4, squad_5])
-                trafficLimitStrategy = "NO_RESET"
-                trafficLimitBytes = 0
-                hwidDeviceLimit = 3
-
-            data = {
-                "username": user_id_str,
-                "status": "ACTIVE",
-                "shortUuid": client_id,
-                "trojanPassword": self._generate_password(),
-                "vlessUuid": vless_uuid,
-                "ssPassword": self._generate_password(),
-                "trafficLimitStrategy": trafficLimitStrategy,
-                "trafficLimitBytes": trafficLimitBytes,
-                "expireAt": expire_time.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
-                "createdAt": current_time.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
-                "hwidDeviceLimit": hwidDeviceLimit,
-                "telegramId": int(user_id),
-                "description": "New user",
-                "activeInternalSquads": squad
-            }
+            data, expire_time = self._new_user_payload(day, user_id_str, user_id)
 
             logger.info(f"Добавление клиента {user_id_str}, срок до: {expire_time}")
 
@@ -153,6 +250,7 @@ class X3:
                     timeout=aiohttp.ClientTimeout(total=15)
             ) as response:
                 logger.info(f"Код ответа: {response.status}")
+                self.invalidate_panel_cache(user_id_str)
 
                 if response.status in [200, 201]:
                     sql = AsyncSQL()
@@ -161,7 +259,7 @@ class X3:
                     except (aiohttp.ClientConnectionError, aiohttp.ContentTypeError, ValueError) as e:
                         # Сервер мог не вернуть JSON, но статус успешный
                         logger.warning(f"Не удалось прочитать JSON при добавлении {user_id}: {e}. Считаем успехом.")
-                        subscription_end_date = expire_time.replace(tzinfo=datetime.timezone.utc)
+                        subscription_end_date = self.to_msk(expire_time.replace(tzinfo=datetime.timezone.utc))
                         if 'white' in user_id_str:
                             await sql.update_white_subscription_end_date(user_id, subscription_end_date)
                         else:
@@ -170,7 +268,7 @@ class X3:
                         return True
                     else:
                         if response_data.get("success", True):
-                            subscription_end_date = expire_time.replace(tzinfo=datetime.timezone.utc)
+                            subscription_end_date = self.to_msk(expire_time.replace(tzinfo=datetime.timezone.utc))
                             if 'white' in user_id_str:
                                 await sql.update_white_subscription_end_date(user_id, subscription_end_date)
                             else:
@@ -191,6 +289,50 @@ class X3:
             logger.error(traceback.format_exc())
             return False
 
+    def _extension_payload(self, user: dict, day, user_id_str) -> Tuple[dict, datetime.datetime, datetime.datetime]:
+        """
+        Данные PATCH /api/users для продления клиента на day дней: истёкшая подписка продлевается от текущего момента,
+        активная — от своей даты окончания. Возвращает (данные, старая дата, новая дата) в UTC.
+        """
+        uuid_user = user['uuid']
+        
+        # Парсим текущую дату истечения
+        expire_at_str = user['expireAt']
+        current_expire_at = datetime.datetime.fromisoformat(expire_at_str.replace('Z', '+00:00'))
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+        # Определяем новую дату истечения
+        if current_expire_at < now:
+            # Подписка истекла - начинаем с текущего момента
+            new_expire_at = now + datetime.timedelta(days=day)
+            status = 'ACTIVE'  # Активируем подписку
+            logger.info(f"Подписка пользователя {user_id_str} истекла. Активируем и добавляем {day} дней")
+        else:
+            # Подписка активна - добавляем к существующей дате
+            new_expire_at = current_expire_at + datetime.timedelta(days=day)
+            status = user.get('status', 'ACTIVE')
+            logger.info(f"Подписка пользователя {user_id_str} активна. Добавляем {day} дней")
+
+        # Обрабатываем activeInternalSquads
+        raw_squads = user.get('activeInternalSquads', [])
+        squads = []
+        for s in raw_squads:
+            if isinstance(s, dict) and 'uuid' in s:
+                squads.append(s['uuid'])
+            elif isinstance(s, str):
+                squads.append(s)
+
+        # Формируем данные для обновления
+        data = {
+            "uuid": uuid_user,
+            "status": status,
+            "expireAt": new_expire_at.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
+            "trafficLimitBytes": user.get('trafficLimitBytes', 0),
+            "trafficLimitStrategy": user.get('trafficLimitStrategy', "NO_RESET"),
+            "activeInternalSquads": squads
+        }
+        return data, current_expire_at, new_expire_at
+
     async def updateClient(self, day, user_id_str, user_id):
         """Обновляет клиента - добавляет дни к подписке"""
         try:
@@ -208,43 +350,7 @@ class X3:
                 logger.error(f"❌ У пользователя {user_id_str} отсутствуют обязательные поля")
                 return False
 
-            uuid_user = user['uuid']
-            
-            # Парсим текущую дату истечения
-            expire_at_str = user['expireAt']
-            current_expire_at = datetime.datetime.fromisoformat(expire_at_str.replace('Z', '+00:00'))
-            now = datetime.datetime.now(datetime.timezone.utc)
-
-            # Определяем новую дату истечения
-            if current_expire_at < now:
-                # Подписка истекла - начинаем с текущего момента
-                new_expire_at = now + datetime.timedelta(days=day)
-                status = 'ACTIVE'  # Активируем подписку
-                logger.info(f"Подписка пользователя {user_id_str} истекла. Активируем и добавляем {day} дней")
-            else:
-                # Подписка активна - добавляем к существующей дате
-                new_expire_at = current_expire_at + datetime.timedelta(days=day)
-                status = user.get('status', 'ACTIVE')
-                logger.info(f"Подписка пользователя {user_id_str} активна. Добавляем {day} дней")
-
-            # Обрабатываем activeInternalSquads
-            raw_squads = user.get('activeInternalSquads', [])
-            squads = []
-            for s in raw_squads:
-                if isinstance(s, dict) and 'uuid' in s:
-                    squads.append(s['uuid'])
-                elif isinstance(s, str):
-                    squads.append(s)
-
-            # Формируем данные для обновления
-            data = {
-                "uuid": uuid_user,
-                "status": status,
-                "expireAt": new_expire_at.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
-                "trafficLimitBytes": user.get('trafficLimitBytes', 0),
-                "trafficLimitStrategy": user.get('trafficLimitStrategy', "NO_RESET"),
-                "activeInternalSquads": squads
-            }
+            data, current_expire_at, new_expire_at = self._extension_payload(user, day, user_id_str)
 
             logger.info(f"Обновление пользователя {user_id_str}:")
             logger.info(f"  Старая дата: {current_expire_at.strftime('%Y-%m-%d %H:%M:%S')}")
@@ -259,6 +365,7 @@ class X3:
                     timeout=aiohttp.ClientTimeout(total=15)
             ) as response:
                 logger.info(f"Код ответа updateClient: {response.status}")
+                self.invalidate_panel_cache(user_id_str)
                 if response.status == 200:
                     sql = AsyncSQL()
                     try:
@@ -266,17 +373,17 @@ class X3:
                     except (aiohttp.ClientConnectionError, aiohttp.ContentTypeError, ValueError) as e:
                         logger.warning(f"Не удалось прочитать JSON при обновлении {user_id}: {e}. Считаем успехом.")
                         if 'white' in user_id_str:
-                            await sql.update_white_subscription_end_date(user_id, new_expire_at)
+                            await sql.update_white_subscription_end_date(user_id, self.to_msk(new_expire_at))
                         else:
-                            await sql.update_subscription_end_date(user_id, new_expire_at)
+                            await sql.update_subscription_end_date(user_id, self.to_msk(new_expire_at))
                         logger.info(f"✅ Клиент {user_id} успешно обновлён (без JSON), добавлено {day} дней")
                         return True
                     else:
                         if response_data.get("success", True):
                             if 'white' in user_id_str:
-                                await sql.update_white_subscription_end_date(user_id, new_expire_at)
+                                await sql.update_white_subscription_end_date(user_id, self.to_msk(new_expire_at))
                             else:
-                                await sql.update_subscription_end_date(user_id, new_expire_at)
+                                await sql.update_subscription_end_date(user_id, self.to_msk(new_expire_at))
                             logger.info(f"✅ Клиент {user_id} успешно обновлён, добавлено {day} дней")
                             return True
                         else:
@@ -293,6 +400,81 @@ class X3:
             logger.error(traceback.format_exc())
             return False
 
+    async def _send_user(self, method: str, data: dict, username: str) -> Optional[dict]:
+        """POST/PATCH /api/users; возвращает пользователя из ответа панели ({} если JSON не пришёл) или None при ошибке."""
+        session = await self._get_session()
+        async with session.request(
+                method,
+                f"{self.target_url}/api/users",
+                json=data,
+                params=self.params,
+                timeout=aiohttp.ClientTimeout(total=15)
+        ) as response:
+            self.invalidate_panel_cache(username)
+            if response.status not in (200, 201):
+                error_text = await response.text() if response.content else "No body"
+                logger.error(f"❌ {method} {username}: HTTP {response.status}, {error_text}")
+                return None
+            try:
+                response_data = await response.json()
+            except (aiohttp.ClientConnectionError, aiohttp.ContentTypeError, ValueError) as e:
+                logger.warning(f"Не удалось прочитать JSON ({method} {username}): {e}. Считаем успехом.")
+                return {}
+            if not response_data.get("success", True):
+                logger.error(f"❌ API вернул success=false: {response_data}")
+                return None
+            return response_data.get('response') or {}
+
+    async def extend_subscription(self, username: str, user_id: int, days: int,
+                                  create: bool = True) -> Optional[Tuple[bool, datetime.datetime, str]]:
+        """
+        Продлевает подписку клиента на days дней, а если клиента нет и create=True — создаёт его.
+        Один GET по username и один POST/PATCH вместо get_user_by_username + updateClient + activ + sublink.
+        Возвращает (клиент уже был, новая дата окончания в UTC, ссылка подписки)
+        или None, если клиента нет (при create=False) либо панель вернула ошибку. БД не трогает.
+        """
+        try:
+            user_response = await self.get_user_by_username(username)
+            user = (user_response or {}).get('response')
+            existed = bool(user)
+
+            if existed:
+                if 'uuid' not in user or 'expireAt' not in user:
+                    logger.error(f"❌ У пользователя {username} отсутствуют обязательные поля")
+                    return None
+                data, _, expire_at = self._extension_payload(user, days, username)
+                logger.info(f"⏫ Обновляем {username} на {days} дней, до {expire_at}")
+                updated = await self._send_user('PATCH', data, username)
+            elif create:
+                data, expire_time = self._new_user_payload(days, username, user_id)
+                expire_at = expire_time.replace(tzinfo=datetime.timezone.utc)
+                logger.info(f"➕ Добавляем {username} на {days} дней, до {expire_at}")
+                updated = await self._send_user('POST', data, username)
+            else:
+                return None
+
+            if updated is None:
+                return None
+            # Дата из ответа панели точнее рассчитанной локально
+            if updated.get('expireAt'):
+                expire_at = datetime.datetime.fromisoformat(updated['expireAt'].replace('Z', '+00:00'))
+            subscription_url = updated.get('subscriptionUrl') or (user or {}).get('subscriptionUrl', '')
+            return existed, expire_at, self._mirror_sublink(subscription_url)
+
+        except Exception as e:
+            logger.error(f"❌ Ошибка продления подписки {username}: {e}")
+            return None
+
+    @staticmethod
+    def _mirror_sublink(subscription_url: str) -> str:
+        return subscription_url.replace('access.zoomervpn.ru', 'zoomer.run')
+
+    @staticmethod
+    def to_msk(expire_at: datetime.datetime) -> datetime.datetime:
+        """Дата окончания в том виде, в каком она хранится в БД: наивное МСК-время с точностью до минуты."""
+        expire_at_utc = expire_at.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return (expire_at_utc + datetime.timedelta(hours=3)).replace(second=0, microsecond=0)
+
     async def get_user_by_username(self, username):
         try:
             session = await self._get_session()
@@ -338,9 +520,7 @@ class X3:
             users = await self.get_user_by_username(user_id)
             if users and 'response' in users and users['response']:
                 user = users['response']
-                true_sublink = user.get('subscriptionUrl', '')
-                mirror_sublink = true_sublink.replace('access.zoomervpn.ru', 'zoomer.run')
-                return mirror_sublink
+                return self._mirror_sublink(user.get('subscriptionUrl', ''))
         except Exception as e:
             logger.error(f"Ошибка при получении ссылки для {user_id}: {e}")
         return ""
@@ -379,17 +559,127 @@ class X3:
             result['activ'] = '❌ - Внутренняя ошибка'
             return result
 
+    async def iter_users(self, concurrency: Optional[int] = None) -> AsyncIterator[List[dict]]:
+        """
+        Постраничный обход всех пользователей панели.
+        Первая страница запрашивается отдельно, чтобы узнать total, остальные
+        качаются параллельно (не более concurrency запросов одновременно).
+        Страницы отдаются строго по порядку; страница, которую не удалось получить, прерывает обход PanelFetchError.
+        """
+        concurrency = max(1, concurrency or PANEL_FETCH_CONCURRENCY)
+
+        first = await self.list(1)
+        response = first.get('response') or {}
+        users = response.get('users') or []
+        if not users:
+            return
+        yield users
+
+        total = response.get('total')
+        if not isinstance(total, int):
+            # Панель не вернула total – обходим последовательно до пустой страницы
+            for i in range(1, PANEL_MAX_PAGES):
+                data = await self.list(PANEL_PAGE_SIZE * i + 1)
+                users = (data.get('response') or {}).get('users') or []
+                if not users:
+                    break
+                yield users
+            return
+
+        pages = min(math.ceil(total / PANEL_PAGE_SIZE), PANEL_MAX_PAGES)
+        window: Deque[asyncio.Task] = deque()
+        try:
+            for i in range(1, pages):
+                window.append(asyncio.create_task(self.list(PANEL_PAGE_SIZE * i + 1)))
+                if len(window) >= concurrency:
+                    data = await window.popleft()
+                    users = (data.get('response') or {}).get('users') or []
+                    if users:
+                        yield users
+            while window:
+                data = await window.popleft()
+                users = (data.get('response') or {}).get('users') or []
+                if users:
+                    yield users
+        finally:
+            # Если потребитель прервал обход – отменяем недокачанные страницы
+            for task in window:
+                task.cancel()
+
+    async def fetch_all_users(self, concurrency: Optional[int] = None) -> List[dict]:
+        """Возвращает всех пользователей панели одним списком (в порядке страниц)."""
+        users_all = []
+        async for page in self.iter_users(concurrency):
+            users_all.extend(page)
+        logger.info(f'Всего юзеров в панели - {len(users_all)}')
+        return users_all
+
+    async def get_panel_snapshot(self, max_age: Optional[float] = None) -> PanelSnapshot:
+        """
+        Возвращает локальный снимок панели не старше max_age секунд (по умолчанию PANEL_CACHE_TTL).
+        Одновременные вызовы ждут одну общую загрузку. Пользователи, изменённые ботом
+        после загрузки снимка, дозапрашиваются точечно по username.
+        """
+        ttl = PANEL_CACHE_TTL if max_age is None else max_age
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.age() < ttl and not self._dirty_usernames:
+            return snapshot
+
+        async with self._snapshot_lock:
+            snapshot = self._snapshot
+            if snapshot is not None and snapshot.age() < ttl:
+                if self._dirty_usernames:
+                    await self._refresh_dirty_users(snapshot)
+                return self._snapshot
+
+            # Изменения, сделанные во время загрузки, попадут в новый набор и будут дозапрошены
+            self._dirty_usernames = set()
+            users = await self.fetch_all_users()
+            snapshot = PanelSnapshot(users)
+            if users:
+                self._snapshot = snapshot
+            return snapshot
+
+    async def _refresh_dirty_users(self, snapshot: PanelSnapshot):
+        """Точечно обновляет в снимке пользователей, изменённых через addClient/updateClient и т.п."""
+        dirty, self._dirty_usernames = self._dirty_usernames, set()
+        if len(dirty) > PANEL_DELTA_LIMIT:
+            self._snapshot = None
+            users = await self.fetch_all_users()
+            if users:
+                self._snapshot = PanelSnapshot(users)
+            return
+
+        usernames = list(dirty)
+        results = await asyncio.gather(*(self.get_user_by_username(u) for u in usernames))
+        for username, data in zip(usernames, results):
+            if data and data.get('response'):
+                snapshot.upsert(data['response'])
+            else:
+                # Не удалось получить – попробуем при следующем обращении
+                self._dirty_usernames.add(username)
+        logger.info(f'Снимок панели: обновлено точечно {len(usernames)} юзеров')
+
+    def invalidate_panel_cache(self, username: Optional[str] = None):
+        """
+        Помечает пользователя изменённым (будет дозапрошен при следующем чтении снимка).
+        Без username сбрасывает снимок целиком.
+        """
+        if username is None:
+            self._snapshot = None
+        else:
+            self._dirty_usernames.add(str(username))
+
+    def _invalidate_panel_uuid(self, user_uuid: str):
+        snapshot = self._snapshot
+        user = snapshot.by_uuid.get(user_uuid) if snapshot else None
+        if user and user.get('username'):
+            self.invalidate_panel_cache(user['username'])
+
     async def activ_list(self):
         lst_users = []
         try:
-            users_all = []
-            for i in range(100):
-                data = await self.list(1000 * i + 1)
-                if data['response']['users']:
-                    users_all.extend(data['response']['users'])
-                else:
-                    break
-            logger.info(f'Всего юзеров в панели - {len(users_all)}')
+            users_all = (await self.get_panel_snapshot()).users
             for user in users_all:
                 if user.get('userTraffic', {}).get('firstConnectedAt') and user.get('description') != 'New user - without pay':
                     telegram_id = user.get('telegramId')
@@ -403,18 +693,11 @@ class X3:
     async def get_all_users(self):
         """
         Возвращает список всех пользователей из панели (объекты пользователей),
-        у которых description == 'New user - without pay'.
+        у которых description != 'New user - without pay'.
         """
         lst_users = []
         try:
-            users_all = []
-            for i in range(100):  # максимум 50 страниц
-                data = await self.list(1000 * i + 1)
-                if data['response']['users']:
-                    users_all.extend(data['response']['users'])
-                else:
-                    break
-            logger.info(f'Всего юзеров в панели - {len(users_all)}')
+            users_all = (await self.get_panel_snapshot()).users
             for user in users_all:
                 if user.get('description') != 'New user - without pay':
                     lst_users.append(user)
@@ -441,6 +724,7 @@ class X3:
                     params=self.params,
                     timeout=aiohttp.ClientTimeout(total=10)
             ) as response:
+                self._invalidate_panel_uuid(user_uuid)
                 if response.status == 200:
                     try:
                         response_data = await response.json()
@@ -464,26 +748,35 @@ class X3:
             return False
 
     async def get_all_panel(self):
-        """
-        Возвращает список всех пользователей из панели (объекты пользователей),
-        у которых description == 'New user - without pay'.
-        """
+        """Возвращает список всех пользователей из панели (объекты пользователей)."""
         lst_users = []
         try:
-            users_all = []
-            for i in range(100):  # максимум 50 страниц
-                data = await self.list(1000 * i + 1)
-                if data['response']['users']:
-                    users_all.extend(data['response']['users'])
-                else:
-                    break
-            logger.info(f'Всего юзеров в панели - {len(users_all)}')
-            for user in users_all:
-                lst_users.append(user)
+            lst_users = list((await self.get_panel_snapshot()).users)
         except Exception as e:
             logger.error(f"Ошибка при получении всех пользователей: {e}")
         return lst_users
 
+    @staticmethod
+    def _expiration_payload(user: dict, target_date: datetime.datetime) -> Tuple[dict, datetime.datetime]:
+        """
+        Данные PATCH /api/users для установки точной даты окончания (остальные поля сохраняются).
+        Дата в прошлом заменяется на текущее время + 1 минута. Возвращает (данные, реальная дата в UTC).
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        effective_date = target_date if target_date > now else now + datetime.timedelta(minutes=1)
+        raw_squads = user.get('activeInternalSquads', [])
+        squads = [s['uuid'] if isinstance(s, dict) else s for s in raw_squads]
+
+        data = {
+            "uuid": user['uuid'],
+            "expireAt": effective_date.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
+            "status": 'ACTIVE',  # Активируем подписку
+            "trafficLimitBytes": user.get('trafficLimitBytes', 0),
+            "trafficLimitStrategy": user.get('trafficLimitStrategy', 'NO_RESET'),
+            "activeInternalSquads": squads
+        }
+        return data, effective_date
+
     async def set_expiration_date(self, username: str, target_date: datetime, user_id: int):
         """
         Устанавливает точную дату окончания подписки для пользователя в панели.
@@ -491,9 +784,6 @@ class X3:
         - Если target_date меньше текущего времени UTC, заменяет на текущее время + 1 минута.
         - Возвращает (успех, реальная_установленная_дата_UTC) или (False, None).
         """
-        now = datetime.datetime.now(datetime.timezone.utc)
-        effective_date = target_date if target_date > now else now + datetime.timedelta(minutes=1)
-
         # Проверяем существование пользователя
         user_data = await self.get_user_by_username(username)
         if not user_data or 'response' not in user_data:
@@ -507,24 +797,7 @@ class X3:
                 logger.error(f"Не удалось получить данные созданного пользователя {username}")
                 return False, None
 
-        user = user_data['response']
-        uuid_user = user['uuid']
-
-        # Формируем данные для обновления (сохраняем остальные поля)
-        traffic_limit_bytes = user.get('trafficLimitBytes', 0)
-        traffic_limit_strategy = user.get('trafficLimitStrategy', 'NO_RESET')
-        status = 'ACTIVE'  # Активируем подписку
-        raw_squads = user.get('activeInternalSquads', [])
-        squads = [s['uuid'] if isinstance(s, dict) else s for s in raw_squads]
-
-        data = {
-            "uuid": uuid_user,
-            "expireAt": effective_date.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
-            "status": status,
-            "trafficLimitBytes": traffic_limit_bytes,
-            "trafficLimitStrategy": traffic_limit_strategy,
-            "activeInternalSquads": squads
-        }
+        data, effective_date = self._expiration_payload(user_data['response'], target_date)
 
         session = await self._get_session()
         try:
@@ -534,6 +807,7 @@ class X3:
                     params=self.params,
                     timeout=aiohttp.ClientTimeout(total=15)
             ) as response:
+                self.invalidate_panel_cache(username)
                 if response.status == 200:
                     try:
                         resp_json = await response.json()
@@ -554,3 +828,147 @@ class X3:
         except Exception as e:
             logger.error(f"Исключение при установке даты для {username}: {e}")
             return False, None
+
+    async def bulk_apply(self, changes: List[PanelChange], concurrency: int = PANEL_BULK_CONCURRENCY,
+                         retries: int = PANEL_BULK_RETRIES) -> Dict[str, Tuple[bool, Optional[datetime.datetime]]]:
+        """
+        Массовое изменение пользователей панели (начисление дней, установка даты, смена squads).
+        Одинаковые изменения с известным uuid уходят bulk-эндпоинтами пачками по PANEL_BULK_CHUNK,
+        остальные выполняются поштучно, не больше concurrency запросов одновременно и с retries повторами.
+        Возвращает {username: (успех, новая дата окончания в UTC, если известна)}.
+        """
+        results: Dict[str, Tuple[bool, Optional[datetime.datetime]]] = {}
+        groups: Dict[Tuple, List[PanelChange]] = {}
+        single: List[PanelChange] = []
+        for change in changes:
+            key = change.bulk_key()
+            if key is None or key[0] in self._bulk_unsupported:
+                single.append(change)
+            else:
+                groups.setdefault(key, []).append(change)
+
+        for key, group in groups.items():
+            if key[0] in self._bulk_unsupported:
+                single.extend(group)
+                continue
+            for start in range(0, len(group), PANEL_BULK_CHUNK):
+                chunk = group[start:start + PANEL_BULK_CHUNK]
+                ok = await self._bulk_request(key, chunk, retries)
+                if ok is None:
+                    single.extend(chunk)
+                    continue
+                for change in chunk:
+                    results[change.username] = (ok, change.expire_at if ok else None)
+
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+
+        async def apply_one(change: PanelChange):
+            async with semaphore:
+                results[change.username] = await self._apply_change(change, retries)
+
+        await asyncio.gather(*(apply_one(change) for change in single))
+
+        success_count = sum(1 for ok, _ in results.values() if ok)
+        logger.info(f"Массовое изменение панели: {success_count} из {len(changes)} успешно "
+                    f"({len(changes) - len(single)} через bulk-эндпоинты)")
+        return results
+
+    async def _bulk_request(self, key: Tuple, chunk: List[PanelChange], retries: int) -> Optional[bool]:
+        """Один запрос к bulk-эндпоинту; None — эндпоинта в этой версии панели нет, нужен поштучный путь."""
+        kind, value = key
+        uuids = [change.uuid for change in chunk]
+        if kind == 'squads':
+            data = {"uuids": uuids, "activeInternalSquads": list(value)}
+        else:
+            data = {"uuids": uuids, "fields": {"expireAt": value, "status": "ACTIVE"}}
+
+        for attempt in range(retries + 1):
+            try:
+                session = await self._get_session()
+                async with session.post(
+                        f"{self.target_url}{PANEL_BULK_ENDPOINTS[kind]}",
+                        json=data,
+                        params=self.params,
+                        timeout=aiohttp.ClientTimeout(total=60)
+                ) as response:
+                    if response.status in (404, 405):
+                        logger.warning(f"Панель не поддерживает {PANEL_BULK_ENDPOINTS[kind]}, изменения пойдут поштучно")
+                        self._bulk_unsupported.add(kind)
+                        return None
+                    if response.status in (200, 201):
+                        for user_uuid in uuids:
+                            self._invalidate_panel_uuid(user_uuid)
+                        logger.info(f"✅ Bulk {kind}: обновлено {len(uuids)} пользователей")
+                        return True
+                    logger.error(f"❌ Bulk {kind}: HTTP {response.status}, {await response.text()}")
+            except Exception as e:
+                logger.error(f"❌ Bulk {kind}: {e}")
+            if attempt < retries:
+                await asyncio.sleep(2 ** attempt)
+        return False
+
+    async def _get_user_for_change(self, username: str) -> Optional[dict]:
+        """Пользователь панели для поштучного изменения; None — его нет, исключение — панель не ответила."""
+        session = await self._get_session()
+        async with session.get(
+                f"{self.target_url}/api/users/by-username/{username}",
+                params=self.params,
+                timeout=aiohttp.ClientTimeout(total=10)
+        ) as resp:
+            if resp.status == 404:
+                return None
+            if resp.status != 200:
+                raise PanelFetchError(f"HTTP {resp.status}: {await resp.text()}")
+            return (await resp.json()).get('response') or None
+
+    async def _apply_change(self, change: PanelChange, retries: int) -> Tuple[bool, Optional[datetime.datetime]]:
+        """
+        Поштучное изменение с повторами при ошибке.
+        Начисление дней не идемпотентно, поэтому пользователь читается один раз, новая дата окончания
+        считается от прочитанной, а повторяется только PATCH с этой абсолютной датой.
+        Пользователя нет в панели — окончательный отказ, без повторов.
+        """
+        if change.days is None and change.expire_at is None and change.squads is None:
+            return False, None
+
+        user = None
+        if change.squads is None or change.uuid is None:
+            for attempt in range(retries + 1):
+                try:
+                    user = await self._get_user_for_change(change.username)
+                    break
+                except Exception as e:
+                    logger.error(f"❌ Не удалось получить {change.username}: {e}")
+                    if attempt == retries:
+                        return False, None
+                    await asyncio.sleep(0.5 * 2 ** attempt)
+            if user is None:
+                logger.warning(f"Пользователь {change.username} не найден в панели, изменение пропущено")
+                return False, None
+            if 'uuid' not in user or (change.days is not None and 'expireAt' not in user):
+                logger.error(f"❌ У пользователя {change.username} отсутствуют обязательные поля")
+                return False, None
+
+        data = expire_at = None
+        if change.days is not None:
+            data, _, expire_at = self._extension_payload(user, change.days, change.username)
+        elif change.expire_at is not None:
+            data, expire_at = self._expiration_payload(user, change.expire_at)
+
+        for attempt in range(retries + 1):
+            try:
+                if data is not None:
+                    updated = await self._send_user('PATCH', data, change.username)
+                    if updated is not None:
+                        # Дата из ответа панели точнее рассчитанной локально
+                        if updated.get('expireAt'):
+                            expire_at = datetime.datetime.fromisoformat(updated['expireAt'].replace('Z', '+00:00'))
+                        return True, expire_at
+                elif await self.update_user_squads(change.uuid or user['uuid'], change.squads):
+                    return True, None
+            except Exception as e:
+                logger.error(f"❌ Ошибка изменения {change.username}: {e}")
+            if attempt < retries:
+                await asyncio.sleep(0.5 * 2 ** attempt)
+        logger.error(f"❌ Не удалось изменить {change.username} после {retries + 1} попыток")
+        return False, None
@@ -1,10 +1,80 @@
+import asyncio
 import json
-import requests
+from typing import Optional
 
-from config import TG_TOKEN
+import aiohttp
 
+from config import TG_TOKEN, BOT_API_CONCURRENCY
+from logging_config import logger
 
-def send_message(chat_id, text, button_text, url):
+
+class BotApiRetryAfter(Exception):
+    """Bot API ответил 429; retry_after — сколько секунд ждать (Broadcaster ставит на паузу всю рассылку)."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Too Many Requests: retry after {retry_after}")
+        self.retry_after = retry_after
+
+
+class BotApiSender:
+    """
+    Асинхронные запросы к Bot API напрямую, в обход aiogram
+    (нужно для кнопок со style, которых aiogram не отдаёт).
+    Держит одно keep-alive соединение с пулом на api.telegram.org.
+    """
+
+    def __init__(self, token: str, concurrency: int = BOT_API_CONCURRENCY, max_retries: int = 3):
+        self.base_url = f"https://api.telegram.org/bot{token}"
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max_retries
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Возвращает активную сессию aiohttp, создавая её при необходимости."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.concurrency,
+                limit_per_host=self.concurrency,
+                keepalive_timeout=60,
+                ttl_dns_cache=300
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=10)
+            )
+        return self._session
+
+    async def close(self):
+        """Закрывает сессию aiohttp (вызывать при завершении работы)."""
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+    async def call(self, method: str, payload: dict, max_retries: Optional[int] = None) -> dict:
+        """
+        Вызывает метод Bot API. На 429 ждёт retry_after и повторяет до max_retries раз
+        (по умолчанию self.max_retries); при max_retries=0 ответ 429 возвращается как есть.
+        """
+        max_retries = self.max_retries if max_retries is None else max_retries
+        data = {}
+        for attempt in range(max_retries + 1):
+            async with self._semaphore:
+                session = await self._get_session()
+                async with session.post(f"{self.base_url}/{method}", json=payload) as response:
+                    data = await response.json(content_type=None)
+            if data.get("error_code") == 429 and attempt < max_retries:
+                retry_after = data.get("parameters", {}).get("retry_after", 1)
+                logger.warning(f"Bot API 429 на {method}, ждём {retry_after} сек.")
+                await asyncio.sleep(retry_after)
+                continue
+            return data
+        return data
+
+
+bot_api = BotApiSender(TG_TOKEN)
+
+
+async def send_message(chat_id, text, button_text, url, max_retries: Optional[int] = None):
     button = {
         "text": button_text,
         "url": url,
@@ -13,7 +83,6 @@ def send_message(chat_id, text, button_text, url):
     reply_markup = {
         "inline_keyboard": [[button]]
     }
-    url = f"https://api.telegram.org/bot{TG_TOKEN}/sendMessage"
     payload = {
         "chat_id": chat_id,
         "text": text,
@@ -23,6 +92,4 @@ def send_message(chat_id, text, button_text, url):
     if reply_markup:
         payload['reply_markup'] = json.dumps(reply_markup)
 
-
-    response = requests.post(url, json=payload, timeout=1)
-    return response.json()
+    return await bot_api.call("sendMessage", payload, max_retries=max_retries)
@@ -0,0 +1,328 @@
+import asyncio
+import time
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, Iterable, List, Optional, Set
+
+from aiogram import Bot
+from aiogram.types import Message
+
+from bot import sql
+from config import BROADCAST_RATE, BROADCAST_WORKERS
+from keyboard import keyboard_broadcast
+from logging_config import logger
+
+BROADCAST_BATCH_SIZE = 200  # получателей между чекпоинтами задания рассылки
+
+
+class TokenBucket:
+    """Ограничитель скорости: не более rate операций в секунду с запасом burst."""
+
+    def __init__(self, rate: float, burst: Optional[int] = None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Останавливает выдачу токенов на seconds секунд (flood-wait от Telegram)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    self._updated = time.monotonic()
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class BroadcastStats:
+    """Счётчики рассылки для отчёта админу."""
+
+    def __init__(self, total: int, sent: int = 0, failed: int = 0):
+        self.total = total
+        self.sent = sent
+        self.failed = failed
+        self.started_at = time.monotonic()
+        self._initial = sent + failed  # обработано до текущего запуска (при возобновлении)
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.failed
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+    @property
+    def rate(self) -> float:
+        elapsed = self.elapsed
+        return (self.processed - self._initial) / elapsed if elapsed > 0 else 0.0
+
+
+class _Batch:
+    """Пачка получателей run_batches и статусы уже обработанных из неё."""
+
+    def __init__(self, user_ids: List[int]):
+        self.user_ids = user_ids
+        self.statuses: Dict[int, str] = {}
+
+    @property
+    def done(self) -> bool:
+        return len(self.statuses) == len(self.user_ids)
+
+
+class Broadcaster:
+    """
+    Рассылка с ограничением скорости: workers параллельных отправителей делят общий
+    TokenBucket. Ошибка с retry_after (TelegramRetryAfter и аналоги) ставит на паузу всех
+    и повторяет отправку. Статусы копятся и пишутся в БД пачками через on_status.
+    """
+
+    def __init__(self,
+                 send: Callable[[int], Awaitable],
+                 rate: float = BROADCAST_RATE,
+                 workers: int = BROADCAST_WORKERS,
+                 on_status: Optional[Callable[[Dict[int, str]], Awaitable]] = None,
+                 on_progress: Optional[Callable[[BroadcastStats], Awaitable]] = None,
+                 flush_size: int = 200,
+                 progress_interval: float = 10.0,
+                 max_retries: int = 3,
+                 bucket: Optional[TokenBucket] = None):
+        self.send = send
+        self.bucket = bucket or TokenBucket(rate)
+        self.workers = max(1, workers)
+        self.on_status = on_status
+        self.on_progress = on_progress
+        self.flush_size = flush_size
+        self.progress_interval = progress_interval
+        self.max_retries = max_retries
+        self._statuses: Dict[int, str] = {}
+        self.stats: Optional[BroadcastStats] = None
+
+    async def run(self, user_ids: Iterable[int]) -> BroadcastStats:
+        queue: asyncio.Queue = asyncio.Queue()
+        for user_id in user_ids:
+            queue.put_nowait(user_id)
+        self.stats = BroadcastStats(queue.qsize())
+
+        reporter = asyncio.create_task(self._report_loop())
+        try:
+            await asyncio.gather(*(self._worker(queue) for _ in range(self.workers)))
+        finally:
+            reporter.cancel()
+            await self._flush()
+
+        logger.debug(f"Рассылка завершена: отправлено {self.stats.sent}, ошибок {self.stats.failed}, "
+                     f"{self.stats.rate:.1f} сообщ./сек")
+        return self.stats
+
+    async def run_batches(self, batches: AsyncIterator[List[int]],
+                          on_batch: Callable[[List[int], Dict[int, str]], Awaitable],
+                          stats: Optional[BroadcastStats] = None) -> BroadcastStats:
+        """
+        Рассылка по пачкам получателей из batches одними и теми же воркерами и TokenBucket:
+        следующая пачка подгружается, пока отправляется текущая, поэтому на границах пачек скорость не падает.
+        on_batch(пачка, статусы) вызывается по порядку пачек, как только пачка и все предыдущие обработаны.
+        """
+        self.stats = stats or BroadcastStats(0)
+        # Маленькая очередь: в работе одновременно не больше пары пачек
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.workers * 2)
+        unfinished: Deque[_Batch] = deque()
+        checkpoint_lock = asyncio.Lock()
+
+        async def produce():
+            async for user_ids in batches:
+                batch = _Batch(user_ids)
+                unfinished.append(batch)
+                for user_id in user_ids:
+                    await queue.put((batch, user_id))
+            for _ in range(self.workers):
+                await queue.put(None)
+
+        async def work():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                batch, user_id = item
+                status = await self._send_one(user_id)
+                if status == 'sent':
+                    self.stats.sent += 1
+                else:
+                    self.stats.failed += 1
+                batch.statuses[user_id] = status
+                async with checkpoint_lock:
+                    while unfinished and unfinished[0].done:
+                        done = unfinished.popleft()
+                        await on_batch(done.user_ids, done.statuses)
+
+        reporter = asyncio.create_task(self._report_loop())
+        tasks = [asyncio.create_task(produce())] + [asyncio.create_task(work()) for _ in range(self.workers)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            reporter.cancel()
+            for task in tasks:
+                task.cancel()
+
+        logger.debug(f"Рассылка завершена: отправлено {self.stats.sent}, ошибок {self.stats.failed}, "
+                     f"{self.stats.rate:.1f} сообщ./сек")
+        return self.stats
+
+    async def _worker(self, queue: asyncio.Queue):
+        while not queue.empty():
+            user_id = queue.get_nowait()
+            status = await self._send_one(user_id)
+            if status == 'sent':
+                self.stats.sent += 1
+            else:
+                self.stats.failed += 1
+            self._statuses[user_id] = status
+            if len(self._statuses) >= self.flush_size:
+                await self._flush()
+
+    async def _send_one(self, user_id: int) -> str:
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            try:
+                await self.send(user_id)
+                return 'sent'
+            except Exception as e:
+                retry_after = getattr(e, 'retry_after', None)
+                if retry_after and attempt < self.max_retries:
+                    logger.warning(f"Flood-wait {retry_after} сек. на {user_id}, ставим рассылку на паузу")
+                    self.bucket.pause(float(retry_after))
+                    continue
+                logger.error(f"Failed to send message to {user_id}: {e}")
+                return 'failed'
+        return 'failed'
+
+    async def _flush(self):
+        if not self._statuses or self.on_status is None:
+            return
+        batch, self._statuses = self._statuses, {}
+        try:
+            await self.on_status(batch)
+        except Exception as e:
+            logger.error(f"Не удалось записать статусы рассылки ({len(batch)} шт.): {e}")
+
+    async def _report_loop(self):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            await self._flush()
+            if self.on_progress is not None:
+                try:
+                    await self.on_progress(self.stats)
+                except Exception as e:
+                    logger.debug(f"Не удалось обновить прогресс рассылки: {e}")
+
+
+_running_jobs: Set[int] = set()
+_job_tasks: Set[asyncio.Task] = set()
+
+
+async def run_broadcast_job(bot: Bot, job_id: int, status_message: Optional[Message] = None):
+    """
+    Выполняет задание рассылки: получатели читаются пачками по BROADCAST_BATCH_SIZE,
+    а отправляет их один Broadcaster на всё задание. Когда пачка (и все до неё) разослана,
+    её статусы, счётчики и курсор сохраняются одной транзакцией, поэтому после перезапуска
+    рассылка продолжается с места остановки (повторно могут уйти только незавершённые пачки, обычно одна-две).
+    """
+    if job_id in _running_jobs:
+        return
+    _running_jobs.add(job_id)
+    try:
+        job = await sql.get_broadcast_job(job_id)
+        if job is None or job.status != 'running':
+            return
+
+        reply_markup = keyboard_broadcast(job.segment)
+        stats = BroadcastStats(job.total, sent=job.sent, failed=job.failed)
+
+        async def send(user_id: int):
+            await bot.copy_message(
+                chat_id=user_id,
+                from_chat_id=job.from_chat_id,
+                message_id=job.message_id,
+                reply_markup=reply_markup,
+            )
+
+        async def report_progress(_: Optional[BroadcastStats] = None):
+            text = (f"⏳ Рассылка #{job_id} ({job.segment}): {stats.processed}/{stats.total}\n"
+                    f"✅ Отправлено: {stats.sent}\n"
+                    f"❌ Ошибок: {stats.failed}\n"
+                    f"⚡ Скорость: {stats.rate:.1f} сообщ./сек")
+            nonlocal status_message
+            try:
+                if status_message is None:
+                    status_message = await bot.send_message(job.admin_chat_id, text)
+                else:
+                    await status_message.edit_text(text)
+            except Exception as e:
+                logger.debug(f"Не удалось обновить прогресс рассылки #{job_id}: {e}")
+
+        async def recipients():
+            cursor = job.cursor
+            while True:
+                user_ids = await sql.get_broadcast_recipients(job_id, cursor, BROADCAST_BATCH_SIZE)
+                if not user_ids:
+                    return
+                cursor = user_ids[-1]
+                yield user_ids
+
+        async def checkpoint(user_ids: List[int], statuses: Dict[int, str]):
+            await sql.checkpoint_broadcast_job(job_id, user_ids[-1], statuses)
+
+        if job.cursor:
+            logger.info(f"Возобновляем рассылку #{job_id} с user_id > {job.cursor}")
+        await report_progress()
+
+        broadcaster = Broadcaster(send, on_progress=report_progress)
+        await broadcaster.run_batches(recipients(), checkpoint, stats=stats)
+
+        await sql.finish_broadcast_job(job_id)
+        logger.success(f"Рассылка #{job_id} завершена: отправлено {stats.sent}, ошибок {stats.failed}")
+        text = (f"Сообщение успешно отправлено {stats.sent} пользователям.\n"
+                f"Ошибок: {stats.failed}\n"
+                f"Время: {int(stats.elapsed)} сек, {stats.rate:.1f} сообщ./сек")
+        try:
+            if status_message is None:
+                await bot.send_message(job.admin_chat_id, text)
+            else:
+                await status_message.edit_text(text)
+        except Exception as e:
+            logger.error(f"Не удалось отправить итог рассылки #{job_id}: {e}")
+    finally:
+        _running_jobs.discard(job_id)
+
+
+def run_in_background(coro) -> None:
+    """Запускает рассылку в фоне, не задерживая обработчик апдейта."""
+    task = asyncio.create_task(coro)
+    _job_tasks.add(task)
+    task.add_done_callback(_job_tasks.discard)
+
+
+def start_broadcast_job(bot: Bot, job_id: int, status_message: Optional[Message] = None) -> None:
+    """Запускает задание рассылки в фоне."""
+    run_in_background(run_broadcast_job(bot, job_id, status_message=status_message))
+
+
+async def resume_broadcast_jobs(bot: Bot):
+    """Запускает в фоне задания рассылки, прерванные перезапуском бота."""
+    jobs = await sql.get_unfinished_broadcast_jobs()
+    for job in jobs:
+        start_broadcast_job(bot, job.id)
+    if jobs:
+        logger.info(f"Возобновлено заданий рассылки: {len(jobs)}")
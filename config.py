@@ -14,3 +14,50 @@ CRYPTOBOT_API_TOKEN: Optional[str] = os.environ.get("CRYPTOBOT_API_TOKEN")
 PANEL_URL: Optional[str] = os.environ.get("PANEL_URL")
 PANEL_API_TOKEN: Optional[str] = os.environ.get("PANEL_API_TOKEN")
 
+PANEL_FETCH_CONCURRENCY: int = int(os.environ.get("PANEL_FETCH_CONCURRENCY", 5))
+PANEL_CACHE_TTL: int = int(os.environ.get("PANEL_CACHE_TTL", 300))
+PANEL_BULK_CONCURRENCY: int = int(os.environ.get("PANEL_BULK_CONCURRENCY", 10))  # поштучных запросов в bulk_apply одновременно
+PANEL_BULK_RETRIES: int = int(os.environ.get("PANEL_BULK_RETRIES", 2))
+BROADCAST_RATE: float = float(os.environ.get("BROADCAST_RATE", 25))
+BROADCAST_WORKERS: int = int(os.environ.get("BROADCAST_WORKERS", 10))
+BOT_API_CONCURRENCY: int = int(os.environ.get("BOT_API_CONCURRENCY", 10))
+
+DB_URL: str = os.environ.get("DB_URL", "sqlite+aiosqlite:///sqlite3.db")
+DB_READ_URL: str = os.environ.get("DB_READ_URL", DB_URL)  # например, реплика PostgreSQL для аналитики
+DB_POOL_SIZE: int = int(os.environ.get("DB_POOL_SIZE", 10))  # только для PostgreSQL
+DB_MAX_OVERFLOW: int = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+DB_POOL_RECYCLE: int = int(os.environ.get("DB_POOL_RECYCLE", 1800))  # сек
+SQLITE_JOURNAL_MODE: str = os.environ.get("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS: str = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_CACHE_SIZE: int = int(os.environ.get("SQLITE_CACHE_SIZE", -64000))  # отрицательное значение — в КиБ
+SQLITE_MMAP_SIZE: int = int(os.environ.get("SQLITE_MMAP_SIZE", 268435456))
+SQLITE_BUSY_TIMEOUT: int = int(os.environ.get("SQLITE_BUSY_TIMEOUT", 5000))  # мс
+DB_WRITE_POOL_SIZE: int = int(os.environ.get("DB_WRITE_POOL_SIZE", 1))
+DB_WRITE_MAX_OVERFLOW: int = int(os.environ.get("DB_WRITE_MAX_OVERFLOW", 2))
+DB_READ_POOL_SIZE: int = int(os.environ.get("DB_READ_POOL_SIZE", 5))
+REPORT_MAX_CONCURRENT: int = int(os.environ.get("REPORT_MAX_CONCURRENT", 2))
+REPORT_PROCESS_WORKERS: int = int(os.environ.get("REPORT_PROCESS_WORKERS", 2))
+STAT_CACHE_TTL: int = int(os.environ.get("STAT_CACHE_TTL", 60))
+DAILY_METRICS_RECENT_DAYS: int = int(os.environ.get("DAILY_METRICS_RECENT_DAYS", 7))  # дни регистрации, пересчитываемые всегда
+PAYMENT_HTTP_TIMEOUT: int = int(os.environ.get("PAYMENT_HTTP_TIMEOUT", 15))  # сек, на запрос к Platega / CryptoBot
+PAYMENT_HTTP_LIMIT_PER_HOST: int = int(os.environ.get("PAYMENT_HTTP_LIMIT_PER_HOST", 10))
+PLATEGA_POLL_CONCURRENCY: int = int(os.environ.get("PLATEGA_POLL_CONCURRENCY", 10))
+PLATEGA_RATE: float = float(os.environ.get("PLATEGA_RATE", 5))  # запросов статуса в секунду
+PENDING_POLL_BATCH: int = int(os.environ.get("PENDING_POLL_BATCH", 500))  # платежей из одной таблицы за проход
+PENDING_POLL_MIN_INTERVAL: int = int(os.environ.get("PENDING_POLL_MIN_INTERVAL", 60))  # сек, для свежих платежей
+PENDING_POLL_MAX_INTERVAL: int = int(os.environ.get("PENDING_POLL_MAX_INTERVAL", 1800))  # сек
+PENDING_EXPIRE_HOURS: int = int(os.environ.get("PENDING_EXPIRE_HOURS", 24))  # после этого pending считаем брошенным
+PAYMENT_WEBHOOKS_ENABLED: bool = os.environ.get("PAYMENT_WEBHOOKS_ENABLED", "0").lower() in ("1", "true", "yes")
+WEBHOOK_HOST: str = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT: int = int(os.environ.get("WEBHOOK_PORT", 8080))
+PLATEGA_WEBHOOK_PATH: str = os.environ.get("PLATEGA_WEBHOOK_PATH", "/webhooks/platega")
+CRYPTOBOT_WEBHOOK_PATH: str = os.environ.get("CRYPTOBOT_WEBHOOK_PATH", "/webhooks/cryptobot")
+PAYMENT_RECONCILE_MINUTES: int = int(os.environ.get("PAYMENT_RECONCILE_MINUTES", 10))  # опрос при включённых вебхуках
+BOT_WEBHOOK_URL: Optional[str] = os.environ.get("BOT_WEBHOOK_URL")  # например, https://bot.example.com; без него — polling
+BOT_WEBHOOK_PATH: str = os.environ.get("BOT_WEBHOOK_PATH", "/webhooks/telegram")
+BOT_WEBHOOK_SECRET: Optional[str] = os.environ.get("BOT_WEBHOOK_SECRET")
+BOT_UPDATES_CONCURRENCY: int = int(os.environ.get("BOT_UPDATES_CONCURRENCY", 50))  # апдейтов в обработке одновременно
+BOT_SHUTDOWN_DRAIN_TIMEOUT: int = int(os.environ.get("BOT_SHUTDOWN_DRAIN_TIMEOUT", 30))  # сек
+PAYMENT_PROCESS_CONCURRENCY: int = int(os.environ.get("PAYMENT_PROCESS_CONCURRENCY", 5))  # платежей в обработке одновременно
+PAYMENT_PROCESSING_TIMEOUT: int = int(os.environ.get("PAYMENT_PROCESSING_TIMEOUT", 15))  # мин, после этого 'processing' считаем зависшим
+PAYMENT_MAX_ATTEMPTS: int = int(os.environ.get("PAYMENT_MAX_ATTEMPTS", 5))  # попыток обработки, дальше только вручную
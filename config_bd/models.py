@@ -1,11 +1,72 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, BigInteger, Date, Float
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, BigInteger, Date, Float, Index, UniqueConstraint, \
+    event, inspect, text
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncAttrs
 from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from datetime import datetime
 
-DB_URL = "sqlite+aiosqlite:///sqlite3.db"  # или путь к вашей БД
-engine = create_async_engine(DB_URL, echo=False)
+from config import DB_URL, DB_READ_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_RECYCLE, SQLITE_JOURNAL_MODE, \
+    SQLITE_SYNCHRONOUS, SQLITE_CACHE_SIZE, SQLITE_MMAP_SIZE, SQLITE_BUSY_TIMEOUT, DB_WRITE_POOL_SIZE, \
+    DB_WRITE_MAX_OVERFLOW, DB_READ_POOL_SIZE
+
+
+def _is_sqlite(url: str) -> bool:
+    return make_url(url).get_backend_name() == 'sqlite'
+
+
+def _is_sqlite_memory(url: str) -> bool:
+    return _is_sqlite(url) and make_url(url).database in (None, '', ':memory:')
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+def _create_engine(url: str, read: bool):
+    if not _is_sqlite(url):
+        # PostgreSQL (asyncpg): обычный пул, писателей может быть много
+        return create_async_engine(
+            url, echo=False,
+            pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+            pool_pre_ping=True, pool_recycle=DB_POOL_RECYCLE
+        )
+    if _is_sqlite_memory(url):
+        # База в памяти живёт в одном соединении (StaticPool), размеры пула к ней неприменимы
+        sqlite_engine = create_async_engine(url, echo=False)
+    # SQLite допускает одного писателя, поэтому пул записи держим маленьким,
+    # а чтение (рассылки, статистика, экспорт) идёт через отдельный пул.
+    # Пул задаём явно: в SQLAlchemy < 2.0.38 файловый aiosqlite по умолчанию без пула (NullPool)
+    elif read:
+        sqlite_engine = create_async_engine(
+            url, echo=False, poolclass=AsyncAdaptedQueuePool,
+            pool_size=DB_READ_POOL_SIZE, max_overflow=0
+        )
+    else:
+        sqlite_engine = create_async_engine(
+            url, echo=False, poolclass=AsyncAdaptedQueuePool,
+            pool_size=DB_WRITE_POOL_SIZE, max_overflow=DB_WRITE_MAX_OVERFLOW
+        )
+    event.listen(sqlite_engine.sync_engine, "connect", _set_sqlite_pragmas)
+    return sqlite_engine
+
+
+engine = _create_engine(DB_URL, read=False)
+# Для PostgreSQL без отдельной реплики читаем через общий пул; SQLite в памяти существует в одном соединении
+if DB_READ_URL == DB_URL and (not _is_sqlite(DB_URL) or _is_sqlite_memory(DB_URL)):
+    read_engine = engine
+else:
+    read_engine = _create_engine(DB_READ_URL, read=True)
+
 AsyncSessionLocal = async_sessionmaker(engine, expire_on_commit=False)
+AsyncReadSessionLocal = async_sessionmaker(read_engine, expire_on_commit=False)
 
 
 class Base(DeclarativeBase, AsyncAttrs):
@@ -16,21 +77,26 @@ class Users(Base):
     __tablename__ = 'users'
     id = Column('Id', Integer, primary_key=True)
     user_id = Column('User_id', BigInteger, unique=True, nullable=False)
-    ref = Column('Ref', String(100), nullable=True)
+    ref = Column('Ref', String(100), nullable=True, index=True)
     is_delete = Column('Is_delete', Boolean, default=False)
-    is_pay_null = Column('Is_pay_null', Boolean, default=False)
-    is_tarif = Column('Is_tarif', Boolean, default=False)
-    create_user = Column('Create_user', DateTime, default=datetime.now)
+    is_pay_null = Column('Is_pay_null', Boolean, default=False, index=True)
+    is_tarif = Column('Is_tarif', Boolean, default=False, index=True)
+    create_user = Column('Create_user', DateTime, default=datetime.now, index=True)
     is_admin = Column('Is_admin', Boolean, default=False)
     has_discount = Column('has_discount', Boolean, default=False)
     subscription_end_date = Column('subscription_end_date', DateTime, nullable=True)
     white_subscription_end_date = Column('white_subscription_end_date', DateTime, nullable=True)
     last_notification_date = Column('last_notification_date', Date, nullable=True)
     last_broadcast_status = Column('last_broadcast_status', String(100), nullable=True)
-    last_broadcast_date = Column('last_broadcast_date', DateTime, nullable=True)
-    stamp = Column('stamp', String(100), nullable=False)
+    last_broadcast_date = Column('last_broadcast_date', DateTime, nullable=True, index=True)
+    stamp = Column('stamp', String(100), nullable=False, index=True)
     ttclid = Column('ttclid', String(100), nullable=True)
 
+    __table_args__ = (
+        # Сегменты рассылки всегда фильтруют по этой тройке флагов
+        Index('ix_users_segment', 'Is_delete', 'Is_pay_null', 'Is_tarif'),
+    )
+
 
 class Gifts(Base):
     __tablename__ = 'gifts'
@@ -47,67 +113,155 @@ class Payments(Base):
     __tablename__ = 'payments'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    user_id = Column(BigInteger, nullable=False)
+    user_id = Column(BigInteger, nullable=False, index=True)
     amount = Column(Integer, nullable=False)
-    time_created = Column(DateTime, default=datetime.now)
+    time_created = Column(DateTime, default=datetime.now, index=True)
     is_gift = Column(Boolean, default=False)
-    status = Column(String, nullable=True)
-    transaction_id = Column(String, nullable=True)
+    status = Column(String, nullable=True, index=True)
+    transaction_id = Column(String, nullable=True, index=True)
     payload = Column(String, nullable=True)
+    next_check_at = Column(DateTime, default=datetime.now)  # когда следующий раз спрашивать статус у Platega
+    check_attempts = Column(Integer, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (Index('ix_payments_status_next_check_at', 'status', 'next_check_at'),)
 
 
 class PaymentsCards(Base):
     __tablename__ = 'payments_cards'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    user_id = Column(BigInteger, nullable=False)
+    user_id = Column(BigInteger, nullable=False, index=True)
     amount = Column(Integer, nullable=False)
-    time_created = Column(DateTime, default=datetime.now)
+    time_created = Column(DateTime, default=datetime.now, index=True)
     is_gift = Column(Boolean, default=False)
-    status = Column(String, nullable=True)
-    transaction_id = Column(String, nullable=True)
+    status = Column(String, nullable=True, index=True)
+    transaction_id = Column(String, nullable=True, index=True)
     payload = Column(String, nullable=True)
+    next_check_at = Column(DateTime, default=datetime.now)  # когда следующий раз спрашивать статус у Platega
+    check_attempts = Column(Integer, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (Index('ix_payments_cards_status_next_check_at', 'status', 'next_check_at'),)
 
 
 class PaymentsPlategaCrypto(Base):
     __tablename__ = 'payments_platega_crypto'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    user_id = Column(BigInteger, nullable=False)
+    user_id = Column(BigInteger, nullable=False, index=True)
     amount = Column(Integer, nullable=False)
-    time_created = Column(DateTime, default=datetime.now)
+    time_created = Column(DateTime, default=datetime.now, index=True)
     is_gift = Column(Boolean, default=False)
-    status = Column(String, nullable=True)
-    transaction_id = Column(String, nullable=True)
+    status = Column(String, nullable=True, index=True)
+    transaction_id = Column(String, nullable=True, index=True)
     payload = Column(String, nullable=True)
+    next_check_at = Column(DateTime, default=datetime.now)  # когда следующий раз спрашивать статус у Platega
+    check_attempts = Column(Integer, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (Index('ix_payments_platega_crypto_status_next_check_at', 'status', 'next_check_at'),)
 
 
 class PaymentsStars(Base):
     __tablename__ = 'payments_stars'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    user_id = Column(BigInteger, nullable=False)
+    user_id = Column(BigInteger, nullable=False, index=True)
     amount = Column(Integer, nullable=False)
-    time_created = Column(DateTime, default=datetime.now)
+    time_created = Column(DateTime, default=datetime.now, index=True)
     is_gift = Column(Boolean, default=False)
-    status = Column(String, default='confirmed')
+    status = Column(String, default='confirmed', index=True)
     payload = Column(String, nullable=True)
+    payment_key = Column(String, nullable=True, unique=True)  # stars:<charge_id>, повтор обработки не пишет платёж дважды
 
 
 class PaymentsCryptobot(Base):
     __tablename__ = 'payments_cryptobot'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    user_id = Column(BigInteger, nullable=False)
+    user_id = Column(BigInteger, nullable=False, index=True)
     amount = Column(Float, nullable=False)
     currency = Column(String(10), nullable=False)
-    time_created = Column(DateTime, default=datetime.now)
+    time_created = Column(DateTime, default=datetime.now, index=True)
     is_gift = Column(Boolean, default=False)
-    status = Column(String, default='pending')
-    invoice_id = Column(String, nullable=True)
+    status = Column(String, default='pending', index=True)
+    invoice_id = Column(String, nullable=True, index=True)
     payload = Column(String, nullable=True)
 
 
+class PaymentsLedger(Base):
+    """Единый журнал платежей всех провайдеров с суммой, приведённой к рублям."""
+    __tablename__ = 'payments_ledger'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    provider = Column(String(20), nullable=False)  # sbp / card / platega_crypto / stars / cryptobot
+    source_id = Column(Integer, nullable=False)  # id строки в таблице провайдера
+    user_id = Column(BigInteger, nullable=False, index=True)
+    amount = Column(Float, nullable=False)  # в валюте платежа
+    currency = Column(String(10), nullable=False)
+    amount_rub = Column(Integer, nullable=True)  # None, если сумму не удалось сопоставить тарифу
+    is_gift = Column(Boolean, default=False)
+    status = Column(String(20), nullable=False)  # pending / confirmed / canceled ...
+    is_test = Column(Boolean, default=False)
+    time_created = Column(DateTime, default=datetime.now)
+
+    __table_args__ = (
+        UniqueConstraint('provider', 'source_id', name='uq_payments_ledger_source'),
+        Index('ix_payments_ledger_status_time', 'status', 'time_created'),
+    )
+
+
+class PaymentsDaily(Base):
+    """Подневная выручка по провайдерам, обновляется вместе с журналом."""
+    __tablename__ = 'payments_daily'
+
+    day = Column(Date, primary_key=True)
+    provider = Column(String(20), primary_key=True)
+    is_gift = Column(Boolean, primary_key=True)
+    amount_rub = Column(Integer, default=0)
+    payments_count = Column(Integer, default=0)
+
+
+class DailyMetrics(Base):
+    """Подневные метрики новых пользователей с разбивкой залив/сарафан для analytics_export."""
+    __tablename__ = 'daily_metrics'
+
+    day = Column(Date, primary_key=True)  # день регистрации
+    source = Column(String(10), primary_key=True)  # zaliv / saraf
+    new_users = Column(Integer, default=0)
+    key_users = Column(Integer, default=0)  # Is_pay_null
+    connect_users = Column(Integer, default=0)  # Is_tarif
+    paid_users = Column(Integer, default=0)  # платили хоть раз
+    pay_new_sum = Column(Integer, default=0)  # оплаты в месяц регистрации, ₽
+    pay_new_users = Column(Integer, default=0)
+    time_updated = Column(DateTime, default=datetime.now)
+
+
+class DailyMetricsState(Base):
+    """Служебные отметки пересчёта daily_metrics (name -> время)."""
+    __tablename__ = 'daily_metrics_state'
+
+    name = Column(String(50), primary_key=True)  # watermark / full_refresh
+    value = Column(DateTime, nullable=False)
+
+
+class ProcessedPayments(Base):
+    """Отметка об обработке подтверждённого платежа: по ней платёж не выдаётся дважды (опрос, вебхук, повтор)."""
+    __tablename__ = 'processed_payments'
+
+    payment_key = Column(String, primary_key=True)  # провайдер:идентификатор транзакции
+    user_id = Column(BigInteger, nullable=False, index=True)
+    status = Column(String, nullable=False)  # processing / done / failed
+    payload = Column(String, nullable=True)  # для повторной обработки сверкой
+    attempts = Column(Integer, nullable=False, default=0, server_default='0')
+    # Дата окончания после продления в панели (МСК); заполнена — панель уже продлена, повтор дни не начисляет
+    panel_expire_at = Column(DateTime, nullable=True)
+    time_created = Column(DateTime, default=datetime.now)  # время последнего захвата под обработку
+    time_done = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index('ix_processed_payments_status_time_created', 'status', 'time_created'),
+    )
+
+
 class WhiteCounter(Base):
     __tablename__ = 'white_counter'
 
@@ -127,7 +281,72 @@ class Online(Base):
     users_trial = Column(Integer, nullable=False)
 
 
+class BroadcastJobs(Base):
+    __tablename__ = 'broadcast_jobs'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    admin_chat_id = Column(BigInteger, nullable=False)
+    from_chat_id = Column(BigInteger, nullable=False)
+    message_id = Column(Integer, nullable=False)
+    segment = Column(String(100), nullable=False)
+    status = Column(String(20), default='running')  # running / done
+    cursor = Column(BigInteger, default=0)  # все получатели с user_id <= cursor обработаны
+    total = Column(Integer, default=0)
+    sent = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    time_created = Column(DateTime, default=datetime.now)
+    time_updated = Column(DateTime, default=datetime.now)
+
+
+class BroadcastRecipients(Base):
+    __tablename__ = 'broadcast_recipients'
+
+    job_id = Column(Integer, primary_key=True)
+    user_id = Column(BigInteger, primary_key=True)
+
+
+# Чем заполнить колонку, добавленную в уже существующую таблицу
+_COLUMN_BACKFILL = {
+    'next_check_at': 'time_created',
+}
+
+
+def _add_missing_columns(sync_conn):
+    # create_all не добавляет колонки в существующие таблицы, поэтому
+    # новые колонки моделей докатываем через ALTER TABLE
+    inspector = inspect(sync_conn)
+    for table in Base.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=sync_conn.dialect)}"
+            if column.server_default is not None:
+                ddl += f" DEFAULT {column.server_default.arg}"
+                if not column.nullable:
+                    ddl += " NOT NULL"
+            sync_conn.execute(text(ddl))
+            source = _COLUMN_BACKFILL.get(column.name)
+            if source is not None:
+                sync_conn.execute(text(f"UPDATE {table.name} SET {column.name} = {source}"))
+
+
+def _create_missing_indexes(sync_conn):
+    # create_all не трогает уже существующие таблицы, поэтому индексы,
+    # добавленные в модели позже, докатываем отдельно
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
+
+
 # Функция для создания таблиц (запустить один раз)
-async def create_tables():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
\ No newline at end of file
+async def create_tables(db_engine=None):
+    async with (db_engine or engine).begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_add_missing_columns)
+        await conn.run_sync(_create_missing_indexes)
+
+async def dispose_engines():
+    await engine.dispose()
+    if read_engine is not engine:
+        await read_engine.dispose()
@@ -1,20 +1,168 @@
+import time
 import uuid
 
-from sqlalchemy import select, update, func, union
-from datetime import datetime, date
-from typing import Optional, List, Tuple, Dict
+from sqlalchemy import select, update, delete, insert, func, text, case, and_, or_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from datetime import datetime, date, timedelta
+from typing import AsyncIterator, Optional, List, Tuple, Dict, Set
 
-from config_bd.models import AsyncSessionLocal, Users, Payments, Gifts, PaymentsCryptobot, PaymentsStars, Online, \
-    WhiteCounter, PaymentsCards, PaymentsPlategaCrypto
+from config_bd.models import AsyncSessionLocal, AsyncReadSessionLocal, Users, Payments, Gifts, PaymentsCryptobot, \
+    PaymentsStars, Online, WhiteCounter, PaymentsCards, PaymentsPlategaCrypto, BroadcastJobs, BroadcastRecipients, \
+    PaymentsLedger, PaymentsDaily, DailyMetrics, DailyMetricsState, ProcessedPayments
+from config import STAT_CACHE_TTL, PENDING_POLL_BATCH, PENDING_EXPIRE_HOURS, DAILY_METRICS_RECENT_DAYS
 from logging_config import logger
 
+SQLITE_MAX_PARAMS = 900  # SQLite по умолчанию допускает не более 999 параметров в одном запросе
+
+# Колонки users в порядке кортежа, который возвращает SELECT_ID
+USER_COLUMNS = (
+    Users.id, Users.user_id, Users.ref, Users.is_delete,
+    Users.is_pay_null, Users.is_tarif, Users.create_user,
+    Users.is_admin, Users.has_discount, Users.subscription_end_date,
+    Users.white_subscription_end_date, Users.last_notification_date,
+    Users.last_broadcast_status, Users.last_broadcast_date,
+    Users.stamp, Users.ttclid
+)
+
+
+def chunked(items: List, size: int = SQLITE_MAX_PARAMS):
+    """Режет список на куски не длиннее size."""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+# ---------- Вспомогательные функции конвертации ----------
+def convert_stars_to_rub(amount: int) -> Optional[int]:
+    mapping = {
+        66: 99,
+        179: 269,
+        199: 299,
+        333: 499,
+        99: 99,
+        269: 269,
+        299: 299,
+        499: 499
+    }
+    return mapping.get(amount)
+
+
+def convert_crypto_to_rub(currency: str, amount: str) -> Optional[int]:
+    mapping = {
+        'TON': {'0.9': 99, '2.5': 269, '2.8': 299, '4.6': 499},
+        'USDT': {'1.3': 99, '3.5': 269, '4.0': 299, '6.5': 499}
+    }
+    return mapping.get(currency, {}).get(amount)
+
+
+# Рефералы, пользователи которых считаются «заливом» (вместе со всеми, у кого есть stamp)
+REF_ZALIV = [
+    '1012882762', '1751833324', '7715104509', '6045891248', '778794666',
+    '6803123509', '7623377322', '8036879919', '8185054692', '7208737418',
+    '7545883972', '7801801881', '7231201607', '7863386911', '7251811519',
+    '7717099908', '6514719405', '8154969535', '8196772935', '7985311643',
+    '7607443801', '7617180616', '7780587251', '7999153238', '8075803624',
+    '7774377890', '7939767168'
+]
+
+# Id пользователей, не учитываемых в аналитике
+EXCLUDE_IDS = list(range(45, 1046))
+
+DAILY_METRIC_FIELDS = ('new_users', 'key_users', 'connect_users', 'paid_users', 'pay_new_sum', 'pay_new_users')
+
+
+# Таблицы провайдеров, которые зеркалируются в payments_ledger
+LEDGER_PROVIDERS = {
+    'sbp': Payments,
+    'card': PaymentsCards,
+    'platega_crypto': PaymentsPlategaCrypto,
+    'stars': PaymentsStars,
+    'cryptobot': PaymentsCryptobot,
+}
+
+# Провайдеры, чьи платежи лежат в таблицах Platega (transaction_id, опрос по next_check_at)
+PLATEGA_PROVIDERS = ('sbp', 'card', 'platega_crypto')
+
+# Статусы провайдеров, приведённые к общему виду
+LEDGER_STATUS_MAP = {
+    'paid': 'confirmed',  # Cryptobot
+    'active': 'pending',  # Cryptobot
+}
+
+
+def ledger_values(provider: str, payment) -> Dict:
+    """Строка payments_ledger для платежа из таблицы провайдера."""
+    if provider == 'stars':
+        currency = 'XTR'
+        amount_rub = convert_stars_to_rub(payment.amount)
+        is_test = False
+    elif provider == 'cryptobot':
+        currency = payment.currency
+        amount_rub = convert_crypto_to_rub(payment.currency, str(payment.amount))
+        is_test = payment.amount <= 0.02
+    else:
+        currency = 'RUB'
+        amount_rub = payment.amount
+        is_test = payment.amount == 1  # тестовые платежи на 1 рубль
+    return {
+        'provider': provider,
+        'source_id': payment.id,
+        'user_id': payment.user_id,
+        'amount': payment.amount,
+        'currency': currency,
+        'amount_rub': amount_rub,
+        'is_gift': bool(payment.is_gift),
+        'status': LEDGER_STATUS_MAP.get(payment.status, payment.status),
+        'is_test': is_test,
+        'time_created': payment.time_created,
+    }
+
+
+def _daily_key(row) -> Optional[Tuple]:
+    """(день, провайдер, подарок, сумма), если платёж учитывается в payments_daily."""
+    if row is None or row['status'] != 'confirmed' or row['is_test'] or row['amount_rub'] is None:
+        return None
+    return row['time_created'].date(), row['provider'], bool(row['is_gift']), row['amount_rub']
+
+
+def _day_ranges(days: Set[date]) -> List[Tuple[date, date]]:
+    """Склеивает дни в непрерывные отрезки (первый, последний день), чтобы фильтр был короче."""
+    ranges: List[Tuple[date, date]] = []
+    for day in sorted(days):
+        if ranges and ranges[-1][1] + timedelta(days=1) == day:
+            ranges[-1] = (ranges[-1][0], day)
+        else:
+            ranges.append((day, day))
+    return ranges
+
+
+def upsert_stmt(dialect_name: str, model, values: Dict, index_elements: List[str],
+                increment: Tuple[str, ...] = ()):
+    """INSERT ... ON CONFLICT DO UPDATE для SQLite и PostgreSQL; колонки из increment суммируются."""
+    dialect_insert = pg_insert if dialect_name == 'postgresql' else sqlite_insert
+    stmt = dialect_insert(model).values(**values)
+    columns = model.__table__.c
+    set_ = {}
+    for key in values:
+        if key in index_elements:
+            continue
+        if key in increment:
+            set_[key] = columns[key] + stmt.excluded[key]
+        else:
+            set_[key] = stmt.excluded[key]
+    return stmt.on_conflict_do_update(index_elements=index_elements, set_=set_)
+
 
 class AsyncSQL:
     def __init__(self):
         self.session_factory = AsyncSessionLocal
+        # Чтение идёт через отдельный пул и не ждёт соединение писателя
+        self.read_session_factory = AsyncReadSessionLocal
+        # /stat: аргумент -> (время расчёта, результат)
+        self._stat_cache: Dict[str, Tuple[float, Tuple]] = {}
 
     async def SELECT_ID(self, user_id: int) -> Optional[Tuple]:
-        async with self.session_factory() as session:
+        async with self.read_session_factory() as session:
             stmt = select(Users).where(Users.user_id == user_id)
             result = await session.execute(stmt)
             user = result.scalar_one_or_none()
@@ -29,6 +177,23 @@ class AsyncSQL:
                 )
             return None
 
+    async def SELECT_IDS(self, user_ids: List[int]) -> Dict[int, Tuple]:
+        """
+        Пакетный аналог SELECT_ID: возвращает {user_id: кортеж в формате SELECT_ID}.
+        Пользователи, которых нет в БД, в словарь не попадают.
+        """
+        ids = list(dict.fromkeys(user_ids))
+        users = {}
+        if not ids:
+            return users
+        async with self.read_session_factory() as session:
+            for chunk in chunked(ids):
+                stmt = select(*USER_COLUMNS).where(Users.user_id.in_(chunk))
+                result = await session.execute(stmt)
+                for row in result.all():
+                    users[row[1]] = tuple(row)
+        return users
+
     async def INSERT(self, user_id: int, Is_pay_null: bool, Is_tarif: bool = False,
                      ref: str = '', is_delete: bool = False, Is_admin: bool = False,
                      stamp=''):
@@ -67,6 +232,26 @@ class AsyncSQL:
             await session.execute(stmt)
             await session.commit()
 
+    async def UPDATE_TARIFF_BULK(self, user_ids: List[int]) -> int:
+        """
+        Ставит Is_tarif = True всем переданным пользователям, у которых он ещё не стоит.
+        Чанки выполняются одной транзакцией. Возвращает число изменённых строк.
+        """
+        ids = list(dict.fromkeys(user_ids))
+        if not ids:
+            return 0
+        updated = 0
+        async with self.session_factory() as session:
+            for chunk in chunked(ids):
+                stmt = update(Users).where(
+                    Users.user_id.in_(chunk),
+                    (Users.is_tarif == False) | (Users.is_tarif.is_(None))
+                ).values(is_tarif=True).execution_options(synchronize_session=False)
+                result = await session.execute(stmt)
+                updated += result.rowcount
+            await session.commit()
+        return updated
+
     async def UPDATE_TTCLID(self, user_id: int, ttclid: str):
         async with self.session_factory() as session:
             stmt = update(Users).where(Users.user_id == user_id).values(ttclid=ttclid)
@@ -95,7 +280,7 @@ class AsyncSQL:
 
 
     async def SELECT_REF(self, user_id: int) -> Optional[Tuple]:
-        async with self.session_factory() as session:
+        async with self.read_session_factory() as session:
             stmt = select(Users).where(Users.user_id == user_id, Users.is_pay_null == True)
             result = await session.execute(stmt)
             user = result.scalar_one_or_none()
@@ -109,7 +294,7 @@ class AsyncSQL:
             return None
 
     async def SELECT_COUNT_REF(self, user_id: int) -> int:
-        async with self.session_factory() as session:
+        async with self.read_session_factory() as session:
             stmt = select(func.count(Users.user_id)).where(Users.ref == str(user_id))
             result = await session.execute(stmt)
             return result.scalar() or 0
@@ -127,13 +312,13 @@ class AsyncSQL:
             await session.commit()
 
     async def get_subscription_end_date(self, user_id: int) -> Optional[datetime]:
-        async with self.session_factory() as session:
+        async with self.read_session_factory() as session:
             stmt = select(Users.subscription_end_date).where(Users.user_id == user_id)
             result = await session.execute(stmt)
             return result.scalar_one_or_none()
 
     async def notification_sent_today(self, user_id: int) -> bool:
-        async with self.session_factory() as session:
+        async with self.read_session_factory() as session:
             stmt = select(Users.last_notification_date).where(Users.user_id == user_id)
             result = await session.execute(stmt)
             last = result.scalar_one_or_none()
@@ -151,7 +336,7 @@ class AsyncSQL:
             await session.commit()
 
     async def get_last_notification_date(self, user_id: int) -> Optional[date]:
-        async with self.session_factory() as session:
+        async with self.read_session_factory() as session:
             stmt = select(Users.last_notification_date).where(Users.user_id == user_id)
             result = await session.execute(stmt)
             val = result.scalar_one_or_none()
@@ -168,117 +353,161 @@ class AsyncSQL:
             await session.execute(stmt)
             await session.commit()
 
-    async def SELECT_ALL_USERS(self) -> List[int]:
-        async with self.session_factory() as session:
-            stmt = select(Users.user_id).where(
+    def _paid_users_stmt(self):
+        """user_id всех, у кого есть хотя бы одна успешная оплата у любого провайдера."""
+        return select(PaymentsLedger.user_id).where(PaymentsLedger.status == 'confirmed').distinct()
+
+    def _segment_stmt(self, parameter: str):
+        """Запрос user_id для сегмента рассылки (см. GET_AVAILABLE_PARAMETERS)."""
+        current_time = datetime.now()
+        today = current_time.date()
+        not_broadcast_today = (Users.last_broadcast_date.is_(None)) | \
+                              (func.date(Users.last_broadcast_date) != today)
+        subscribe_off = (Users.subscription_end_date < current_time) | \
+                        (Users.subscription_end_date.is_(None))
+
+        if parameter == 'all_users':
+            return select(Users.user_id).where(
                 Users.is_delete == False
             )
-            result = await session.execute(stmt)
-            return [row[0] for row in result.all()]
-
-    async def SELECT_NOT_CONNECTED_SUBSCRIBE_YES(self) -> List[int]:
-        async with self.session_factory() as session:
-            current_time = datetime.now()
-            today = date.today()
-            stmt = select(Users.user_id).where(
+        if parameter == 'not_connected_subscribe_yes':
+            return select(Users.user_id).where(
                 Users.is_pay_null == True,
                 Users.is_tarif == False,
                 Users.is_delete == False,
                 Users.subscription_end_date > current_time,
-                (Users.last_broadcast_date.is_(None)) | (func.date(Users.last_broadcast_date) != today)
+                not_broadcast_today
             )
-            result = await session.execute(stmt)
-            return [row[0] for row in result.all()]
-
-    async def SELECT_NOT_CONNECTED_SUBSCRIBE_OFF(self):
-        async with self.session_factory() as session:
-            current_time = datetime.now()
-            today = datetime.now().date()
-            stmt = select(Users.user_id).where(
+        if parameter == 'not_connected_subscribe_off':
+            return select(Users.user_id).where(
                 Users.is_pay_null == True,
                 Users.is_tarif == False,
                 Users.is_delete == False,
-                (Users.subscription_end_date < current_time) |
-                (Users.subscription_end_date.is_(None)),
-                (Users.last_broadcast_date.is_(None)) |
-                (func.date(Users.last_broadcast_date) != today)
+                subscribe_off,
+                not_broadcast_today
             )
-            result = await session.execute(stmt)
-            return [row[0] for row in result.all()]
-
-    async def SELECT_CONNECTED_SUBSCRIBE_OFF(self):
-        async with self.session_factory() as session:
-            current_time = datetime.now()
-            today = datetime.now().date()
-            stmt = select(Users.user_id).where(
+        if parameter == 'connected_subscribe_off':
+            return select(Users.user_id).where(
                 Users.is_pay_null == True,
                 Users.is_tarif == True,
                 Users.is_delete == False,
-                (Users.subscription_end_date < current_time) |
-                (Users.subscription_end_date.is_(None)),
-                (Users.last_broadcast_date.is_(None)) |
-                (func.date(Users.last_broadcast_date) != today)
+                subscribe_off,
+                not_broadcast_today
             )
-            result = await session.execute(stmt)
-            return [row[0] for row in result.all()]
-
-    async def SELECT_CONNECTED_SUBSCRIBE_YES(self):
-        async with self.session_factory() as session:
-            current_time = datetime.now()
-            today = datetime.now().date()
-            stmt = select(Users.user_id).where(
+        if parameter == 'connected_subscribe_yes':
+            return select(Users.user_id).where(
                 Users.is_pay_null == True,
                 Users.is_tarif == True,
                 Users.is_delete == False,
                 Users.subscription_end_date > current_time,
-                (Users.last_broadcast_date.is_(None)) |
-                (func.date(Users.last_broadcast_date) != today)
+                not_broadcast_today
             )
-            result = await session.execute(stmt)
-            return [row[0] for row in result.all()]
-
-    async def SELECT_NOT_SUBSCRIBED(self):
-        async with self.session_factory() as session:
-            today = datetime.now().date()
-            stmt = select(Users.user_id).where(
+        if parameter == 'not_subscribed':
+            return select(Users.user_id).where(
                 Users.is_pay_null == False,
                 Users.is_tarif == False,
                 Users.is_delete == False,
-                (Users.last_broadcast_date.is_(None)) |
-                (func.date(Users.last_broadcast_date) != today)
+                not_broadcast_today
             )
-            result = await session.execute(stmt)
+        if parameter == 'connected_never_paid':
+            # Подзапрос: все пользователи с успешными платежами
+            paid_subq = self._paid_users_stmt().subquery()
+            return select(Users.user_id).where(
+                Users.is_tarif == True,
+                Users.is_delete == False,
+                not_broadcast_today,
+                Users.user_id.notin_(select(paid_subq))
+            )
+        if parameter == 'subscribed_all':
+            return select(Users.user_id).where(
+                Users.is_pay_null == True,
+                Users.subscription_end_date != None,
+                Users.is_delete == False
+            )
+        raise ValueError(f"Unknown segment: {parameter}")
+
+    async def SELECT_SEGMENT(self, parameter: str) -> List[int]:
+        """Возвращает user_id пользователей сегмента рассылки."""
+        async with self.read_session_factory() as session:
+            result = await session.execute(self._segment_stmt(parameter))
             return [row[0] for row in result.all()]
 
+    async def SELECT_SEGMENTS(self) -> Dict[str, List[int]]:
+        """
+        Раскладывает пользователей по всем сегментам из GET_AVAILABLE_PARAMETERS за один проход.
+        Условия совпадают с _segment_stmt (включая NULL-семантику SQL), но вместо восьми
+        запросов выполняются два: по users и по множеству когда-либо плативших.
+        """
+        current_time = datetime.now()
+        today = current_time.date()
+        segments = {parameter: [] for parameter in self.GET_AVAILABLE_PARAMETERS()}
+
+        async with self.read_session_factory() as session:
+            paid_result = await session.execute(self._paid_users_stmt())
+            paid_user_ids = {row[0] for row in paid_result.all()}
+
+            result = await session.execute(
+                select(Users.user_id, Users.is_delete, Users.is_pay_null, Users.is_tarif,
+                       Users.subscription_end_date, Users.last_broadcast_date)
+            )
+            rows = result.all()
+
+        for user_id, is_delete, is_pay_null, is_tarif, end_date, last_broadcast in rows:
+            # Как и в SQL, NULL не проходит ни сравнение с True, ни с False
+            if is_delete is None or is_delete:
+                continue
+            segments['all_users'].append(user_id)
+
+            not_broadcast_today = last_broadcast is None or last_broadcast.date() != today
+            subscribe_yes = end_date is not None and end_date > current_time
+            subscribe_off = end_date is None or end_date < current_time
+
+            if is_pay_null is True and end_date is not None:
+                segments['subscribed_all'].append(user_id)
+            if is_tarif is True and not_broadcast_today and user_id not in paid_user_ids:
+                segments['connected_never_paid'].append(user_id)
+            if not not_broadcast_today:
+                continue
+            if is_pay_null is True and is_tarif is False:
+                if subscribe_yes:
+                    segments['not_connected_subscribe_yes'].append(user_id)
+                elif subscribe_off:
+                    segments['not_connected_subscribe_off'].append(user_id)
+            elif is_pay_null is True and is_tarif is True:
+                if subscribe_yes:
+                    segments['connected_subscribe_yes'].append(user_id)
+                elif subscribe_off:
+                    segments['connected_subscribe_off'].append(user_id)
+            elif is_pay_null is False and is_tarif is False:
+                segments['not_subscribed'].append(user_id)
+
+        return segments
+
+    async def SELECT_ALL_USERS(self) -> List[int]:
+        return await self.SELECT_SEGMENT('all_users')
+
+    async def SELECT_NOT_CONNECTED_SUBSCRIBE_YES(self) -> List[int]:
+        return await self.SELECT_SEGMENT('not_connected_subscribe_yes')
+
+    async def SELECT_NOT_CONNECTED_SUBSCRIBE_OFF(self) -> List[int]:
+        return await self.SELECT_SEGMENT('not_connected_subscribe_off')
+
+    async def SELECT_CONNECTED_SUBSCRIBE_OFF(self) -> List[int]:
+        return await self.SELECT_SEGMENT('connected_subscribe_off')
+
+    async def SELECT_CONNECTED_SUBSCRIBE_YES(self) -> List[int]:
+        return await self.SELECT_SEGMENT('connected_subscribe_yes')
+
+    async def SELECT_NOT_SUBSCRIBED(self) -> List[int]:
+        return await self.SELECT_SEGMENT('not_subscribed')
+
     async def SELECT_CONNECTED_NEVER_PAID(self) -> List[int]:
         """
         Возвращает список user_id, у которых is_tarif=True, is_delete=False,
         и нет ни одной успешной оплаты (статус 'confirmed' в Payments или PaymentsStars,
         или статус 'paid' в PaymentsCryptobot).
         """
-        async with self.session_factory() as session:
-            # Подзапрос: все пользователи с успешными платежами
-            today = datetime.now().date()
-            paid_subq = (
-                select(Payments.user_id)
-                .where(Payments.status == 'confirmed')
-                .union(
-                    select(PaymentsStars.user_id).where(PaymentsStars.status == 'confirmed'),
-                    select(PaymentsCryptobot.user_id).where(PaymentsCryptobot.status == 'paid'),
-                    select(PaymentsCards.user_id).where(PaymentsCards.status == 'confirmed'),
-                    select(PaymentsPlategaCrypto.user_id).where(PaymentsPlategaCrypto.status == 'confirmed')
-                )
-                .subquery()
-            )
-            stmt = select(Users.user_id).where(
-                Users.is_tarif == True,
-                Users.is_delete == False,
-                (Users.last_broadcast_date.is_(None)) |
-                (func.date(Users.last_broadcast_date) != today),
-                Users.user_id.notin_(paid_subq)
-            )
-            result = await session.execute(stmt)
-            return [row[0] for row in result.all()]
+        return await self.SELECT_SEGMENT('connected_never_paid')
 
     async def SELECT_SUBSCRIBED_NOT_IN_PANEL(self) -> List[int]:
         """
@@ -286,7 +515,7 @@ class AsyncSQL:
         и нет ни одной успешной оплаты (статус 'confirmed' в Payments или PaymentsStars,
         или статус 'paid' в PaymentsCryptobot).
         """
-        async with self.session_factory() as session:
+        async with self.read_session_factory() as session:
             # Подзапрос: все пользователи с успешными платежами
             stmt = select(Users.user_id).where(
                 Users.is_pay_null == True,
@@ -297,15 +526,35 @@ class AsyncSQL:
             return [row[0] for row in result.all()]
 
     async def SELECT_SUBSCRIBED(self) -> List[int]:
-        async with self.session_factory() as session:
-            # Подзапрос: все пользователи с успешными платежами
-            stmt = select(Users.user_id).where(
-                Users.is_pay_null == True,
-                Users.subscription_end_date != None,
-                Users.is_delete == False
-            )
-            result = await session.execute(stmt)
-            return [row[0] for row in result.all()]
+        return await self.SELECT_SEGMENT('subscribed_all')
+
+    async def explain_segment_queries(self) -> Dict[str, Tuple[int, float, List[str]]]:
+        """
+        Для каждого сегмента рассылки возвращает (кол-во строк, время в мс, план запроса).
+        План берётся через EXPLAIN QUERY PLAN в SQLite и EXPLAIN в PostgreSQL.
+        Нужен, чтобы убедиться, что запросы сегментов идут по индексам, а не полным сканом.
+        """
+        report = {}
+        async with self.read_session_factory() as session:
+            dialect = session.bind.dialect
+            for parameter in self.GET_AVAILABLE_PARAMETERS():
+                stmt = self._segment_stmt(parameter)
+                compiled = stmt.compile(dialect=dialect, compile_kwargs={'literal_binds': True})
+                if dialect.name == 'sqlite':
+                    plan_result = await session.execute(text(f"EXPLAIN QUERY PLAN {compiled}"))
+                    plan = [row[-1] for row in plan_result.all()]
+                else:
+                    plan_result = await session.execute(text(f"EXPLAIN {compiled}"))
+                    plan = [row[0].strip() for row in plan_result.all()]
+
+                started = time.perf_counter()
+                result = await session.execute(stmt)
+                rows = len(result.all())
+                elapsed_ms = (time.perf_counter() - started) * 1000
+
+                report[parameter] = (rows, elapsed_ms, plan)
+                logger.info(f"Segment query {parameter}: {rows} rows, {elapsed_ms:.1f} ms, plan: {plan}")
+        return report
 
     async def SELECT_USERS_BY_PARAMETER(self, parameter: str, value: str) -> List[int]:
         """
@@ -334,7 +583,7 @@ class AsyncSQL:
         else:
             val = value
 
-        async with self.session_factory() as session:
+        async with self.read_session_factory() as session:
             stmt = select(Users.user_id).where(attr == val)
             result = await session.execute(stmt)
             rows = result.all()
@@ -345,51 +594,58 @@ class AsyncSQL:
         """
         Возвращает статистику по пользователям, у которых Ref == arg,
         если таких нет – по пользователям с stamp == arg.
-        Возвращает (total, with_sub, with_tarif, total_payments, source)
-        или (None, None, None, None, None) если нет совпадений.
-        """
-        # 1. Ищем по Ref
-        users = await self.SELECT_USERS_BY_PARAMETER('Ref', arg)
-        source = 'ref'
-        if not users:
-            # 2. Ищем по stamp
-            users = await self.SELECT_USERS_BY_PARAMETER('stamp', arg)
-            source = 'stamp'
-
-        if not users:
-            return None, None, None, None, None, None
-
-        total = len(users)
-        with_sub = 0
-        with_tarif = 0
-        with_tarif_not_blocked = 0
-
-        for user_id in users:
-            user_data = await self.SELECT_ID(user_id)
-            if user_data:
-                # subscription_end_date — индекс 9, Is_tarif — индекс 5
-                if user_data[9] is not None:
-                    with_sub += 1
-                if user_data[5]:  # Is_tarif
-                    with_tarif += 1
-                if user_data[5] and not user_data[3]:
-                    with_tarif_not_blocked +=1
-        with_tarif = with_tarif // 2
-        with_tarif_not_blocked = with_tarif_not_blocked // 2
-
-        # Сумма подтверждённых платежей этих пользователей
-        total_payments = 0
-        if users:
-            async with self.session_factory() as session:
-                stmt = select(func.coalesce(func.sum(Payments.amount), 0)).where(
-                    Payments.user_id.in_(users),
-                    Payments.status == 'confirmed'
-                )
-                result = await session.execute(stmt)
-                total_payments = result.scalar() or 0
-                total_payments = total_payments // 2
+        Возвращает (total, with_sub, with_tarif, with_tarif_not_blocked, total_payments, source)
+        или кортеж из None, если нет совпадений. Считается одним агрегирующим запросом,
+        результат кэшируется на STAT_CACHE_TTL секунд.
+        """
+        cached = self._stat_cache.get(arg)
+        if cached and time.monotonic() - cached[0] < STAT_CACHE_TTL:
+            return cached[1]
+
+        # Пользователи с Ref == arg попадают в группу ref, остальные совпадения — в stamp.
+        # Группа stamp используется, только если по Ref никого нет, и тогда она совпадает с выборкой по stamp
+        source_expr = case((Users.ref == arg, 'ref'), else_='stamp')
+        matched = or_(Users.ref == arg, Users.stamp == arg)
+        # Сумма подтверждённых платежей по каждому подходящему пользователю
+        paid = (
+            select(Payments.user_id, func.sum(Payments.amount).label('amount'))
+            .where(
+                Payments.status == 'confirmed',
+                Payments.user_id.in_(select(Users.user_id).where(matched))
+            )
+            .group_by(Payments.user_id)
+            .subquery()
+        )
+        is_tarif = Users.is_tarif == True
+        stmt = (
+            select(
+                source_expr,
+                func.count(Users.id),
+                func.count(Users.subscription_end_date),
+                func.sum(case((is_tarif, 1), else_=0)),
+                func.sum(case((and_(is_tarif, or_(Users.is_delete == False, Users.is_delete.is_(None))), 1), else_=0)),
+                func.coalesce(func.sum(paid.c.amount), 0)
+            )
+            .outerjoin(paid, paid.c.user_id == Users.user_id)
+            .where(matched)
+            .group_by(source_expr)
+        )
+        async with self.read_session_factory() as session:
+            groups = {row[0]: row[1:] for row in (await session.execute(stmt)).all()}
+
+        source = 'ref' if 'ref' in groups else 'stamp'
+        if source not in groups:
+            stat = (None, None, None, None, None, None)
+        else:
+            total, with_sub, with_tarif, with_tarif_not_blocked, total_payments = groups[source]
+            stat = (total, with_sub, int(with_tarif) // 2, int(with_tarif_not_blocked) // 2,
+                    int(total_payments) // 2, source)
 
-        return total, with_sub, with_tarif, with_tarif_not_blocked, total_payments, source
+        now = time.monotonic()
+        self._stat_cache = {key: value for key, value in self._stat_cache.items()
+                            if now - value[0] < STAT_CACHE_TTL}
+        self._stat_cache[arg] = (now, stat)
+        return stat
 
     def GET_AVAILABLE_PARAMETERS(self) -> List[str]:
         """Возвращает список доступных параметров для фильтрации пользователей."""
@@ -433,7 +689,7 @@ class AsyncSQL:
         Возвращает список user_id, у которых есть хотя бы один платёж со статусом 'confirmed'.
         Если передан список user_ids, возвращаются только те, кто есть в этом списке.
         """
-        async with self.session_factory() as session:
+        async with self.read_session_factory() as session:
             stmt = select(Payments.user_id).where(Payments.status == 'confirmed').distinct()
             if user_ids:
                 stmt = stmt.where(Payments.user_id.in_(user_ids))
@@ -443,55 +699,33 @@ class AsyncSQL:
     async def get_payment_stats_by_period(self, start_date: datetime, end_date: datetime) -> Tuple[Dict[str, int], Dict[str, int]]:
         """
         Возвращает статистику платежей за период по группам ref и stamp.
-        Для каждого платежа с суммой != 1, статус 'confirmed', дата между start_date и end_date включительно,
-        находим пользователя и добавляем сумму в группы ref и stamp (если они заданы).
+        Берутся подтверждённые нетестовые платежи СБП из payments_ledger с датой между start_date
+        и end_date включительно; суммы группируются по ref и stamp пользователя (если они заданы).
         Возвращает два словаря: ref_totals, stamp_totals.
         """
         # Приводим даты к началу и концу суток для включительности
         start = datetime.combine(start_date.date(), datetime.min.time())
         end = datetime.combine(end_date.date(), datetime.max.time())
 
-        async with self.session_factory() as session:
-            # Получаем платежи за период, исключая сумму 1
-            stmt_payments = select(
-                Payments.user_id,
-                Payments.amount
-            ).where(
-                Payments.status == 'confirmed',
-                Payments.amount != 1,
-                Payments.time_created.between(start, end)
-            )
-            payments_result = await session.execute(stmt_payments)
-            payments_data = payments_result.all()
-
-            if not payments_data:
-                return {}, {}
-
-            # Собираем уникальные user_id из платежей
-            user_ids = list(set(p[0] for p in payments_data))
-
-            # Получаем данные всех этих пользователей одним запросом
-            stmt_users = select(
-                Users.user_id,
-                Users.ref,
-                Users.stamp
-            ).where(Users.user_id.in_(user_ids))
-            users_result = await session.execute(stmt_users)
-            users_data = users_result.all()
-
-        # Словарь для быстрого поиска ref и stamp по user_id
-        user_map = {u[0]: (u[1], u[2]) for u in users_data}
-
-        ref_totals = {}
-        stamp_totals = {}
-
-        for user_id, amount in payments_data:
-            ref, stamp = user_map.get(user_id, (None, None))
-            if ref:
-                ref_totals[ref] = ref_totals.get(ref, 0) + amount
-            if stamp:
-                stamp_totals[stamp] = stamp_totals.get(stamp, 0) + amount
+        paid_in_period = (
+            PaymentsLedger.provider == 'sbp',
+            PaymentsLedger.status == 'confirmed',
+            PaymentsLedger.is_test == False,
+            PaymentsLedger.time_created.between(start, end)
+        )
+        async with self.read_session_factory() as session:
+            totals = []
+            for column in (Users.ref, Users.stamp):
+                stmt = (
+                    select(column, func.sum(PaymentsLedger.amount_rub))
+                    .join(Users, Users.user_id == PaymentsLedger.user_id)
+                    .where(*paid_in_period, column.is_not(None), column != '')
+                    .group_by(column)
+                )
+                result = await session.execute(stmt)
+                totals.append({key: int(amount) for key, amount in result.all()})
 
+        ref_totals, stamp_totals = totals
         return ref_totals, stamp_totals
 
     async def update_broadcast_status(self, user_id: int, status: str) -> None:
@@ -510,6 +744,94 @@ class AsyncSQL:
                 await session.rollback()
                 logger.error(f"Error updating broadcast status for user {user_id}: {e}")
 
+    async def create_broadcast_job(self, admin_chat_id: int, from_chat_id: int, message_id: int,
+                                   segment: str, user_ids: List[int]) -> int:
+        """
+        Создаёт задание рассылки и замораживает список получателей.
+        Возвращает id задания.
+        """
+        ids = sorted(set(user_ids))
+        async with self.session_factory() as session:
+            job = BroadcastJobs(
+                admin_chat_id=admin_chat_id,
+                from_chat_id=from_chat_id,
+                message_id=message_id,
+                segment=segment,
+                status='running',
+                cursor=0,
+                total=len(ids)
+            )
+            session.add(job)
+            await session.flush()
+            for chunk in chunked(ids, 5000):
+                await session.execute(
+                    insert(BroadcastRecipients),
+                    [{'job_id': job.id, 'user_id': user_id} for user_id in chunk]
+                )
+            await session.commit()
+            logger.info(f"Создано задание рассылки {job.id}: {segment}, получателей {len(ids)}")
+            return job.id
+
+    async def get_broadcast_job(self, job_id: int) -> Optional[BroadcastJobs]:
+        async with self.read_session_factory() as session:
+            return await session.get(BroadcastJobs, job_id)
+
+    async def get_unfinished_broadcast_jobs(self) -> List[BroadcastJobs]:
+        """Возвращает задания рассылки, прерванные перезапуском бота."""
+        async with self.read_session_factory() as session:
+            stmt = select(BroadcastJobs).where(BroadcastJobs.status == 'running')
+            result = await session.execute(stmt)
+            return result.scalars().all()
+
+    async def get_broadcast_recipients(self, job_id: int, cursor: int, limit: int) -> List[int]:
+        """Следующая пачка получателей после cursor (по возрастанию user_id)."""
+        async with self.read_session_factory() as session:
+            stmt = select(BroadcastRecipients.user_id).where(
+                BroadcastRecipients.job_id == job_id,
+                BroadcastRecipients.user_id > cursor
+            ).order_by(BroadcastRecipients.user_id).limit(limit)
+            result = await session.execute(stmt)
+            return [row[0] for row in result.all()]
+
+    async def checkpoint_broadcast_job(self, job_id: int, cursor: int, statuses: Dict[int, str]) -> None:
+        """
+        Одной транзакцией сохраняет статусы пачки, счётчики и курсор задания.
+        """
+        sent = sum(1 for status in statuses.values() if status == 'sent')
+        failed = len(statuses) - sent
+        now = datetime.now()
+        async with self.session_factory() as session:
+            for status in ('sent', 'failed'):
+                user_ids = [user_id for user_id, st in statuses.items() if st == status]
+                for chunk in chunked(user_ids):
+                    await session.execute(
+                        update(Users).where(Users.user_id.in_(chunk)).values(
+                            last_broadcast_status=status,
+                            last_broadcast_date=now
+                        ).execution_options(synchronize_session=False)
+                    )
+            await session.execute(
+                update(BroadcastJobs).where(BroadcastJobs.id == job_id).values(
+                    cursor=cursor,
+                    sent=BroadcastJobs.sent + sent,
+                    failed=BroadcastJobs.failed + failed,
+                    time_updated=now
+                )
+            )
+            await session.commit()
+
+    async def finish_broadcast_job(self, job_id: int) -> None:
+        """Помечает задание завершённым и удаляет замороженный список получателей."""
+        async with self.session_factory() as session:
+            await session.execute(
+                update(BroadcastJobs).where(BroadcastJobs.id == job_id).values(
+                    status='done',
+                    time_updated=datetime.now()
+                )
+            )
+            await session.execute(delete(BroadcastRecipients).where(BroadcastRecipients.job_id == job_id))
+            await session.commit()
+
     async def activate_gift(self, gift_id: str, recipient_id: int) -> Tuple[bool, Optional[int], Optional[bool]]:
         """
         Активирует подарок по gift_id для указанного получателя.
@@ -541,32 +863,66 @@ class AsyncSQL:
                 logger.error(f"Error activating gift {gift_id} for user {recipient_id}: {e}")
                 return False, None, None
 
-    async def get_pending_platega_payments(self) -> List[Payments]:
-        """Возвращает все платежи из таблицы payments со статусом 'pending'."""
-        async with self.session_factory() as session:
-            stmt = select(Payments).where(Payments.status == 'pending')
+    async def _get_due_payments(self, model) -> List:
+        """
+        Pending-платежи, которым подошло время проверки (next_check_at <= сейчас), самые просроченные первыми.
+        Выборка идёт по индексу (status, next_check_at), а не по всем pending-платежам.
+        """
+        async with self.read_session_factory() as session:
+            stmt = (
+                select(model)
+                .where(model.status == 'pending', model.next_check_at <= datetime.now())
+                .order_by(model.next_check_at)
+                .limit(PENDING_POLL_BATCH)
+            )
             result = await session.execute(stmt)
             return result.scalars().all()
 
+    async def get_pending_platega_payments(self) -> List[Payments]:
+        """Возвращает платежи из таблицы payments со статусом 'pending', которые пора проверить."""
+        return await self._get_due_payments(Payments)
+
     async def get_pending_platega_card_payments(self) -> List[PaymentsCards]:
-        """Возвращает все платежи из таблицы payments со статусом 'pending'."""
-        async with self.session_factory() as session:
-            stmt = select(PaymentsCards).where(PaymentsCards.status == 'pending')
-            result = await session.execute(stmt)
-            return result.scalars().all()
+        """Возвращает платежи из таблицы payments_cards со статусом 'pending', которые пора проверить."""
+        return await self._get_due_payments(PaymentsCards)
 
     async def get_pending_platega_crypto_payments(self) -> List[PaymentsPlategaCrypto]:
-        """Возвращает все платежи из таблицы payments со статусом 'pending'."""
+        """Возвращает платежи из таблицы payments_platega_crypto со статусом 'pending', которые пора проверить."""
+        return await self._get_due_payments(PaymentsPlategaCrypto)
+
+    async def get_platega_payment(self, provider: str, transaction_id: str):
+        """Свежая строка платежа Platega из основной БД (не из реплики) — перед обработкой статуса."""
+        model = LEDGER_PROVIDERS[provider]
         async with self.session_factory() as session:
-            stmt = select(PaymentsPlategaCrypto).where(PaymentsPlategaCrypto.status == 'pending')
-            result = await session.execute(stmt)
-            return result.scalars().all()
+            result = await session.execute(select(model).where(model.transaction_id == transaction_id))
+            return result.scalars().first()
+
+    async def find_platega_payment(self, transaction_id: str) -> Optional[Tuple[str, object]]:
+        """Ищет платёж Platega во всех трёх таблицах; возвращает (провайдер, платёж) или None."""
+        for provider in PLATEGA_PROVIDERS:
+            payment = await self.get_platega_payment(provider, transaction_id)
+            if payment is not None:
+                return provider, payment
+        return None
+
+    async def schedule_payment_check(self, provider: str, transaction_id: str, next_check_at: datetime) -> None:
+        """Откладывает следующую проверку платежа Platega и увеличивает счётчик проверок."""
+        model = LEDGER_PROVIDERS[provider]
+        async with self.session_factory() as session:
+            stmt = (
+                update(model)
+                .where(model.transaction_id == transaction_id)
+                .values(next_check_at=next_check_at, check_attempts=model.check_attempts + 1)
+            )
+            await session.execute(stmt)
+            await session.commit()
 
     async def update_payment_status(self, transaction_id: str, new_status: str) -> None:
         """Обновляет статус платежа по transaction_id."""
         async with self.session_factory() as session:
             stmt = update(Payments).where(Payments.transaction_id == transaction_id).values(status=new_status)
             await session.execute(stmt)
+            await self._sync_ledger_where(session, 'sbp', Payments.transaction_id == transaction_id)
             await session.commit()
 
     async def update_payment_card_status(self, transaction_id: str, new_status: str) -> None:
@@ -574,6 +930,7 @@ class AsyncSQL:
         async with self.session_factory() as session:
             stmt = update(PaymentsCards).where(PaymentsCards.transaction_id == transaction_id).values(status=new_status)
             await session.execute(stmt)
+            await self._sync_ledger_where(session, 'card', PaymentsCards.transaction_id == transaction_id)
             await session.commit()
 
     async def update_payment_platega_crypto_status(self, transaction_id: str, new_status: str) -> None:
@@ -581,17 +938,25 @@ class AsyncSQL:
         async with self.session_factory() as session:
             stmt = update(PaymentsPlategaCrypto).where(PaymentsPlategaCrypto.transaction_id == transaction_id).values(status=new_status)
             await session.execute(stmt)
+            await self._sync_ledger_where(session, 'platega_crypto', PaymentsPlategaCrypto.transaction_id == transaction_id)
             await session.commit()
 
     async def get_active_cryptobot_payments(self) -> List[PaymentsCryptobot]:
         """
         Возвращает все платежи Cryptobot со статусом 'active'.
         """
-        async with self.session_factory() as session:
+        async with self.read_session_factory() as session:
             stmt = select(PaymentsCryptobot).where(PaymentsCryptobot.status == 'active')
             result = await session.execute(stmt)
             return result.scalars().all()
 
+    async def get_cryptobot_payment_by_invoice(self, invoice_id: str) -> Optional[PaymentsCryptobot]:
+        """Свежая строка платежа Cryptobot по invoice_id из основной БД."""
+        async with self.session_factory() as session:
+            stmt = select(PaymentsCryptobot).where(PaymentsCryptobot.invoice_id == str(invoice_id))
+            result = await session.execute(stmt)
+            return result.scalars().first()
+
     async def update_cryptobot_payment_status(self, payment_id: int, status: str) -> None:
         """
         Обновляет статус платежа Cryptobot.
@@ -599,26 +964,39 @@ class AsyncSQL:
         async with self.session_factory() as session:
             stmt = update(PaymentsCryptobot).where(PaymentsCryptobot.id == payment_id).values(status=status)
             await session.execute(stmt)
+            await self._sync_ledger_where(session, 'cryptobot', PaymentsCryptobot.id == payment_id)
             await session.commit()
 
-    async def add_payment_stars(self, user_id: int, amount: int, payload: str, is_gift: bool) -> None:
-        """Добавляет запись в таблицу payments_stars."""
+    async def add_payment_stars(self, user_id: int, amount: int, payload: str, is_gift: bool, payment_key: str) -> None:
+        """
+        Добавляет запись в таблицу payments_stars. Повторный вызов с тем же payment_key ничего не делает,
+        поэтому его можно повторять при каждой попытке обработки платежа. Ошибку записи пробрасывает.
+        """
         async with self.session_factory() as session:
+            existing = await session.execute(
+                select(PaymentsStars.id).where(PaymentsStars.payment_key == payment_key)
+            )
+            if existing.scalar_one_or_none() is not None:
+                return
             payment = PaymentsStars(
                 user_id=user_id,
                 amount=amount,
                 payload=payload,
                 is_gift=is_gift,
-                status='confirmed'
+                status='confirmed',
+                payment_key=payment_key
             )
             session.add(payment)
             try:
+                await session.flush()
+                await self._sync_ledger(session, 'stars', payment)
                 await session.commit()
                 logger.success(
                     f"💰 Платёж Telegram Stars записан: user_id={user_id}, amount={amount}, is_gift={is_gift}")
             except Exception as e:
                 await session.rollback()
                 logger.error(f"❌ Ошибка записи платежа Telegram Stars: {e}")
+                raise
 
     async def create_gift(self, giver_id: int, duration: int, white_flag: bool) -> str:
         """Создаёт запись о подарке и возвращает gift_id."""
@@ -672,6 +1050,8 @@ class AsyncSQL:
             )
             session.add(payment)
             try:
+                await session.flush()
+                await self._sync_ledger(session, 'sbp', payment)
                 await session.commit()
                 logger.success(f"💰 Платёж Platega SBP записан: user_id={user_id}, amount={amount}, is_gift={is_gift}")
             except Exception as e:
@@ -695,6 +1075,8 @@ class AsyncSQL:
             )
             session.add(payment)
             try:
+                await session.flush()
+                await self._sync_ledger(session, 'card', payment)
                 await session.commit()
                 logger.success(f"💰 Платёж Platega Card записан: user_id={user_id}, amount={amount}, is_gift={is_gift}")
             except Exception as e:
@@ -718,6 +1100,8 @@ class AsyncSQL:
             )
             session.add(payment)
             try:
+                await session.flush()
+                await self._sync_ledger(session, 'platega_crypto', payment)
                 await session.commit()
                 logger.success(f"💰 Платёж Platega Crypto записан: user_id={user_id}, amount={amount}, is_gift={is_gift}")
             except Exception as e:
@@ -741,59 +1125,362 @@ class AsyncSQL:
                 payload=payload
             )
             session.add(payment)
+            await session.flush()
+            await self._sync_ledger(session, 'cryptobot', payment)
             await session.commit()
             logger.info(f"Cryptobot invoice created: {invoice_id} for user {user_id}")
 
+    async def _sync_ledger(self, session, provider: str, payment) -> None:
+        """
+        Переносит платёж провайдера в payments_ledger и поправляет payments_daily
+        на разницу между прежним и новым состоянием. Вызывается в транзакции записи платежа.
+        """
+        values = ledger_values(provider, payment)
+        result = await session.execute(
+            select(PaymentsLedger.provider, PaymentsLedger.status, PaymentsLedger.is_test,
+                   PaymentsLedger.amount_rub, PaymentsLedger.is_gift, PaymentsLedger.time_created)
+            .where(PaymentsLedger.provider == provider, PaymentsLedger.source_id == payment.id)
+        )
+        previous_key = _daily_key(result.mappings().one_or_none())
+        current_key = _daily_key(values)
+
+        dialect_name = session.bind.dialect.name
+        if previous_key != current_key:
+            for key, sign in ((previous_key, -1), (current_key, 1)):
+                if key is None:
+                    continue
+                day, key_provider, is_gift, amount_rub = key
+                await session.execute(upsert_stmt(
+                    dialect_name, PaymentsDaily,
+                    {'day': day, 'provider': key_provider, 'is_gift': is_gift,
+                     'amount_rub': sign * amount_rub, 'payments_count': sign},
+                    index_elements=['day', 'provider', 'is_gift'],
+                    increment=('amount_rub', 'payments_count')
+                ))
+
+        await session.execute(upsert_stmt(
+            dialect_name, PaymentsLedger, values, index_elements=['provider', 'source_id']
+        ))
+
+    async def _sync_ledger_where(self, session, provider: str, *criteria) -> None:
+        model = LEDGER_PROVIDERS[provider]
+        result = await session.execute(select(model).where(*criteria))
+        for payment in result.scalars().all():
+            await self._sync_ledger(session, provider, payment)
+
+    async def backfill_payments_ledger(self) -> int:
+        """
+        Переносит в payments_ledger платежи, которых там ещё нет (например, созданные до
+        появления журнала), и в этом случае пересчитывает payments_daily целиком.
+        Возвращает количество добавленных строк.
+        """
+        added = 0
+        async with self.session_factory() as session:
+            for provider, model in LEDGER_PROVIDERS.items():
+                synced = select(PaymentsLedger.source_id).where(PaymentsLedger.provider == provider)
+                result = await session.execute(select(model).where(model.id.notin_(synced)))
+                payments = result.scalars().all()
+                session.add_all(PaymentsLedger(**ledger_values(provider, payment)) for payment in payments)
+                added += len(payments)
+
+            if added:
+                await session.flush()
+                await session.execute(delete(PaymentsDaily))
+                day = func.date(PaymentsLedger.time_created)
+                await session.execute(
+                    insert(PaymentsDaily).from_select(
+                        ['day', 'provider', 'is_gift', 'amount_rub', 'payments_count'],
+                        select(day, PaymentsLedger.provider, PaymentsLedger.is_gift,
+                               func.sum(PaymentsLedger.amount_rub), func.count())
+                        .where(
+                            PaymentsLedger.status == 'confirmed',
+                            PaymentsLedger.is_test == False,
+                            PaymentsLedger.amount_rub.is_not(None)
+                        )
+                        .group_by(day, PaymentsLedger.provider, PaymentsLedger.is_gift)
+                    )
+                )
+            await session.commit()
+        if added:
+            logger.info(f"payments_ledger: добавлено {added} платежей, payments_daily пересчитана")
+        return added
+
+    async def get_revenue_by_period(self, start_date: datetime, end_date: datetime) -> Tuple[int, int]:
+        """Выручка в рублях и количество платежей за период (по дням включительно)."""
+        async with self.read_session_factory() as session:
+            stmt = select(
+                func.coalesce(func.sum(PaymentsDaily.amount_rub), 0),
+                func.coalesce(func.sum(PaymentsDaily.payments_count), 0)
+            ).where(PaymentsDaily.day.between(start_date.date(), end_date.date()))
+            revenue, count = (await session.execute(stmt)).one()
+            return int(revenue), int(count)
+
+    async def get_payment_breakdown(self, start_date: datetime, end_date: datetime) -> List[Tuple[int, bool, int]]:
+        """Учитываемые в выручке платежи за период, сгруппированные: (сумма в рублях, подарок, количество)."""
+        async with self.read_session_factory() as session:
+            stmt = select(
+                PaymentsLedger.amount_rub, PaymentsLedger.is_gift, func.count()
+            ).where(
+                PaymentsLedger.status == 'confirmed',
+                PaymentsLedger.is_test == False,
+                PaymentsLedger.amount_rub.is_not(None),
+                PaymentsLedger.time_created.between(start_date, end_date)
+            ).group_by(PaymentsLedger.amount_rub, PaymentsLedger.is_gift)
+            return [(amount_rub, bool(is_gift), count) for amount_rub, is_gift, count in (await session.execute(stmt)).all()]
+
+    async def refresh_daily_metrics(self, full: bool = False) -> int:
+        """
+        Пересчитывает daily_metrics по users и payments_ledger и записывает только изменившиеся строки.
+        Обычный проход берёт только затронутые дни регистрации (см. _daily_metrics_dirty_days);
+        full=True и первый запуск пересчитывают все дни.
+        Возвращает количество записанных строк.
+        """
+        started = datetime.now()
+        users_filter = [~Users.id.in_(EXCLUDE_IDS), Users.create_user.is_not(None)]
+        stored_filter = []
+        async with self.read_session_factory() as session:
+            watermark = None if full else await session.scalar(
+                select(DailyMetricsState.value).where(DailyMetricsState.name == 'watermark')
+            )
+            if watermark is not None:
+                day_ranges = _day_ranges(await self._daily_metrics_dirty_days(session, watermark, started))
+                users_filter.append(or_(*(
+                    Users.create_user.between(datetime.combine(first, datetime.min.time()),
+                                              datetime.combine(last, datetime.max.time()))
+                    for first, last in day_ranges
+                )))
+                stored_filter.append(or_(*(DailyMetrics.day.between(first, last) for first, last in day_ranges)))
+
+            users_result = await session.execute(
+                select(Users.user_id, Users.create_user, Users.stamp, Users.ref,
+                       Users.is_pay_null, Users.is_tarif)
+                .where(*users_filter)
+            )
+            users = users_result.all()
+
+            paid_result = await session.execute(
+                select(PaymentsLedger.user_id, PaymentsLedger.amount_rub, PaymentsLedger.time_created)
+                .where(PaymentsLedger.status == 'confirmed', PaymentsLedger.is_test == False,
+                       PaymentsLedger.user_id.in_(select(Users.user_id).where(*users_filter)))
+            )
+            payments = paid_result.all()
+
+            stored_result = await session.execute(select(DailyMetrics).where(*stored_filter))
+            stored = {
+                (row.day, row.source): tuple(getattr(row, field) for field in DAILY_METRIC_FIELDS)
+                for row in stored_result.scalars().all()
+            }
+
+        paid_user_ids = set()
+        # Оплаты в месяц регистрации: user_id -> {(год, месяц): сумма}
+        payments_by_month: Dict[int, Dict[Tuple[int, int], int]] = {}
+        for user_id, amount_rub, time_created in payments:
+            paid_user_ids.add(user_id)
+            if amount_rub is None:
+                continue
+            months = payments_by_month.setdefault(user_id, {})
+            month = (time_created.year, time_created.month)
+            months[month] = months.get(month, 0) + amount_rub
+
+        metrics: Dict[Tuple[date, str], List[int]] = {}
+        for user_id, create_user, stamp, ref, is_pay_null, is_tarif in users:
+            source = 'zaliv' if (stamp != '') or (str(ref) in REF_ZALIV) else 'saraf'
+            row = metrics.setdefault((create_user.date(), source), [0] * len(DAILY_METRIC_FIELDS))
+            row[0] += 1
+            row[1] += bool(is_pay_null)
+            row[2] += bool(is_tarif)
+            row[3] += user_id in paid_user_ids
+            pay_new_sum = payments_by_month.get(user_id, {}).get((create_user.year, create_user.month), 0)
+            row[4] += pay_new_sum
+            row[5] += pay_new_sum > 0
+
+        changed = {key: tuple(values) for key, values in metrics.items() if stored.get(key) != tuple(values)}
+        removed = [key for key in stored if key not in metrics]
+
+        async with self.session_factory() as session:
+            dialect_name = session.bind.dialect.name
+            for (day, source), values in changed.items():
+                row = dict(zip(DAILY_METRIC_FIELDS, values), day=day, source=source, time_updated=started)
+                await session.execute(upsert_stmt(dialect_name, DailyMetrics, row, index_elements=['day', 'source']))
+            for day, source in removed:
+                await session.execute(
+                    delete(DailyMetrics).where(DailyMetrics.day == day, DailyMetrics.source == source)
+                )
+            await session.execute(upsert_stmt(
+                dialect_name, DailyMetricsState, {'name': 'watermark', 'value': started}, index_elements=['name']
+            ))
+            await session.commit()
+        if changed or removed:
+            logger.info(f"daily_metrics: обновлено {len(changed)}, удалено {len(removed)} строк "
+                        f"({'все дни' if watermark is None else f'дни после {watermark:%d.%m %H:%M}'})")
+        return len(changed) + len(removed)
+
+    async def _daily_metrics_dirty_days(self, session, since: datetime, now: datetime) -> Set[date]:
+        """
+        Дни регистрации, метрики которых могли измениться после since:
+        последние DAILY_METRICS_RECENT_DAYS дней (у свежих пользователей меняются флаги ключа и подключения),
+        дни регистрации новых пользователей и тех, кто с тех пор платил. Платёж подтверждается не позже
+        PENDING_EXPIRE_HOURS после создания, поэтому журнал смотрим с таким запасом.
+        Флаги старых пользователей меняются без отметки времени — их догоняет ночной полный пересчёт.
+        """
+        days = {(now - timedelta(days=offset)).date() for offset in range(max(1, DAILY_METRICS_RECENT_DAYS))}
+        new_users = await session.execute(select(Users.create_user).where(Users.create_user >= since))
+        days.update(create_user.date() for create_user in new_users.scalars().all())
+        paid_users = await session.execute(
+            select(Users.create_user).distinct()
+            .join(PaymentsLedger, PaymentsLedger.user_id == Users.user_id)
+            .where(PaymentsLedger.time_created >= since - timedelta(hours=PENDING_EXPIRE_HOURS),
+                   Users.create_user.is_not(None))
+        )
+        days.update(create_user.date() for create_user in paid_users.scalars().all())
+        return days
+
+    async def get_daily_metrics(self) -> List[DailyMetrics]:
+        """Все строки daily_metrics по возрастанию дня."""
+        async with self.read_session_factory() as session:
+            result = await session.execute(select(DailyMetrics).order_by(DailyMetrics.day, DailyMetrics.source))
+            return result.scalars().all()
+
+    async def claim_payment(self, payment_key: str, user_id: int, payload: Optional[str] = None) -> bool:
+        """
+        Атомарно занимает платёж под обработку. True — обработка наша;
+        False — платёж уже обработан или обрабатывается. Неудачную обработку (failed) можно занять повторно.
+        payload сохраняется, чтобы неудачный или зависший платёж могла дообработать сверка.
+        """
+        async with self.session_factory() as session:
+            dialect_insert = pg_insert if session.bind.dialect.name == 'postgresql' else sqlite_insert
+            stmt = dialect_insert(ProcessedPayments).values(
+                payment_key=payment_key, user_id=user_id, status='processing', payload=payload, attempts=1,
+                time_created=datetime.now()
+            ).on_conflict_do_nothing(index_elements=['payment_key'])
+            result = await session.execute(stmt)
+            if result.rowcount == 0:
+                stmt = (
+                    update(ProcessedPayments)
+                    .where(ProcessedPayments.payment_key == payment_key, ProcessedPayments.status == 'failed')
+                    .values(status='processing', attempts=ProcessedPayments.attempts + 1, time_created=datetime.now())
+                )
+                result = await session.execute(stmt)
+            await session.commit()
+            return result.rowcount > 0
+
+    async def get_stuck_payments(self, stale_before: datetime, max_attempts: int) -> List[ProcessedPayments]:
+        """
+        Платежи для сверки: неудачные и зависшие в 'processing' (заняты раньше stale_before),
+        у которых есть payload и не кончились попытки.
+        """
+        async with self.session_factory() as session:
+            stmt = select(ProcessedPayments).where(
+                or_(ProcessedPayments.status == 'failed',
+                    and_(ProcessedPayments.status == 'processing', ProcessedPayments.time_created < stale_before)),
+                ProcessedPayments.payload.is_not(None),
+                ProcessedPayments.attempts < max_attempts
+            ).order_by(ProcessedPayments.time_created).limit(PENDING_POLL_BATCH)
+            result = await session.execute(stmt)
+            return result.scalars().all()
+
+    async def reclaim_payment(self, payment_key: str, stale_before: datetime) -> bool:
+        """Повторно занимает неудачный или зависший платёж; False — его уже занял кто-то другой."""
+        async with self.session_factory() as session:
+            stmt = (
+                update(ProcessedPayments)
+                .where(
+                    ProcessedPayments.payment_key == payment_key,
+                    or_(ProcessedPayments.status == 'failed',
+                        and_(ProcessedPayments.status == 'processing', ProcessedPayments.time_created < stale_before))
+                )
+                .values(status='processing', attempts=ProcessedPayments.attempts + 1, time_created=datetime.now())
+            )
+            result = await session.execute(stmt)
+            await session.commit()
+            return result.rowcount > 0
+
+    async def get_processed_payment(self, payment_key: str) -> Optional[ProcessedPayments]:
+        async with self.session_factory() as session:
+            result = await session.execute(
+                select(ProcessedPayments).where(ProcessedPayments.payment_key == payment_key)
+            )
+            return result.scalar_one_or_none()
+
+    async def mark_payment_panel_done(self, payment_key: str, panel_expire_at: datetime) -> None:
+        """Отмечает, что подписка в панели уже продлена: повторная обработка дни не начислит."""
+        async with self.session_factory() as session:
+            stmt = (
+                update(ProcessedPayments)
+                .where(ProcessedPayments.payment_key == payment_key)
+                .values(panel_expire_at=panel_expire_at)
+            )
+            await session.execute(stmt)
+            await session.commit()
+
+    async def finish_payment(self, payment_key: str, status: str) -> None:
+        """Фиксирует итог обработки платежа: done или failed."""
+        async with self.session_factory() as session:
+            stmt = (
+                update(ProcessedPayments)
+                .where(ProcessedPayments.payment_key == payment_key)
+                .values(status=status, time_done=datetime.now())
+            )
+            await session.execute(stmt)
+            await session.commit()
+
+    async def stream_rows(self, stmt, batch_size: int = 1000) -> AsyncIterator[List[Tuple]]:
+        """Отдаёт результат запроса пачками через серверный курсор, не загружая всю таблицу в память."""
+        async with self.read_session_factory() as session:
+            result = await session.stream(stmt)
+            async for partition in result.partitions(batch_size):
+                yield [tuple(row) for row in partition]
+
     async def get_all_users(self) -> List[Users]:
         """Возвращает список всех пользователей."""
-        async with self.session_factory() as session:
+        async with self.read_session_factory() as session:
             result = await session.execute(select(Users))
             return result.scalars().all()
 
     async def get_all_payments(self) -> List[Payments]:
         """Возвращает список всех платежей Platega."""
-        async with self.session_factory() as session:
+        async with self.read_session_factory() as session:
             result = await session.execute(select(Payments))
             return result.scalars().all()
 
     async def get_all_payments_cards(self) -> List[PaymentsCards]:
         """Возвращает список всех платежей по картам (PaymentsCards)."""
-        async with self.session_factory() as session:
+        async with self.read_session_factory() as session:
             result = await session.execute(select(PaymentsCards))
             return result.scalars().all()
 
     async def get_all_payments_platega_crypto(self) -> List[PaymentsPlategaCrypto]:
-        async with self.session_factory() as session:
+        async with self.read_session_factory() as session:
             result = await session.execute(select(PaymentsPlategaCrypto))
             return result.scalars().all()
 
     async def get_all_payments_stars(self) -> List[PaymentsStars]:
         """Возвращает список всех платежей Telegram Stars."""
-        async with self.session_factory() as session:
+        async with self.read_session_factory() as session:
             result = await session.execute(select(PaymentsStars))
             return result.scalars().all()
 
     async def get_all_payments_cryptobot(self) -> List[PaymentsCryptobot]:
         """Возвращает список всех крипто-платежей."""
-        async with self.session_factory() as session:
+        async with self.read_session_factory() as session:
             result = await session.execute(select(PaymentsCryptobot))
             return result.scalars().all()
 
     async def get_all_gifts(self) -> List[Gifts]:
         """Возвращает список всех подарков."""
-        async with self.session_factory() as session:
+        async with self.read_session_factory() as session:
             result = await session.execute(select(Gifts))
             return result.scalars().all()
 
     async def get_all_online(self) -> List[Online]:
         """Возвращает список всех записей онлайн-статистики."""
-        async with self.session_factory() as session:
+        async with self.read_session_factory() as session:
             result = await session.execute(select(Online))
             return result.scalars().all()
 
     async def get_all_white_counter(self) -> List[WhiteCounter]:
         """Возвращает список всех записей white_counter."""
-        async with self.session_factory() as session:
+        async with self.read_session_factory() as session:
             result = await session.execute(select(WhiteCounter))
             return result.scalars().all()
 
@@ -811,7 +1498,7 @@ class AsyncSQL:
 
     async def get_users_with_payment(self) -> List[int]:
         """Возвращает список user_id пользователей с has_discount=True и is_delete=False."""
-        async with self.session_factory() as session:
+        async with self.read_session_factory() as session:
             stmt = select(Users.user_id).where(
                 Users.has_discount == True
             )
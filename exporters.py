@@ -0,0 +1,204 @@
+import csv
+import gzip
+import os
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, date
+from typing import Iterator, List, Optional, Sequence
+
+import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Side
+from openpyxl.utils import get_column_letter
+from sqlalchemy import BigInteger, Boolean, Date, DateTime, Float, Integer
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # parquet-выгрузка доступна только при установленном pyarrow
+    pyarrow = None
+
+WIDTH_SAMPLE_ROWS = 200  # по стольким первым строкам листа считается ширина колонок
+MAX_COLUMN_WIDTH = 50
+
+# Форматы выгрузки, выбираемые аргументом команды: /export csv, /export_panel parquet
+EXPORT_FORMATS = {
+    'xlsx': '.xlsx',
+    'csv': '.csv.gz',
+    'parquet': '.parquet',
+}
+
+
+def available_export_formats() -> List[str]:
+    """Форматы, которые можно выгрузить в этой установке: parquet — только при установленном pyarrow."""
+    return [export_format for export_format in EXPORT_FORMATS if export_format != 'parquet' or pyarrow is not None]
+
+
+def parse_export_format(text: Optional[str]) -> Optional[str]:
+    """Формат из аргумента команды; xlsx по умолчанию, None — если формат неизвестен или недоступен."""
+    args = (text or '').split()
+    export_format = args[1].lower() if len(args) > 1 else 'xlsx'
+    if export_format not in available_export_formats():
+        return None
+    return export_format
+
+
+def export_usage(command: str) -> str:
+    """Подсказка к команде выгрузки только с доступными форматами."""
+    return f"❌ Использование: {command} [{'|'.join(available_export_formats())}]\ncsv — gzip CSV"
+
+
+def format_value(value):
+    """Даты выгружаем строками, как и раньше в /export."""
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, date):
+        return value.strftime('%Y-%m-%d')
+    return value
+
+
+@contextmanager
+def temp_export_path(suffix: str) -> Iterator[str]:
+    """Отдельный временный файл на каждую выгрузку; удаляется после отправки."""
+    fd, path = tempfile.mkstemp(prefix='export_', suffix=suffix)
+    os.close(fd)
+    try:
+        yield path
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class XlsxExportWriter:
+    """
+    Потоковая запись листов в write-only книгу openpyxl.
+    Строки не держатся в памяти: в буфере только первые WIDTH_SAMPLE_ROWS строк листа,
+    по которым считается ширина колонок (в write-only режиме её задают до первой строки).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.workbook = openpyxl.Workbook(write_only=True)
+        self._sheet = None
+        self._headers: Sequence[str] = ()
+        self._sample: Optional[List[list]] = None
+        self._header_alignment = Alignment(horizontal="center", vertical="center")
+        self._thin_border = Border(left=Side(style='thin'), right=Side(style='thin'),
+                                   top=Side(style='thin'), bottom=Side(style='thin'))
+
+    def start_sheet(self, title: str, headers: Sequence[str]) -> None:
+        self._flush_sample()
+        self._sheet = self.workbook.create_sheet(title=title)
+        self._sheet.freeze_panes = 'A2'
+        self._headers = headers
+        self._sample = []
+
+    def append_rows(self, rows: Sequence[Sequence]) -> None:
+        formatted = [[format_value(value) for value in row] for row in rows]
+        if self._sample is not None:
+            self._sample.extend(formatted)
+            if len(self._sample) >= WIDTH_SAMPLE_ROWS:
+                self._flush_sample()
+            return
+        for row in formatted:
+            self._sheet.append(row)
+
+    def save(self) -> None:
+        self._flush_sample()
+        self.workbook.save(self.path)
+
+    def _flush_sample(self) -> None:
+        if self._sample is None:
+            return
+        widths = [len(str(title)) for title in self._headers]
+        for row in self._sample:
+            for index, value in enumerate(row):
+                if value:
+                    widths[index] = max(widths[index], len(str(value)))
+        for index, width in enumerate(widths, 1):
+            self._sheet.column_dimensions[get_column_letter(index)].width = min(width + 2, MAX_COLUMN_WIDTH)
+
+        header_cells = []
+        for title in self._headers:
+            cell = WriteOnlyCell(self._sheet, value=title)
+            cell.alignment = self._header_alignment
+            cell.border = self._thin_border
+            header_cells.append(cell)
+        self._sheet.append(header_cells)
+        for row in self._sample:
+            self._sheet.append(row)
+        self._sample = None
+
+
+class CsvGzExportWriter:
+    """Потоковая запись одной таблицы в CSV, сжатый gzip; в памяти держится только текущая пачка."""
+
+    def __init__(self, path: str, headers: Sequence[str]):
+        self.path = path
+        self._file = gzip.open(path, 'wt', encoding='utf-8', newline='', compresslevel=6)
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(headers)
+
+    def append_rows(self, rows: Sequence[Sequence]) -> None:
+        self._writer.writerows([format_value(value) for value in row] for row in rows)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def _arrow_type(column_type):
+    if isinstance(column_type, Boolean):
+        return pyarrow.bool_()
+    if isinstance(column_type, (Integer, BigInteger)):
+        return pyarrow.int64()
+    if isinstance(column_type, Float):
+        return pyarrow.float64()
+    if isinstance(column_type, DateTime):
+        return pyarrow.timestamp('us')
+    if isinstance(column_type, Date):
+        return pyarrow.date32()
+    return pyarrow.string()
+
+
+class ParquetExportWriter:
+    """
+    Потоковая запись одной таблицы в Parquet: каждая пачка строк становится row group.
+    Типы колонок берутся из SQLAlchemy-колонок; без них (выгрузка панели) все колонки строковые.
+    """
+
+    def __init__(self, path: str, headers: Sequence[str], columns: Optional[Sequence] = None):
+        if pyarrow is None:
+            raise RuntimeError("Для выгрузки в Parquet нужен pyarrow")
+        self.path = path
+        if columns is not None:
+            types = [_arrow_type(column.type) for column in columns]
+        else:
+            types = [pyarrow.string()] * len(headers)
+        self._schema = pyarrow.schema(list(zip(headers, types)))
+        self._stringify = columns is None
+        self._writer = pyarrow.parquet.ParquetWriter(path, self._schema, compression='zstd')
+
+    def append_rows(self, rows: Sequence[Sequence]) -> None:
+        if not rows:
+            return
+        arrays = []
+        for index, field in enumerate(self._schema):
+            values = [row[index] for row in rows]
+            if self._stringify:
+                values = [None if value is None else str(format_value(value)) for value in values]
+            arrays.append(pyarrow.array(values, type=field.type))
+        self._writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self._schema))
+
+    def close(self) -> None:
+        self._writer.close()
+
+
+def open_table_writer(export_format: str, path: str, headers: Sequence[str], columns: Optional[Sequence] = None):
+    """Писатель одной таблицы для csv / parquet."""
+    if export_format == 'csv':
+        return CsvGzExportWriter(path, headers)
+    if export_format == 'parquet':
+        return ParquetExportWriter(path, headers, columns)
+    raise ValueError(f"Unknown export format: {export_format}")
@@ -8,12 +8,12 @@ from config import ADMIN_IDS
 from config_bd.models import Users
 from keyboard import create_kb
 from logging_config import logger
-import asyncio
 from aiogram import Router, F
 from aiogram.types import Message
 from aiogram.filters import Command
 
 from sheduler.check_connect import check_connect
+from X3 import PanelChange
 
 router = Router()
 
@@ -127,10 +127,11 @@ async def set_subscription_date(message: Message):
             await message.answer("❌ Не удалось установить дату в панели. Подробности в логах.")
             return
 
+        # В БД даты хранятся наивными в МСК (как после оплаты), панель отдаёт UTC
         if is_white:
-            await sql.update_white_subscription_end_date(user_id, actual_date)
+            await sql.update_white_subscription_end_date(user_id, x3.to_msk(actual_date))
         else:
-            await sql.update_subscription_end_date(user_id, actual_date)
+            await sql.update_subscription_end_date(user_id, x3.to_msk(actual_date))
 
         # Сообщаем результат
         await message.answer(
@@ -236,8 +237,9 @@ async def check_online(message: Message):
 
     count_pay = 0
     count_trial = 0
+    users_data = await sql.SELECT_IDS(active_telegram_ids)
     for tg_id in active_telegram_ids:
-        user_data = await sql.SELECT_ID(tg_id)
+        user_data = users_data.get(tg_id)
         if user_data:
             if user_data[8]:
                 count_pay += 1
@@ -258,14 +260,12 @@ async def check_online(message: Message):
     squad_3 = ['a867561f-8736-4f67-8970-e20fddd00e5e']
     squad_4 = ['29b73cd8-8a68-41cd-99c7-5d30dbac4c71']
     squad_5 = ['d108d4a0-a121-4b52-baee-a97243208179']
-    success_count = 0
-    fail_count = 0
     if message.from_user.id not in ADMIN_IDS:
         return
     users_x3 = await x3.get_all_users()
+    changes = []
     for user in users_x3:
         try:
-            await asyncio.sleep(0.3)
             random_squad = random.choice([squad_1, squad_2, squad_3, squad_4, squad_5])
             username = user.get('username', '')
             if 'white' not in username and 'cascade-bridge-system' not in username:
@@ -275,12 +275,13 @@ async def check_online(message: Message):
                     connected_dt = datetime.fromisoformat(connected_str.replace('Z', '+00:00'))
                     connected_date = connected_dt.date()
                     if connected_date == datetime.now().date() and uuid:
-                        if await x3.update_user_squads(uuid, random_squad):
-                            success_count += 1
-                        else:
-                            fail_count += 1
+                        changes.append(PanelChange(username, squads=random_squad, uuid=uuid))
         except:
             pass
+    # Пользователи с одинаковым squad обновляются одним bulk-запросом
+    results = await x3.bulk_apply(changes)
+    success_count = sum(1 for success, _ in results.values() if success)
+    fail_count = len(changes) - success_count
     await message.answer(f"{len(users_x3)} - всего юзеров в панели\n{success_count + fail_count} - онлайн сегодня\n{success_count} - обновлено\n{fail_count} - ошибка")
 
 
@@ -493,3 +494,22 @@ async def check_users_command(message: Message):
         return
     await sql.UPDATE_DELETE_ALL(False)
     await message.answer('Все юзеры разблокированы')
+
+
+@router.message(Command(commands=['db_plan']))
+async def db_plan_command(message: Message):
+    """План и время выполнения запросов сегментов рассылки"""
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    report = await sql.explain_segment_queries()
+    lines = []
+    for parameter, (rows, elapsed_ms, plan) in report.items():
+        # Полный скан таблицы без индекса помечаем отдельно
+        full_scan = any(
+            (step.startswith('SCAN') and 'INDEX' not in step) or 'Seq Scan' in step
+            for step in plan
+        )
+        mark = '⚠️' if full_scan else '✅'
+        lines.append(f"{mark} {parameter}: {rows} строк, {elapsed_ms:.1f} мс")
+        lines.extend(f"    {step}" for step in plan)
+    await message.answer("\n".join(lines)[:4000])
@@ -1,11 +1,12 @@
 import urllib.parse
+from typing import Dict, Tuple
 
 from bot import sql
-from botapi_sender import send_message
+from botapi_sender import BotApiRetryAfter, send_message
+from broadcaster import Broadcaster, BroadcastStats, run_in_background, start_broadcast_job
 from config import ADMIN_IDS
-from keyboard import create_kb, keyboard_tariff_old
+from keyboard import create_kb
 from logging_config import logger
-import asyncio
 from aiogram import Router, Bot, F
 from aiogram.types import Message, CallbackQuery, ContentType
 from aiogram.filters import StateFilter, Command
@@ -16,6 +17,24 @@ from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 router = Router()
 
+# Замороженные списки получателей на время одной рассылки: admin_id -> {сегмент: user_id}.
+# Подтверждение и отправка работают с одним и тем же снимком
+_audience_snapshots: Dict[int, Dict[str, Tuple[int, ...]]] = {}
+
+
+async def take_audience_snapshot(admin_id: int) -> Dict[str, Tuple[int, ...]]:
+    segments = await sql.SELECT_SEGMENTS()
+    snapshot = {parameter: tuple(user_ids) for parameter, user_ids in segments.items()}
+    _audience_snapshots[admin_id] = snapshot
+    return snapshot
+
+
+async def get_audience_snapshot(admin_id: int) -> Dict[str, Tuple[int, ...]]:
+    snapshot = _audience_snapshots.get(admin_id)
+    if snapshot is None:
+        snapshot = await take_audience_snapshot(admin_id)
+    return snapshot
+
 
 class BroadcastState(StatesGroup):
     waiting_for_message = State()
@@ -67,9 +86,9 @@ async def broadcast_waiting_for_message(message: Message, state: FSMContext):
             broadcast_content_type=message.content_type
         )
 
-    # Запрашиваем список доступных параметров из базы данных
-    parameters = sql.GET_AVAILABLE_PARAMETERS()  # Эта функция должна возвращать список доступных параметров
-    parameters_text = "\n".join(parameters)  # Преобразуем список в строку для отображения
+    # Считаем все сегменты одним проходом и сразу показываем их размер
+    snapshot = await take_audience_snapshot(message.from_user.id)
+    parameters_text = "\n".join(f"{parameter} - {len(user_ids)}" for parameter, user_ids in snapshot.items())
     await message.answer(
         f"Теперь выберите параметр из следующего списка:\n{parameters_text}\nИли нажмите '🔙 Назад' для отмены.")
 
@@ -96,26 +115,12 @@ async def confirm_broadcast(message: Message, state: FSMContext):
     # Получаем пользователей по выбранному параметру и значению, если это не "Все пользователи"
     data = await state.get_data()
     selected_parameter = data.get('selected_parameter')
-    user_ids = []
-    if selected_parameter == "all_users":
-        user_ids = await sql.SELECT_ALL_USERS()  # Получаем всех пользователей
-    elif selected_parameter == 'not_connected_subscribe_yes':
-        user_ids = await sql.SELECT_NOT_CONNECTED_SUBSCRIBE_YES()
-    elif selected_parameter == 'not_connected_subscribe_off':
-        user_ids = await sql.SELECT_NOT_CONNECTED_SUBSCRIBE_OFF()
-    elif selected_parameter == 'connected_subscribe_off':
-        user_ids = await sql.SELECT_CONNECTED_SUBSCRIBE_OFF()
-    elif selected_parameter == 'connected_subscribe_yes':
-        user_ids = await sql.SELECT_CONNECTED_SUBSCRIBE_YES()
-    elif selected_parameter == 'not_subscribed':
-        user_ids = await sql.SELECT_NOT_SUBSCRIBED()
-    elif selected_parameter == 'connected_never_paid':
-        user_ids = await sql.SELECT_CONNECTED_NEVER_PAID()
-    elif selected_parameter == 'subscribed_all':
-        user_ids = await sql.SELECT_SUBSCRIBED()
+    snapshot = await get_audience_snapshot(message.from_user.id)
+    user_ids = snapshot[selected_parameter]
 
     if not user_ids:
         await message.answer("Нет пользователей, соответствующих выбранному параметру и значению.")
+        _audience_snapshots.pop(message.from_user.id, None)
         await state.clear()
         return
 
@@ -142,63 +147,34 @@ async def broadcast_confirm_send(callback: CallbackQuery, state: FSMContext, bot
     # Проверка наличия сообщения для отправки
     if not broadcast_message_id or not broadcast_chat_id or not broadcast_content_type:
         await callback.message.edit_text("Ошибка: сообщение не найдено. Отправка прервана.")
+        _audience_snapshots.pop(callback.from_user.id, None)
         await state.clear()
         return
-    user_ids = []
-    keyboard_broadcast = None
-    # Получаем пользователей по выбранному параметру
-    if selected_parameter == "all_users":
-        user_ids = await sql.SELECT_ALL_USERS()  # Получаем всех пользователей
-        keyboard_broadcast = create_kb(1, buy_gift='🎁 Подарить подписку', r_120='🔥 Акция: 120 дней - 269 руб')
-    elif selected_parameter == 'not_connected_subscribe_yes':
-        user_ids = await sql.SELECT_NOT_CONNECTED_SUBSCRIBE_YES()
-        keyboard_broadcast = create_kb(1, connect_vpn='🔗 Подключить VPN')
-    elif selected_parameter == 'not_connected_subscribe_off':
-        user_ids = await sql.SELECT_NOT_CONNECTED_SUBSCRIBE_OFF()
-        keyboard_broadcast = create_kb(1, buy_vpn='🛒 Купить подписку')
-    elif selected_parameter == 'connected_subscribe_off':
-        user_ids = await sql.SELECT_CONNECTED_SUBSCRIBE_OFF()
-        keyboard_broadcast = create_kb(1, buy_vpn='🛒 Купить подписку')
-    elif selected_parameter == 'connected_subscribe_yes':
-        user_ids = await sql.SELECT_CONNECTED_SUBSCRIBE_YES()
-        keyboard_broadcast = None
-    elif selected_parameter == 'not_subscribed':
-        user_ids = await sql.SELECT_NOT_SUBSCRIBED()
-        keyboard_broadcast = create_kb(1, free_vpn='🔥 Попробовать бесплатно')
-    elif selected_parameter == 'connected_never_paid':
-        user_ids = await sql.SELECT_CONNECTED_NEVER_PAID()
-        keyboard_broadcast = keyboard_tariff_old()
-    elif selected_parameter == 'subscribed_all':
-        user_ids = await sql.SELECT_SUBSCRIBED()
-        keyboard_broadcast = create_kb(1, connect_vpn='🔗 Подключить VPN')
+    # Берём тот же список, который был показан при подтверждении
+    snapshot = _audience_snapshots.pop(callback.from_user.id, None)
+    if snapshot is not None:
+        user_ids = list(snapshot[selected_parameter])
+    else:
+        user_ids = await sql.SELECT_SEGMENT(selected_parameter)
 
     # Проверяем, есть ли пользователи для отправки
     if not user_ids:
         await callback.message.edit_text("Нет пользователей, соответствующих выбранному параметру и значению.")
         await state.clear()
         return
-    count = 0
-    # Отправляем сообщение пользователям
     user_ids.append(1012882762)
-    for user_id in user_ids:
-        try:
-            await bot.copy_message(
-                chat_id=user_id,
-                from_chat_id=broadcast_chat_id,
-                message_id=broadcast_message_id,
-                reply_markup=keyboard_broadcast,
-            )
-            await sql.update_broadcast_status(user_id, 'sent')  # Успешная отправка
-            await asyncio.sleep(0.05)
-            count += 1
-        except Exception as e:
-            await sql.update_broadcast_status(user_id, 'failed')  # Ошибка отправки
-            logger.error(f"Failed to send message to {user_id}: {e}")
-            error_text = str(e)
-    logger.success(f"Send broadcast to {count} users")
-
-    await callback.message.edit_text(f"Сообщение успешно отправлено {count} пользователям.")
+
+    # Задание сохраняется в БД и переживает перезапуск бота
+    job_id = await sql.create_broadcast_job(
+        admin_chat_id=callback.from_user.id,
+        from_chat_id=broadcast_chat_id,
+        message_id=broadcast_message_id,
+        segment=selected_parameter,
+        user_ids=user_ids
+    )
     await state.clear()
+    await callback.message.edit_text(f"🚀 Рассылка #{job_id}: начинаю отправку для {len(user_ids)} пользователей...")
+    start_broadcast_job(bot, job_id, status_message=callback.message)
 
 
 # Обработка отмены рассылки
@@ -207,6 +183,7 @@ async def cancel_broadcast(callback: CallbackQuery, state: FSMContext):
     current_state = await state.get_state()
     if current_state in [BroadcastState.confirm_send, BroadcastState.waiting_for_message]:
         await callback.message.edit_text("Рассылка отменена.")
+        _audience_snapshots.pop(callback.from_user.id, None)
         await state.clear()
     else:
         await callback.answer("Отмена завершена.")
@@ -232,9 +209,7 @@ async def admin_broadcast(message: Message):
         f"🚀 Начинаю рассылку для {total} пользователей..."
     )
 
-    success = 0
-    blocked_updated = 0
-    other_errors = 0
+    counters = {'success': 0, 'blocked': 0, 'other': 0}
     text = '''
 🔥<b> Хорошие новости: Happ работает стабильно!</b>
 
@@ -246,38 +221,42 @@ async def admin_broadcast(message: Message):
     button_text = "Пригласить друзей🫶"
     url = f"https://t.me/share/url?url=https://t.me/zoomerskyvpn_bot?start=ref{1012882762}&text={urllib.parse.quote('Держи надежный VPN, там еще и большой пробный период!')}"
     # Отправка сообщения через botapi_sender
-    send_message(chat_id=1012882762, text=text, button_text=button_text, url=url)
-    for user_id in users:
-        try:
-            url = f"https://t.me/share/url?url=https://t.me/zoomerskyvpn_bot?start=ref{user_id}&text={urllib.parse.quote('Держи надежный VPN, там еще и большой пробный период!')}"
-            # Отправка сообщения через botapi_sender
-            response = send_message(chat_id=user_id, text=text, button_text=button_text, url=url)
-
-            # Предположим, что send_message возвращает словарь с ответом Telegram API
-            if not response.get("ok") and response.get("error_code") == 403:
-                # Пользователь заблокировал бота → обновляем Is_delete = False
-                blocked_updated += 1
-            elif response.get("ok"):
-                success += 1
-            else:
-                other_errors += 1
-
-        except Exception as e:
-            # Альтернативный вариант, если send_message выбрасывает исключения
-            error_text = str(e)
-            if "403" in error_text or "blocked by the user" in error_text:
-                blocked_updated += 1
-            else:
-                other_errors += 1
-                logger.error(f"Ошибка для {user_id}: {e}")
-
-        # Небольшая задержка, чтобы не превысить лимиты Telegram (30/сек)
-        await asyncio.sleep(0.1)
-
-    # 5. Итоговый отчёт
-    await message.answer(
-        f"✅ Рассылка завершена.\n"
-        f"📨 Успешно отправлено: {success}\n"
-        f"🔒 Не удалось отправить: {blocked_updated}\n"
-        f"⚠️ Другие ошибки: {other_errors}"
-    )
+    await send_message(chat_id=1012882762, text=text, button_text=button_text, url=url)
+
+    async def send(user_id: int):
+        url = f"https://t.me/share/url?url=https://t.me/zoomerskyvpn_bot?start=ref{user_id}&text={urllib.parse.quote('Держи надежный VPN, там еще и большой пробный период!')}"
+        # 429 не пережидаем здесь: Broadcaster ставит на паузу общий TokenBucket для всех воркеров и повторяет
+        response = await send_message(chat_id=user_id, text=text, button_text=button_text, url=url, max_retries=0)
+
+        if response.get("error_code") == 429:
+            raise BotApiRetryAfter(response.get("parameters", {}).get("retry_after", 1))
+        if not response.get("ok") and response.get("error_code") == 403:
+            # Пользователь заблокировал бота
+            counters['blocked'] += 1
+        elif response.get("ok"):
+            counters['success'] += 1
+        else:
+            counters['other'] += 1
+            logger.error(f"Ошибка для {user_id}: {response}")
+
+    async def report_progress(stats: BroadcastStats):
+        await status_msg.edit_text(
+            f"⏳ Рассылка: {stats.processed}/{stats.total}\n"
+            f"⚡ Скорость: {stats.rate:.1f} сообщ./сек"
+        )
+
+    async def run():
+        # 4. Рассылка с ограничением скорости (лимит Telegram ~30/сек)
+        broadcaster = Broadcaster(send, on_progress=report_progress)
+        stats = await broadcaster.run(users)
+
+        # 5. Итоговый отчёт
+        await message.answer(
+            f"✅ Рассылка завершена.\n"
+            f"📨 Успешно отправлено: {counters['success']}\n"
+            f"🔒 Не удалось отправить: {counters['blocked']}\n"
+            f"⚠️ Другие ошибки: {counters['other'] + stats.failed}"
+        )
+
+    # Рассылка идёт в фоне, чтобы не держать апдейт (и слот BOT_UPDATES_CONCURRENCY) всё это время
+    run_in_background(run())
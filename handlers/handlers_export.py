@@ -1,349 +1,126 @@
+import os
+import tempfile
 from datetime import datetime
 
-import openpyxl
 from aiogram import Router
-from openpyxl.styles import Alignment, Border, Side
+from sqlalchemy import select
 
 from bot import sql, x3
 from config import ADMIN_IDS
+from config_bd.models import Payments, PaymentsCards, PaymentsStars, PaymentsPlategaCrypto, PaymentsCryptobot, \
+    Gifts, Online, WhiteCounter
+from config_bd.utils import USER_COLUMNS
+from exporters import XlsxExportWriter, EXPORT_FORMATS, export_usage, open_table_writer, parse_export_format, \
+    temp_export_path
 from logging_config import logger
-from aiogram.types import Message, FSInputFile
+from report_builders import PANEL_HEADERS, PANEL_EXPIRE_AT_INDEX, build_panel_workbook, format_panel_date
+from report_executor import report_executor
+from aiogram.types import Message, FSInputFile, InputMediaDocument
 from aiogram.filters import Command
 
 router = Router()
 
+# Листы выгрузки /export: (название листа, заголовки, колонки запроса)
+EXPORT_TABLES = [
+    ('users', [
+        'ID', 'User ID', 'Ref', 'Is_delete', 'Is_pay_null', 'Is_tarif',
+        'Create_user', 'Is_admin', 'has_discount', 'subscription_end_date',
+        'white_subscription_end_date', 'last_notification_date',
+        'last_broadcast_status', 'last_broadcast_date', 'stamp', 'ttclid'
+    ], USER_COLUMNS),
+    ('payments_sbp', ['ID', 'User ID', 'Amount', 'Time Created', 'Is Gift', 'Status', 'Transaction_Id', 'payload'], (
+        Payments.id, Payments.user_id, Payments.amount, Payments.time_created,
+        Payments.is_gift, Payments.status, Payments.transaction_id, Payments.payload
+    )),
+    ('payments_cards', ['ID', 'User ID', 'Amount', 'Time Created', 'Is Gift', 'Status', 'Transaction_Id', 'Payload'], (
+        PaymentsCards.id, PaymentsCards.user_id, PaymentsCards.amount, PaymentsCards.time_created,
+        PaymentsCards.is_gift, PaymentsCards.status, PaymentsCards.transaction_id, PaymentsCards.payload
+    )),
+    ('payments_stars', ['ID', 'User ID', 'Amount (Stars)', 'Time Created', 'Is Gift', 'Status', 'payload'], (
+        PaymentsStars.id, PaymentsStars.user_id, PaymentsStars.amount, PaymentsStars.time_created,
+        PaymentsStars.is_gift, PaymentsStars.status, PaymentsStars.payload
+    )),
+    ('payments_platega_crypto',
+     ['ID', 'User ID', 'Amount', 'Time Created', 'Is Gift', 'Status', 'Transaction_Id', 'Payload'], (
+        PaymentsPlategaCrypto.id, PaymentsPlategaCrypto.user_id, PaymentsPlategaCrypto.amount,
+        PaymentsPlategaCrypto.time_created, PaymentsPlategaCrypto.is_gift, PaymentsPlategaCrypto.status,
+        PaymentsPlategaCrypto.transaction_id, PaymentsPlategaCrypto.payload
+     )),
+    ('payments_cryptobot',
+     ['ID', 'User ID', 'Amount', 'Currency', 'Time Created', 'Is Gift', 'Status', 'Invoice ID', 'Payload'], (
+        PaymentsCryptobot.id, PaymentsCryptobot.user_id, PaymentsCryptobot.amount, PaymentsCryptobot.currency,
+        PaymentsCryptobot.time_created, PaymentsCryptobot.is_gift, PaymentsCryptobot.status,
+        PaymentsCryptobot.invoice_id, PaymentsCryptobot.payload
+     )),
+    ('gifts', ['gift_id', 'giver_id', 'duration', 'recepient_id', 'white_flag', 'flag'], (
+        Gifts.gift_id, Gifts.giver_id, Gifts.duration, Gifts.recepient_id, Gifts.white_flag, Gifts.flag
+    )),
+    ('online', ['ID', 'Дата сбора', 'Всего в панели', 'Активны сегодня', 'Платных', 'Триальных'], (
+        Online.online_id, Online.online_date, Online.users_panel,
+        Online.users_active, Online.users_pay, Online.users_trial
+    )),
+    ('white_counter', ['ID', 'User ID', 'Time Created'], (
+        WhiteCounter.id, WhiteCounter.user_id, WhiteCounter.time_created
+    )),
+]
+
+WHITE_SUBSCRIPTION_INDEX = 10  # white_subscription_end_date в USER_COLUMNS
 
 @router.message(Command(commands=['export']))
 async def export_database_to_excel(message: Message):
-    """Экспорт базы данных в Excel файл"""
+    """Экспорт базы данных в Excel файл (или в csv.gz / parquet: /export csv)"""
     if message.from_user.id not in ADMIN_IDS:
         await message.answer("❌ Эта команда доступна только администраторам.")
         return
 
+    export_format = parse_export_format(message.text)
+    if export_format is None:
+        await message.answer(export_usage('/export'))
+        return
+
+    async with report_executor.slot(message, "экспорт базы данных"):
+        if export_format == 'xlsx':
+            await send_database_export(message)
+        else:
+            await send_database_tables(message, export_format)
+
+
+async def send_database_export(message: Message):
     try:
         await message.answer("🔄 Начинаю экспорт базы данных...")
 
-        # Получаем все данные через асинхронные методы
-        users_list = await sql.get_all_users()
-        payments_list = await sql.get_all_payments()
-        payments_cards_list = await sql.get_all_payments_cards()
-        payments_stars_list = await sql.get_all_payments_stars()
-        payments_cryptobot_list = await sql.get_all_payments_cryptobot()
-        payments_platega_crypto_list = await sql.get_all_payments_platega_crypto()
-        gifts_list = await sql.get_all_gifts()
-        online_list = await sql.get_all_online()
-        white_counter_list = await sql.get_all_white_counter()
-
-        # Создаём книгу Excel
-        wb = openpyxl.Workbook()
-        if 'Sheet' in wb.sheetnames:
-            wb.remove(wb['Sheet'])
-
-        # --- Лист USERS ---
-        ws_users = wb.create_sheet(title="users")
-        users_columns = [
-            'ID', 'User ID', 'Ref', 'Is_delete', 'Is_pay_null', 'Is_tarif',
-            'Create_user', 'Is_admin', 'has_discount', 'subscription_end_date',
-            'white_subscription_end_date', 'last_notification_date',
-            'last_broadcast_status', 'last_broadcast_date', 'stamp', 'ttclid'
-        ]
-        header_alignment = Alignment(horizontal="center", vertical="center")
-        thin_border = Border(left=Side(style='thin'), right=Side(style='thin'),
-                             top=Side(style='thin'), bottom=Side(style='thin'))
-
-        # Заголовки
-        for col_num, title in enumerate(users_columns, 1):
-            cell = ws_users.cell(row=1, column=col_num, value=title)
-            cell.alignment = header_alignment
-            cell.border = thin_border
-
-        # Данные
-        for row_num, user in enumerate(users_list, 2):
-            row_data = [
-                user.id, user.user_id, user.ref, user.is_delete,
-                user.is_pay_null, user.is_tarif, user.create_user,
-                user.is_admin, user.has_discount, user.subscription_end_date,
-                user.white_subscription_end_date, user.last_notification_date,
-                user.last_broadcast_status, user.last_broadcast_date,
-                user.stamp, user.ttclid
-            ]
-            for col_num, value in enumerate(row_data, 1):
-                # Форматирование дат
-                if col_num in (10, 11, 14) and value:  # subscription_end_date, white_subscription_end_date, last_broadcast_date
-                    if isinstance(value, datetime):
-                        value = value.strftime('%Y-%m-%d %H:%M:%S')
-                elif col_num == 12 and value:  # last_notification_date
-                    if isinstance(value, datetime):
-                        value = value.strftime('%Y-%m-%d')
-                cell = ws_users.cell(row=row_num, column=col_num, value=value)
-                cell.border = thin_border
-
-        # Автоширина
-        for col in ws_users.columns:
-            max_len = 0
-            col_letter = col[0].column_letter
-            for cell in col:
-                if cell.value:
-                    max_len = max(max_len, len(str(cell.value)))
-            ws_users.column_dimensions[col_letter].width = min(max_len + 2, 50)
-
-        # --- Лист PAYMENTS (Platega) ---
-        ws_payments = wb.create_sheet(title="payments_sbp")
-        payments_columns = ['ID', 'User ID', 'Amount', 'Time Created', 'Is Gift', 'Status', 'Transaction_Id', 'payload']
-        for col_num, title in enumerate(payments_columns, 1):
-            cell = ws_payments.cell(row=1, column=col_num, value=title)
-            cell.alignment = header_alignment
-            cell.border = thin_border
-
-        for row_num, pay in enumerate(payments_list, 2):
-            row_data = [
-                pay.id, pay.user_id, pay.amount, pay.time_created,
-                pay.is_gift, pay.status, pay.transaction_id, pay.payload
-            ]
-            for col_num, value in enumerate(row_data, 1):
-                if col_num == 4 and value and isinstance(value, datetime):
-                    value = value.strftime('%Y-%m-%d %H:%M:%S')
-                cell = ws_payments.cell(row=row_num, column=col_num, value=value)
-                cell.border = thin_border
-
-        for col in ws_payments.columns:
-            max_len = 0
-            col_letter = col[0].column_letter
-            for cell in col:
-                if cell.value:
-                    max_len = max(max_len, len(str(cell.value)))
-            ws_payments.column_dimensions[col_letter].width = min(max_len + 2, 50)
-
-
-
-        # --- Лист PAYMENTS_CARDS (платежи по картам) ---
-        ws_payments_cards = wb.create_sheet(title="payments_cards")
-        cards_columns = ['ID', 'User ID', 'Amount', 'Time Created', 'Is Gift', 'Status', 'Transaction_Id',
-                         'Payload']
-        for col_num, title in enumerate(cards_columns, 1):
-            cell = ws_payments_cards.cell(row=1, column=col_num, value=title)
-            cell.alignment = header_alignment
-            cell.border = thin_border
-
-        for row_num, pay in enumerate(payments_cards_list, 2):
-            row_data = [
-                pay.id, pay.user_id, pay.amount, pay.time_created,
-                pay.is_gift, pay.status, pay.transaction_id, pay.payload
-            ]
-            for col_num, value in enumerate(row_data, 1):
-                if col_num == 4 and value and isinstance(value, datetime):
-                    value = value.strftime('%Y-%m-%d %H:%M:%S')
-                cell = ws_payments_cards.cell(row=row_num, column=col_num, value=value)
-                cell.border = thin_border
-
-        for col in ws_payments_cards.columns:
-            max_len = 0
-            col_letter = col[0].column_letter
-            for cell in col:
-                if cell.value:
-                    max_len = max(max_len, len(str(cell.value)))
-            ws_payments_cards.column_dimensions[col_letter].width = min(max_len + 2, 50)
-
-
-        # --- Лист PAYMENTS_STARS ---
-        ws_payments_stars = wb.create_sheet(title="payments_stars")
-        stars_columns = ['ID', 'User ID', 'Amount (Stars)', 'Time Created', 'Is Gift', 'Status', 'payload']
-        for col_num, title in enumerate(stars_columns, 1):
-            cell = ws_payments_stars.cell(row=1, column=col_num, value=title)
-            cell.alignment = header_alignment
-            cell.border = thin_border
-
-        for row_num, ps in enumerate(payments_stars_list, 2):
-            row_data = [
-                ps.id, ps.user_id, ps.amount, ps.time_created,
-                ps.is_gift, ps.status, ps.payload
-            ]
-            for col_num, value in enumerate(row_data, 1):
-                if col_num == 4 and value and isinstance(value, datetime):
-                    value = value.strftime('%Y-%m-%d %H:%M:%S')
-                cell = ws_payments_stars.cell(row=row_num, column=col_num, value=value)
-                cell.border = thin_border
-
-        for col in ws_payments_stars.columns:
-            max_len = 0
-            col_letter = col[0].column_letter
-            for cell in col:
-                if cell.value:
-                    max_len = max(max_len, len(str(cell.value)))
-            ws_payments_stars.column_dimensions[col_letter].width = min(max_len + 2, 50)
-
-        # --- Лист PAYMENTS_PLATEGA_CRYPTO ---
-        ws_platega_crypto = wb.create_sheet(title="payments_platega_crypto")
-        platega_crypto_columns = ['ID', 'User ID', 'Amount', 'Time Created', 'Is Gift', 'Status', 'Transaction_Id',
-                                  'Payload']
-        for col_num, title in enumerate(platega_crypto_columns, 1):
-            cell = ws_platega_crypto.cell(row=1, column=col_num, value=title)
-            cell.alignment = header_alignment
-            cell.border = thin_border
-
-        for row_num, pay in enumerate(payments_platega_crypto_list, 2):
-            row_data = [
-                pay.id, pay.user_id, pay.amount, pay.time_created,
-                pay.is_gift, pay.status, pay.transaction_id, pay.payload
-            ]
-            for col_num, value in enumerate(row_data, 1):
-                if col_num == 4 and value and isinstance(value, datetime):
-                    value = value.strftime('%Y-%m-%d %H:%M:%S')
-                cell = ws_platega_crypto.cell(row=row_num, column=col_num, value=value)
-                cell.border = thin_border
-
-        for col in ws_platega_crypto.columns:
-            max_len = 0
-            col_letter = col[0].column_letter
-            for cell in col:
-                if cell.value:
-                    max_len = max(max_len, len(str(cell.value)))
-            ws_platega_crypto.column_dimensions[col_letter].width = min(max_len + 2, 50)
-
-
-        # --- Лист PAYMENTS_CRYPTOBOT ---
-        ws_payments_cryptobot = wb.create_sheet(title="payments_cryptobot")
-        crypto_columns = [
-            'ID', 'User ID', 'Amount', 'Currency', 'Time Created',
-            'Is Gift', 'Status', 'Invoice ID', 'Payload'
-        ]
-        for col_num, title in enumerate(crypto_columns, 1):
-            cell = ws_payments_cryptobot.cell(row=1, column=col_num, value=title)
-            cell.alignment = header_alignment
-            cell.border = thin_border
-
-        for row_num, pc in enumerate(payments_cryptobot_list, 2):
-            row_data = [
-                pc.id, pc.user_id, pc.amount, pc.currency, pc.time_created,
-                pc.is_gift, pc.status, pc.invoice_id, pc.payload
-            ]
-            for col_num, value in enumerate(row_data, 1):
-                if col_num == 5 and value and isinstance(value, datetime):
-                    value = value.strftime('%Y-%m-%d %H:%M:%S')
-                cell = ws_payments_cryptobot.cell(row=row_num, column=col_num, value=value)
-                cell.border = thin_border
-
-        for col in ws_payments_cryptobot.columns:
-            max_len = 0
-            col_letter = col[0].column_letter
-            for cell in col:
-                if cell.value:
-                    max_len = max(max_len, len(str(cell.value)))
-            ws_payments_cryptobot.column_dimensions[col_letter].width = min(max_len + 2, 50)
-
-        # --- Лист GIFTS ---
-        ws_gifts = wb.create_sheet(title="gifts")
-        gifts_columns = ['gift_id', 'giver_id', 'duration', 'recepient_id', 'white_flag', 'flag']
-        for col_num, title in enumerate(gifts_columns, 1):
-            cell = ws_gifts.cell(row=1, column=col_num, value=title)
-            cell.alignment = header_alignment
-            cell.border = thin_border
-
-        for row_num, gift in enumerate(gifts_list, 2):
-            row_data = [
-                gift.gift_id, gift.giver_id, gift.duration,
-                gift.recepient_id, gift.white_flag, gift.flag
-            ]
-            for col_num, value in enumerate(row_data, 1):
-                cell = ws_gifts.cell(row=row_num, column=col_num, value=value)
-                cell.border = thin_border
-
-        for col in ws_gifts.columns:
-            max_len = 0
-            col_letter = col[0].column_letter
-            for cell in col:
-                if cell.value:
-                    max_len = max(max_len, len(str(cell.value)))
-            ws_gifts.column_dimensions[col_letter].width = min(max_len + 2, 50)
-
-        # --- Лист ONLINE ---
-        ws_online = wb.create_sheet(title="online")
-        online_columns = ['ID', 'Дата сбора', 'Всего в панели', 'Активны сегодня', 'Платных', 'Триальных']
-        for col_num, title in enumerate(online_columns, 1):
-            cell = ws_online.cell(row=1, column=col_num, value=title)
-            cell.alignment = header_alignment
-            cell.border = thin_border
-
-        for row_num, rec in enumerate(online_list, 2):
-            row_data = [
-                rec.online_id, rec.online_date, rec.users_panel,
-                rec.users_active, rec.users_pay, rec.users_trial
-            ]
-            for col_num, value in enumerate(row_data, 1):
-                if col_num == 2 and value and isinstance(value, datetime):
-                    value = value.strftime('%Y-%m-%d %H:%M:%S')
-                cell = ws_online.cell(row=row_num, column=col_num, value=value)
-                cell.border = thin_border
-
-        for col in ws_online.columns:
-            max_len = 0
-            col_letter = col[0].column_letter
-            for cell in col:
-                if cell.value:
-                    max_len = max(max_len, len(str(cell.value)))
-            ws_online.column_dimensions[col_letter].width = min(max_len + 2, 50)
-
-        # --- Лист WHITE_COUNTER ---
-        ws_white_counter = wb.create_sheet(title="white_counter")
-        wc_columns = ['ID', 'User ID', 'Time Created']
-        for col_num, title in enumerate(wc_columns, 1):
-            cell = ws_white_counter.cell(row=1, column=col_num, value=title)
-            cell.alignment = header_alignment
-            cell.border = thin_border
-
-        for row_num, wc in enumerate(white_counter_list, 2):
-            row_data = [wc.id, wc.user_id, wc.time_created]
-            for col_num, value in enumerate(row_data, 1):
-                if col_num == 3 and value and isinstance(value, datetime):
-                    value = value.strftime('%Y-%m-%d %H:%M:%S')
-                cell = ws_white_counter.cell(row=row_num, column=col_num, value=value)
-                cell.border = thin_border
-
-        for col in ws_white_counter.columns:
-            max_len = 0
-            col_letter = col[0].column_letter
-            for cell in col:
-                if cell.value:
-                    max_len = max(max_len, len(str(cell.value)))
-            ws_white_counter.column_dimensions[col_letter].width = min(max_len + 2, 50)
-
-        # Заморозка заголовков
-        for ws in [ws_users, ws_payments, ws_payments_cards, ws_payments_stars, ws_platega_crypto,
-                   ws_payments_cryptobot, ws_gifts, ws_online, ws_white_counter]:
-            ws.freeze_panes = ws['A2']
-
-        # Сохраняем файл
-        wb.save('export.xlsx')
-
-        # Статистика для caption
-        users_count = len(users_list)
-        gifts_count = len(gifts_list)
-        payments_count = len(payments_list)
-        payments_cards_count = len(payments_cards_list)
-        payments_stars_count = len(payments_stars_list)
-        payments_cryptobot_count = len(payments_cryptobot_list)
-        white_counter_count = len(white_counter_list)
-        payments_platega_crypto_count = len(payments_platega_crypto_list)
-
-        white_subscription_count = sum(
-            1 for u in users_list if u.white_subscription_end_date is not None
-        )
-
-        await message.answer_document(
-            document=FSInputFile('export.xlsx'),
-            caption=f"📊 Экспорт базы данных\n"
-                    f"📅 Создано: {datetime.now().strftime('%d.%m.%Y %H:%M')}\n\n"
-                    f"📊 Статистика:\n"
-                    f"├ 👥 Пользователей: {users_count}\n"
-                    f"├ 🎁 Подарков: {gifts_count}\n"
-                    f"├ 💰 Платежей Platega СБП: {payments_count}\n"
-                    f"├ 💳 Платежей по картам: {payments_cards_count}\n"
-                    f"├ ⭐ Платежей Stars: {payments_stars_count}\n"
-                    f"├ 💰 Платежей Platega Crypto: {payments_platega_crypto_count}\n"
-                    f"├ 💎 Крипто-платежей: {payments_cryptobot_count}\n"
-                    f"├ ⚪ White-подписок: {white_subscription_count}\n"
-                    f"└ 👁 White-кликов: {white_counter_count}"
-        )
+        counts = {}
+        white_subscription_count = 0
+        with temp_export_path('.xlsx') as path:
+            # Строки читаются из БД пачками, а запись в книгу идёт в отдельном потоке
+            writer = XlsxExportWriter(path)
+            for title, headers, columns in EXPORT_TABLES:
+                writer.start_sheet(title, headers)
+                counts[title] = 0
+                async for rows in sql.stream_rows(select(*columns)):
+                    if title == 'users':
+                        white_subscription_count += sum(
+                            1 for row in rows if row[WHITE_SUBSCRIPTION_INDEX] is not None
+                        )
+                    await report_executor.run_in_thread(writer.append_rows, rows)
+                    counts[title] += len(rows)
+            await report_executor.run_in_thread(writer.save)
+
+            await message.answer_document(
+                document=FSInputFile(path, filename=f"export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"),
+                caption=f"📊 Экспорт базы данных\n"
+                        f"📅 Создано: {datetime.now().strftime('%d.%m.%Y %H:%M')}\n\n"
+                        f"📊 Статистика:\n"
+                        f"├ 👥 Пользователей: {counts['users']}\n"
+                        f"├ 🎁 Подарков: {counts['gifts']}\n"
+                        f"├ 💰 Платежей Platega СБП: {counts['payments_sbp']}\n"
+                        f"├ 💳 Платежей по картам: {counts['payments_cards']}\n"
+                        f"├ ⭐ Платежей Stars: {counts['payments_stars']}\n"
+                        f"├ 💰 Платежей Platega Crypto: {counts['payments_platega_crypto']}\n"
+                        f"├ 💎 Крипто-платежей: {counts['payments_cryptobot']}\n"
+                        f"├ ⚪ White-подписок: {white_subscription_count}\n"
+                        f"└ 👁 White-кликов: {counts['white_counter']}"
+            )
 
         logger.info(f"Администратор {message.from_user.id} экспортировал базу данных в Excel")
 
@@ -353,96 +130,127 @@ async def export_database_to_excel(message: Message):
         logger.exception("Детали ошибки:")
         await message.answer(error_message)
 
+async def send_database_tables(message: Message, export_format: str):
+    """Потоковая выгрузка каждой таблицы в отдельный файл csv.gz / parquet; файлы уходят одним альбомом."""
+    try:
+        await message.answer(f"🔄 Начинаю экспорт базы данных в {export_format}...")
+
+        counts = {}
+        with tempfile.TemporaryDirectory(prefix='export_') as directory:
+            paths = []
+            for title, headers, columns in EXPORT_TABLES:
+                path = os.path.join(directory, f"{title}{EXPORT_FORMATS[export_format]}")
+                writer = await report_executor.run_in_thread(open_table_writer, export_format, path, headers, columns)
+                counts[title] = 0
+                try:
+                    async for rows in sql.stream_rows(select(*columns)):
+                        await report_executor.run_in_thread(writer.append_rows, rows)
+                        counts[title] += len(rows)
+                finally:
+                    await report_executor.run_in_thread(writer.close)
+                paths.append(path)
+
+            caption = (f"📊 Экспорт базы данных ({export_format})\n"
+                       f"📅 Создано: {datetime.now().strftime('%d.%m.%Y %H:%M')}\n\n" +
+                       "\n".join(f"├ {title}: {count}" for title, count in counts.items()))
+            media = [InputMediaDocument(media=FSInputFile(path)) for path in paths]
+            media[-1].caption = caption
+            await message.answer_media_group(media)
+
+        logger.info(f"Администратор {message.from_user.id} экспортировал базу данных в {export_format}")
+
+    except Exception as e:
+        error_message = f"❌ Ошибка при экспорте базы данных: {str(e)}"
+        logger.error(error_message)
+        logger.exception("Детали ошибки:")
+        await message.answer(error_message)
+
 
 @router.message(Command("export_panel"))
 async def export_panel(message: Message):
     if message.from_user.id not in ADMIN_IDS:
         return
 
-    users_x3 = await x3.get_all_panel()
-    total = len(users_x3)
-    await message.answer(f"{total} - всего юзеров в панели. Формирую Excel...")
-
-    if not users_x3:
-        await message.answer("Нет пользователей для экспорта.")
+    export_format = parse_export_format(message.text)
+    if export_format is None:
+        await message.answer(export_usage('/export_panel'))
         return
 
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = "panel_users"
+    async with report_executor.slot(message, "выгрузка панели"):
+        if export_format != 'xlsx':
+            await send_panel_table(message, export_format)
+            return
 
-    # Заголовки
-    headers = [
-        "username", "telegramId", "expireAt",
-        "shortUuid", "vlessUuid", "trojanPassword", "ssPassword",
-        "description", "squad_uuid"
-    ]
-    ws.append(headers)
-
-    # Стили
-    header_alignment = Alignment(horizontal="center", vertical="center")
-    thin_border = Border(left=Side(style='thin'), right=Side(style='thin'),
-                         top=Side(style='thin'), bottom=Side(style='thin'))
-
-    # Заголовки форматируем
-    for col_num, title in enumerate(headers, 1):
-        cell = ws.cell(row=1, column=col_num, value=title)
-        cell.alignment = header_alignment
-        cell.border = thin_border
-
-    # Заполнение данными
-    for user in users_x3:
-        # Извлекаем squad (первый элемент списка activeInternalSquads, если есть)
-        squad_name = ""
-        squad_uuid = ""
-        if user.get('activeInternalSquads') and len(user['activeInternalSquads']) > 0:
-            squad = user['activeInternalSquads'][0]
-            squad_name = squad.get('name', '')
-            squad_uuid = squad.get('uuid', '')
-
-        # Форматируем даты (если есть)
-        def format_date(dt_str):
-            if dt_str:
-                try:
-                    dt = datetime.fromisoformat(dt_str.replace('Z', '+00:00'))
-                    return dt.strftime('%Y-%m-%d %H:%M:%S')
-                except:
-                    return dt_str
-            return ""
-
-        row_data = [
-            user.get('username', ''),
-            user.get('telegramId', ''),
-            format_date(user.get('expireAt')),
-            user.get('shortUuid', ''),
-            user.get('vlessUuid', ''),
-            user.get('trojanPassword', ''),
-            user.get('ssPassword', ''),
-            user.get('description', ''),
-            squad_uuid
-        ]
-        ws.append(row_data)
-
-    # Автоширина колонок
-    for col in ws.columns:
-        max_len = 0
-        col_letter = col[0].column_letter
-        for cell in col:
-            if cell.value:
-                max_len = max(max_len, len(str(cell.value)))
-        ws.column_dimensions[col_letter].width = min(max_len + 2, 50)
-
-    # Заморозка заголовка
-    ws.freeze_panes = 'A2'
-
-    wb.save('panel.xlsx')
-
-    # Отправляем файл
-    from aiogram.types import BufferedInputFile
-    await message.answer_document(
-        document=FSInputFile('panel.xlsx',
-        filename=f"panel_users_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"),
-        caption=f"📊 Выгружено пользователей из панели: {total}"
-    )
+        users_x3 = await x3.get_all_panel()
+        total = len(users_x3)
+        await message.answer(f"{total} - всего юзеров в панели. Формирую Excel...")
+
+        if not users_x3:
+            await message.answer("Нет пользователей для экспорта.")
+            return
+
+        # В пул процессов уходят только нужные поля, а не целые ответы панели
+        rows = [panel_row(user) for user in users_x3]
+        with temp_export_path('.xlsx') as path:
+            await report_executor.run_in_process(build_panel_workbook, rows, path)
+
+            # Отправляем файл
+            await message.answer_document(
+                document=FSInputFile(path, filename=f"panel_users_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"),
+                caption=f"📊 Выгружено пользователей из панели: {total}"
+            )
 
     logger.info(f"Администратор {message.from_user.id} выгрузил список пользователей панели")
+
+
+def panel_row(user: dict) -> list:
+    """Строка выгрузки панели в порядке PANEL_HEADERS; expireAt форматируется при построении книги."""
+    # squad — первый элемент списка activeInternalSquads, если есть
+    squad_uuid = ""
+    if user.get('activeInternalSquads'):
+        squad_uuid = user['activeInternalSquads'][0].get('uuid', '')
+    return [
+        user.get('username', ''),
+        user.get('telegramId', ''),
+        user.get('expireAt'),
+        user.get('shortUuid', ''),
+        user.get('vlessUuid', ''),
+        user.get('trojanPassword', ''),
+        user.get('ssPassword', ''),
+        user.get('description', ''),
+        squad_uuid
+    ]
+
+
+async def send_panel_table(message: Message, export_format: str):
+    """Потоковая выгрузка панели в csv.gz / parquet прямо со страниц API, без загрузки всех юзеров в память."""
+    await message.answer(f"🔄 Выгружаю пользователей панели в {export_format}...")
+    total = 0
+    try:
+        with temp_export_path(EXPORT_FORMATS[export_format]) as path:
+            writer = await report_executor.run_in_thread(open_table_writer, export_format, path, PANEL_HEADERS)
+            try:
+                async for users in x3.iter_users():
+                    rows = [panel_row(user) for user in users]
+                    for row in rows:
+                        row[PANEL_EXPIRE_AT_INDEX] = format_panel_date(row[PANEL_EXPIRE_AT_INDEX])
+                    await report_executor.run_in_thread(writer.append_rows, rows)
+                    total += len(rows)
+            finally:
+                await report_executor.run_in_thread(writer.close)
+
+            if not total:
+                await message.answer("Нет пользователей для экспорта.")
+                return
+
+            filename = f"panel_users_{datetime.now().strftime('%Y%m%d_%H%M%S')}{EXPORT_FORMATS[export_format]}"
+            await message.answer_document(
+                document=FSInputFile(path, filename=filename),
+                caption=f"📊 Выгружено пользователей из панели: {total}"
+            )
+    except Exception as e:
+        logger.exception("Ошибка выгрузки панели")
+        await message.answer(f"❌ Ошибка: {str(e)}")
+        return
+
+    logger.info(f"Администратор {message.from_user.id} выгрузил список пользователей панели в {export_format}")
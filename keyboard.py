@@ -111,6 +111,21 @@ def keyboard_tariff_old():
                      )
 
 
+def keyboard_broadcast(segment):
+    """Клавиатура под сообщением рассылки для выбранного сегмента."""
+    if segment == 'all_users':
+        return create_kb(1, buy_gift='🎁 Подарить подписку', r_120='🔥 Акция: 120 дней - 269 руб')
+    elif segment in ('not_connected_subscribe_yes', 'subscribed_all'):
+        return create_kb(1, connect_vpn='🔗 Подключить VPN')
+    elif segment in ('not_connected_subscribe_off', 'connected_subscribe_off'):
+        return create_kb(1, buy_vpn='🛒 Купить подписку')
+    elif segment == 'not_subscribed':
+        return create_kb(1, free_vpn='🔥 Попробовать бесплатно')
+    elif segment == 'connected_never_paid':
+        return keyboard_tariff_old()
+    return None
+
+
 def keyboard_gift_tariff():
     return create_kb(1,
                      gift_r_7='🤌 7 дней - 99 руб',
@@ -1,8 +1,11 @@
 import logging
+import multiprocessing
 from loguru import logger
 
 time_format = "{time:YYYY-MM-DD!UTC}"
-logger.add(f'logs/{time_format}_log.log', format='[{level}]\t[{time}] [{file}]\t: {message}', rotation='00:00')
+# Процессы отчётов (report_executor) тоже импортируют этот модуль; файл лога с ротацией ведёт только основной процесс
+if multiprocessing.current_process().name == 'MainProcess':
+    logger.add(f'logs/{time_format}_log.log', format='[{level}]\t[{time}] [{file}]\t: {message}', rotation='00:00')
 logger_update: logging.Logger = logging.getLogger(__name__)
 logging.basicConfig(
             level=logging.INFO,
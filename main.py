@@ -1,18 +1,29 @@
 import asyncio
+import signal
 from aiogram import Bot, Dispatcher
 from aiogram.types import BotCommand
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
-from bot import bot
-from config_bd.models import create_tables
+from bot import bot, sql, x3
+from botapi_sender import bot_api
+from broadcaster import resume_broadcast_jobs
+from config_bd.models import create_tables, dispose_engines
 from payments import pay_stars, pay_cryptobot, pay_platega
+from report_executor import report_executor
 from sheduler.check_connect import check_connect
 from sheduler.check_cryptobot import check_cryptobot_payments
 from sheduler.check_online import check_online_daily
-from sheduler.check_platega import check_platega, check_platega_card, check_platega_crypto
+from sheduler.daily_metrics import refresh_daily_metrics
+from sheduler.check_platega import check_platega_payments
+from sheduler.retry_payments import retry_failed_payments
 from handlers import handlers_user, handlers_statistic, handlers_admin, handlers_broadcast, handlers_export
 from sheduler.time_mes import send_message_cron
 from logging_config import logger
+from config import PAYMENT_WEBHOOKS_ENABLED, PAYMENT_RECONCILE_MINUTES, BOT_WEBHOOK_URL, BOT_WEBHOOK_PATH, \
+    BOT_WEBHOOK_SECRET, BOT_SHUTDOWN_DRAIN_TIMEOUT
+from middlewares import update_limiter
+from webhooks import create_web_app, start_web_app, drain_background_tasks
 from sheduler.time_mes_not_sub import send_push_cron
 
 
@@ -22,9 +33,31 @@ async def set_commands(bot: Bot):
     ]
     await bot.set_my_commands(commands)
 
+async def run_webhook(dp: Dispatcher) -> None:
+    """Режим webhook: апдейты приходят на BOT_WEBHOOK_PATH HTTP-сервера; работает до SIGINT/SIGTERM."""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:  # Windows: остановка через KeyboardInterrupt
+            pass
+
+    await bot.set_webhook(
+        f"{BOT_WEBHOOK_URL.rstrip('/')}{BOT_WEBHOOK_PATH}",
+        secret_token=BOT_WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+        drop_pending_updates=False
+    )
+    logger.info("Bot start webhook.")
+    await stop_event.wait()
+    # Снимаем webhook до ожидания текущих апдейтов: новые останутся в очереди Telegram до следующего запуска
+    await bot.delete_webhook(drop_pending_updates=False)
+
 # Функция конфигурирования и запуска бота
 async def main() -> None:
     await create_tables()
+    await sql.backfill_payments_ledger()
 
     # Инициализация диспетчера
     dp: Dispatcher = Dispatcher()
@@ -36,29 +69,60 @@ async def main() -> None:
     dp.include_router(pay_stars.router)
     dp.include_router(pay_platega.router)
     # dp.include_router(pay_cryptobot.router)
+    dp.update.outer_middleware(update_limiter)
 
     # Запуск шедулера
     scheduler = AsyncIOScheduler(timezone="Europe/Moscow")
     scheduler.add_job(send_message_cron, 'cron', hour=9, minute=30, args=[bot], misfire_grace_time=60)
     scheduler.add_job(check_connect, trigger='interval', minutes=14, misfire_grace_time=60)
-    scheduler.add_job(check_platega, trigger='interval', minutes=1, misfire_grace_time=10)
-    scheduler.add_job(check_platega_card, trigger='interval', minutes=1, misfire_grace_time=10)
-    scheduler.add_job(check_platega_crypto, trigger='interval', minutes=1, misfire_grace_time=10)
+    # При включённых вебхуках платежи подтверждаются колбэками, а опрос остаётся редкой сверкой
+    platega_poll_minutes = PAYMENT_RECONCILE_MINUTES if PAYMENT_WEBHOOKS_ENABLED else 1
+    scheduler.add_job(check_platega_payments, trigger='interval', minutes=platega_poll_minutes, max_instances=1,
+                      coalesce=True, misfire_grace_time=10)
     # scheduler.add_job(check_cryptobot_payments, trigger='interval', minutes=1, misfire_grace_time=10)
+    scheduler.add_job(retry_failed_payments, trigger='interval', minutes=5, max_instances=1, coalesce=True,
+                      misfire_grace_time=60)
     scheduler.add_job(send_push_cron, trigger='interval', minutes=30, misfire_grace_time=60)
     scheduler.add_job(check_online_daily, 'cron', hour=2, minute=55, id='daily_online_stats', misfire_grace_time=60)
+    scheduler.add_job(refresh_daily_metrics, trigger='interval', minutes=30, max_instances=1, misfire_grace_time=60)
+    # Флаги старых пользователей меняются без отметки времени, их догоняет ночной полный пересчёт
+    scheduler.add_job(refresh_daily_metrics, 'cron', hour=3, minute=30, kwargs={'full': True}, max_instances=1,
+                      misfire_grace_time=600)
     scheduler.start()
 
     await set_commands(bot)
+    await resume_broadcast_jobs(bot)
+
+    web_runner = None
+    if PAYMENT_WEBHOOKS_ENABLED or BOT_WEBHOOK_URL:
+        web_app = create_web_app()
+        if BOT_WEBHOOK_URL:
+            SimpleRequestHandler(
+                dispatcher=dp, bot=bot, secret_token=BOT_WEBHOOK_SECRET, handle_in_background=True
+            ).register(web_app, path=BOT_WEBHOOK_PATH)
+        web_runner = await start_web_app(web_app)
 
     try:
-        # Пропуск накопившихся апдейтов и запуск polling
-        await bot.delete_webhook(drop_pending_updates=True)
-        logger.info("Bot start polling.")
-        await dp.start_polling(bot)
+        if BOT_WEBHOOK_URL:
+            await run_webhook(dp)
+        else:
+            # Пропуск накопившихся апдейтов и запуск polling
+            await bot.delete_webhook(drop_pending_updates=True)
+            logger.info("Bot start polling.")
+            await dp.start_polling(bot)
     except asyncio.CancelledError:
         logger.error("Polling was cancelled. Cleaning up...")
     finally:
+        await update_limiter.drain(BOT_SHUTDOWN_DRAIN_TIMEOUT)
+        await drain_background_tasks(BOT_SHUTDOWN_DRAIN_TIMEOUT)
+        if web_runner is not None:
+            await web_runner.cleanup()
+        await bot_api.close()
+        await pay_platega.platega.close()
+        await pay_cryptobot.cryptobot.close()
+        await x3.close()
+        report_executor.shutdown()
+        await dispose_engines()
         await bot.session.close()
         logger.info("Bot session closed.")
 
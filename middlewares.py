@@ -0,0 +1,86 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from config import BOT_UPDATES_CONCURRENCY
+from logging_config import logger
+
+LATENCY_REPORT_EVERY = 100  # раз в столько апдейтов пишем в лог сводку по задержкам
+
+
+class UpdateLimiterMiddleware(BaseMiddleware):
+    """
+    Внешний middleware на апдейты (dp.update.outer_middleware).
+    - Ограничивает число одновременно обрабатываемых апдейтов: остальные ждут семафор.
+    - Считает апдейты в работе, чтобы при остановке дождаться их (drain).
+    - Пишет задержки: от отправки сообщения пользователем до конца обработки и само время обработки,
+      чтобы сравнивать режимы polling и webhook.
+    """
+
+    def __init__(self, concurrency: int = BOT_UPDATES_CONCURRENCY):
+        self._semaphore = asyncio.Semaphore(max(1, concurrency))
+        self._in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._count = 0
+        self._handle_total = 0.0
+        self._handle_max = 0.0
+        self._latency_total = 0.0
+        self._latency_count = 0
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        self._in_flight += 1
+        self._idle.clear()
+        try:
+            async with self._semaphore:
+                started = time.monotonic()
+                try:
+                    return await handler(event, data)
+                finally:
+                    self._record(event, time.monotonic() - started)
+        finally:
+            self._in_flight -= 1
+            if self._in_flight == 0:
+                self._idle.set()
+
+    def _record(self, event: TelegramObject, handle_time: float) -> None:
+        self._count += 1
+        self._handle_total += handle_time
+        self._handle_max = max(self._handle_max, handle_time)
+
+        message = event.message if isinstance(event, Update) else None
+        if message is not None and message.date is not None:
+            # message.date с точностью до секунды, поэтому задержка тоже грубая
+            latency = (datetime.now(timezone.utc) - message.date).total_seconds()
+            self._latency_total += latency
+            self._latency_count += 1
+            logger.debug(f"Update {event.update_id}: обработка {handle_time:.3f} с, от сообщения до ответа {latency:.1f} с")
+
+        if self._count % LATENCY_REPORT_EVERY == 0:
+            avg_latency = self._latency_total / self._latency_count if self._latency_count else 0.0
+            logger.info(f"📈 Апдейтов: {self._count}, обработка в среднем {self._handle_total / self._count:.3f} с "
+                        f"(макс. {self._handle_max:.3f} с), от сообщения до ответа в среднем {avg_latency:.1f} с, "
+                        f"сейчас в работе: {self._in_flight}")
+            self._handle_max = 0.0
+
+    async def drain(self, timeout: float) -> None:
+        """Ждёт завершения апдейтов, которые уже в обработке, но не дольше timeout секунд."""
+        if self._in_flight == 0:
+            return
+        logger.info(f"Ждём завершения {self._in_flight} апдейтов...")
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не дождались {self._in_flight} апдейтов за {timeout} с")
+
+
+update_limiter = UpdateLimiterMiddleware()
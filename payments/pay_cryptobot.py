@@ -4,7 +4,7 @@ from aiogram import F, Router
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 
 from bot import sql
-from config import CRYPTOBOT_API_TOKEN, ADMIN_IDS
+from config import CRYPTOBOT_API_TOKEN, ADMIN_IDS, PAYMENT_HTTP_TIMEOUT, PAYMENT_HTTP_LIMIT_PER_HOST
 from keyboard import create_kb
 from lexicon import lexicon
 from logging_config import logger
@@ -21,6 +21,23 @@ class CryptoBotPayment:
             "Crypto-Pay-API-Token": api_token,
             "Content-Type": "application/json"
         }
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Долгоживущая сессия с keep-alive вместо новой сессии на каждый запрос"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit_per_host=PAYMENT_HTTP_LIMIT_PER_HOST, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(
+                headers=self.headers,
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=PAYMENT_HTTP_TIMEOUT, connect=5)
+            )
+        return self._session
+
+    async def close(self):
+        """Закрытие сессии aiohttp"""
+        if self._session and not self._session.closed:
+            await self._session.close()
 
     async def create_invoice(self, asset: str, amount: float, description: str,
                              payload: str, expires_in: int = 7200) -> Dict:
@@ -38,25 +55,25 @@ class CryptoBotPayment:
             "expires_in": expires_in
         }
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=data, headers=self.headers) as resp:
-                    if resp.status == 200:
-                        result = await resp.json()
-                        if result.get("ok"):
-                            inv = result["result"]
-                            return {
-                                'status': 'pending',
-                                'url': inv['pay_url'],
-                                'invoice_id': inv['invoice_id'],
-                                'payload': payload
-                            }
-                        else:
-                            logger.error(f"Cryptobot API error: {result}")
-                            return {'status': 'error', 'message': result.get('error')}
+            session = await self._get_session()
+            async with session.post(url, json=data) as resp:
+                if resp.status == 200:
+                    result = await resp.json()
+                    if result.get("ok"):
+                        inv = result["result"]
+                        return {
+                            'status': 'pending',
+                            'url': inv['pay_url'],
+                            'invoice_id': inv['invoice_id'],
+                            'payload': payload
+                        }
                     else:
-                        text = await resp.text()
-                        logger.error(f"Cryptobot HTTP error {resp.status}: {text}")
-                        return {'status': 'error', 'message': f"HTTP {resp.status}"}
+                        logger.error(f"Cryptobot API error: {result}")
+                        return {'status': 'error', 'message': result.get('error')}
+                else:
+                    text = await resp.text()
+                    logger.error(f"Cryptobot HTTP error {resp.status}: {text}")
+                    return {'status': 'error', 'message': f"HTTP {resp.status}"}
         except Exception as e:
             logger.error(f"Error creating Cryptobot invoice: {e}")
             return {'status': 'error', 'message': str(e)}
@@ -66,24 +83,27 @@ class CryptoBotPayment:
         url = f"{self.base_url}/getInvoices"
         params = {"invoice_ids": str(invoice_id)}
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers=self.headers, params=params) as resp:
-                    if resp.status == 200:
-                        result = await resp.json()
-                        if result.get("ok") and result.get("result", {}).get("items"):
-                            invoice = result["result"]["items"][0]
-                            return invoice.get("status")
-                        else:
-                            logger.error(f"Failed to get invoice {invoice_id}: {result}")
-                            return None
+            session = await self._get_session()
+            async with session.get(url, params=params) as resp:
+                if resp.status == 200:
+                    result = await resp.json()
+                    if result.get("ok") and result.get("result", {}).get("items"):
+                        invoice = result["result"]["items"][0]
+                        return invoice.get("status")
                     else:
-                        logger.error(f"HTTP error {resp.status} for invoice {invoice_id}")
+                        logger.error(f"Failed to get invoice {invoice_id}: {result}")
                         return None
+                else:
+                    logger.error(f"HTTP error {resp.status} for invoice {invoice_id}")
+                    return None
         except Exception as e:
             logger.error(f"Error checking invoice {invoice_id}: {e}")
             return None
 
 
+cryptobot = CryptoBotPayment(CRYPTOBOT_API_TOKEN)
+
+
 async def create_cryptobot_payment(amount: float, currency: str, description: str,
                                    user_id: int, duration: int, white: bool,
                                    is_gift: bool, method: str) -> Dict:
@@ -91,8 +111,6 @@ async def create_cryptobot_payment(amount: float, currency: str, description: st
     Создание платежа через Cryptobot и запись в БД.
     Возвращает словарь с ключами: status, url, invoice_id.
     """
-    cryptobot = CryptoBotPayment(CRYPTOBOT_API_TOKEN)
-
     # Формируем payload для последующей обработки
     payload = (f"user_id:{user_id},duration:{duration},white:{white},"
                f"gift:{is_gift},method:{method},amount:{amount}")
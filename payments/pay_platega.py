@@ -5,7 +5,7 @@ from aiogram import Router, F
 from aiogram.types import CallbackQuery
 
 from bot import sql
-from config import PLATEGA_API_KEY, PLATEGA_MERCHANT_ID, ADMIN_IDS
+from config import PLATEGA_API_KEY, PLATEGA_MERCHANT_ID, ADMIN_IDS, PAYMENT_HTTP_TIMEOUT, PAYMENT_HTTP_LIMIT_PER_HOST
 from keyboard import keyboard_payment_sbp, create_kb
 from lexicon import dct_price, dct_desc, lexicon
 from logging_config import logger
@@ -25,6 +25,23 @@ class PlategaPayment:
             "X-MerchantId": merchant_id,
             "Content-Type": "application/json"
         }
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Долгоживущая сессия с keep-alive: DNS, TCP и TLS не повторяются на каждый запрос."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit_per_host=PAYMENT_HTTP_LIMIT_PER_HOST, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(
+                headers=self.headers,
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=PAYMENT_HTTP_TIMEOUT, connect=5)
+            )
+        return self._session
+
+    async def close(self):
+        """Закрывает сессию aiohttp (вызывать при завершении работы)."""
+        if self._session and not self._session.closed:
+            await self._session.close()
 
     async def create_payment(
             self,
@@ -53,22 +70,22 @@ class PlategaPayment:
             data["payload"] = payload
 
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=data, headers=self.headers) as response:
-                    response_text = await response.text()
-
-                    if response.status == 200:
-                        result = await response.json()
-
-                        return {
-                            'status': result.get('status', 'PENDING').lower(),
-                            'url': result.get('redirect', ''),
-                            'id': result.get('transactionId', ''),
-                            'payment_method': result.get('paymentMethod', 'UNKNOWN')
-                        }
-                    else:
-                        logger.error(f"Platega API error {response.status}: {response_text}")
-                        raise Exception(f"Ошибка создания платежа: {response.status}")
+            session = await self._get_session()
+            async with session.post(url, json=data) as response:
+                response_text = await response.text()
+
+                if response.status == 200:
+                    result = await response.json()
+
+                    return {
+                        'status': result.get('status', 'PENDING').lower(),
+                        'url': result.get('redirect', ''),
+                        'id': result.get('transactionId', ''),
+                        'payment_method': result.get('paymentMethod', 'UNKNOWN')
+                    }
+                else:
+                    logger.error(f"Platega API error {response.status}: {response_text}")
+                    raise Exception(f"Ошибка создания платежа: {response.status}")
 
         except Exception as e:
             logger.error(f"Error creating Platega payment: {e}")
@@ -77,23 +94,25 @@ class PlategaPayment:
     async def check_payment(self, transaction_id: str) -> Dict:
         url = f"{self.base_url}/transaction/{transaction_id}"
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers=self.headers) as response:
-                    response_text = await response.text()
-                    if response.status == 200:
-                        return await response.json()
-                    else:
-                        logger.error(f"Platega API check error {response.status}: {response_text}")
-                        raise Exception(f"Ошибка проверки платежа: {response.status}")
+            session = await self._get_session()
+            async with session.get(url) as response:
+                response_text = await response.text()
+                if response.status == 200:
+                    return await response.json()
+                else:
+                    logger.error(f"Platega API check error {response.status}: {response_text}")
+                    raise Exception(f"Ошибка проверки платежа: {response.status}")
         except Exception as e:
             logger.error(f"Error checking Platega payment: {e}")
             raise
 
 
+platega = PlategaPayment(PLATEGA_API_KEY, PLATEGA_MERCHANT_ID)
+
+
 async def pay(val: str, des: str, user_id: str, duration: str, white: bool, payment_method: int = 2) -> Dict:
     """Создание платежа для совместимости с pay_yoo.py"""
 
-    platega = PlategaPayment(PLATEGA_API_KEY, PLATEGA_MERCHANT_ID)
     if payment_method == 2:
         method = 'sbp'
     elif payment_method == 11:
@@ -137,7 +156,6 @@ async def pay(val: str, des: str, user_id: str, duration: str, white: bool, paym
 async def pay_for_gift(val: str, des: str, user_id: str, duration: str, white: bool, payment_method: int = 2) -> Dict:
     """Создание платежа для совместимости с pay_yoo.py"""
 
-    platega = PlategaPayment(PLATEGA_API_KEY, PLATEGA_MERCHANT_ID)
     if payment_method == 2:
         method = 'sbp'
     elif payment_method == 11:
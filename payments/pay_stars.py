@@ -6,7 +6,7 @@ from logging_config import logger
 from aiogram import Router, F
 from aiogram.types import CallbackQuery, LabeledPrice, PreCheckoutQuery, Message
 from lexicon import lexicon
-from payments.process_payload import process_confirmed_payment
+from payments.process_payload import process_payment_once
 
 
 router: Router = Router()
@@ -67,4 +67,4 @@ async def success_payment_handler(message: Message):
     if not payload:
         logger.error(f"❌ Нет payload в платеже {message.successful_payment.invoice_payload}")
         return
-    await process_confirmed_payment(payload)
+    await process_payment_once(f"stars:{message.successful_payment.telegram_payment_charge_id}", payload)
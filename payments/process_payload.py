@@ -1,16 +1,136 @@
-from datetime import datetime
+import asyncio
+from datetime import datetime, timedelta
+from typing import Set
+from weakref import WeakValueDictionary
 
 from bot import x3, sql, bot
 
+from config import PAYMENT_PROCESS_CONCURRENCY, PAYMENT_PROCESSING_TIMEOUT, PAYMENT_MAX_ATTEMPTS
 from keyboard import create_kb, keyboard_sub_after_buy
 from lexicon import lexicon
 from logging_config import logger
 
-async def process_confirmed_payment(payload):
-    """Обработка подтвержденного платежа"""
+# Платежи разных пользователей обрабатываются параллельно (не больше PAYMENT_PROCESS_CONCURRENCY),
+# платежи одного пользователя — строго по очереди
+_processing_semaphore = asyncio.Semaphore(PAYMENT_PROCESS_CONCURRENCY)
+_user_locks: WeakValueDictionary = WeakValueDictionary()
+_in_progress: Set[str] = set()  # payment_key, которые обрабатываются в этом процессе
+REFERRAL_KEY_PREFIX = 'ref:'  # бонус рефереру за платёж: ref:<payment_key> в processed_payments
+REFERRAL_BONUS_DAYS = 7
+
+
+def parse_payload(payload: str) -> dict:
+    return dict(item.split(':') for item in payload.split(','))
+
+
+async def process_payment_once(payment_key: str, payload: str) -> bool:
+    """
+    Единая точка входа для подтверждённых платежей (Stars, Platega, Cryptobot).
+    payment_key — провайдер:идентификатор транзакции; по отметке в processed_payments
+    один платёж обрабатывается ровно один раз, даже если его подтвердили и опрос, и вебхук.
+    Неудачные и зависшие обработки дообрабатывает retry_stuck_payments.
+    """
+    try:
+        user_id = int(parse_payload(payload).get('user_id', 0))
+    except ValueError:
+        logger.error(f"❌ Некорректный payload в платеже {payment_key}: {payload}")
+        return False
+
+    if not await sql.claim_payment(payment_key, user_id, payload):
+        logger.info(f"♻️ Платёж {payment_key} уже обработан или обрабатывается, пропускаем")
+        return False
+    return await _process_claimed_payment(payment_key, user_id, payload)
+
+
+async def _process_claimed_payment(payment_key: str, user_id: int, payload: str) -> bool:
+    _in_progress.add(payment_key)
+    lock = _user_locks.setdefault(user_id, asyncio.Lock())
+    success = False
     try:
+        async with lock:
+            async with _processing_semaphore:
+                if payment_key.startswith(REFERRAL_KEY_PREFIX):
+                    success = await grant_referral_bonus(payload, payment_key)
+                else:
+                    success = await process_confirmed_payment(payload, payment_key)
+    finally:
+        _in_progress.discard(payment_key)
+        await sql.finish_payment(payment_key, 'done' if success else 'failed')
+    return success
+
+
+async def retry_stuck_payments() -> int:
+    """
+    Сверка processed_payments: снова обрабатывает платежи в 'failed' и зависшие в 'processing'
+    дольше PAYMENT_PROCESSING_TIMEOUT минут (например, бот перезапустили посреди обработки).
+    После PAYMENT_MAX_ATTEMPTS попыток платёж остаётся для ручного разбора.
+    Возвращает количество успешно дообработанных платежей.
+    """
+    stale_before = datetime.now() - timedelta(minutes=PAYMENT_PROCESSING_TIMEOUT)
+    payments = await sql.get_stuck_payments(stale_before, PAYMENT_MAX_ATTEMPTS)
+    claimed = []
+    for payment in payments:
+        if payment.payment_key in _in_progress or not await sql.reclaim_payment(payment.payment_key, stale_before):
+            continue
+        logger.info(f"🔁 Повторная обработка платежа {payment.payment_key} ({payment.status}), "
+                    f"попытка {payment.attempts + 1}")
+        claimed.append(_process_claimed_payment(payment.payment_key, payment.user_id, payment.payload))
+    if not claimed:
+        return 0
+    results = await asyncio.gather(*claimed)
+    logger.info(f"🔁 Сверка платежей: дообработано {sum(results)} из {len(results)}")
+    return sum(results)
+
+
+async def grant_referral_bonus(payload: str, ref_key: str) -> bool:
+    """
+    Начисляет рефереру REFERRAL_BONUS_DAYS дней за оплату приглашённого и уведомляет его.
+    payload — ref_id:<реферер>,user_id:<приглашённый>. Как и основной платёж, отмечает продление
+    в панели, чтобы повтор после сбоя не начислил дни второй раз.
+    """
+    try:
+        payload_parts = parse_payload(payload)
+        ref_id = int(payload_parts['ref_id'])
+        user_id = int(payload_parts['user_id'])
+
+        processed = await sql.get_processed_payment(ref_key)
+        if processed is not None and processed.panel_expire_at is not None:
+            ref_subscription_end_date = processed.panel_expire_at
+        else:
+            logger.info(f"🎁 Начисляем {REFERRAL_BONUS_DAYS} дней рефереру {ref_id} за приглашение")
+            # Рефереру только продлеваем подписку, новых клиентов не создаём
+            ref_extended = await x3.extend_subscription(str(ref_id), ref_id, REFERRAL_BONUS_DAYS, create=False)
+            if ref_extended is None:
+                logger.error(f"❌ Не удалось продлить подписку реферера {ref_id}")
+                return False
+            ref_subscription_end_date = x3.to_msk(ref_extended[1])
+            await sql.mark_payment_panel_done(ref_key, ref_subscription_end_date)
+
+        await sql.update_subscription_end_date(ref_id, ref_subscription_end_date)
+        logger.info(f"✅ Обновлена подписка реферера {ref_id} на {REFERRAL_BONUS_DAYS} дней, до {ref_subscription_end_date}")
+
+        try:
+            await bot.send_message(
+                chat_id=ref_id,
+                text=lexicon['ref_success'].format(user_id),
+                reply_markup=create_kb(1, back_to_main='🔙 Назад')
+            )
+            logger.info(f"✅ Уведомление отправлено рефереру {ref_id}")
+        except Exception as e:
+            logger.error(f"❌ Ошибка отправки уведомления рефереру: {e}")
+        return True
+
+    except Exception as e:
+        logger.error(f"❌ Ошибка начисления бонуса рефереру ({ref_key}): {e}")
+        return False
+
+
+async def process_confirmed_payment(payload, payment_key: str) -> bool:
+    """Обработка подтвержденного платежа. Напрямую не вызывать — только через process_payment_once."""
+    try:
+        processed = await sql.get_processed_payment(payment_key)
         # Парсим payload
-        payload_parts = dict(item.split(':') for item in payload.split(','))
+        payload_parts = parse_payload(payload)
         user_id = int(payload_parts.get('user_id', 0))
         duration = int(payload_parts.get('duration', 0))
         white_flag = payload_parts.get('white', 'False') == 'True'
@@ -30,7 +150,8 @@ async def process_confirmed_payment(payload):
             currency = 'руб'
         elif method == 'stars':
             currency = '⭐️'
-            await sql.add_payment_stars(user_id, amount, payload, is_gift)
+            # Запись идемпотентна по payment_key, поэтому повторяется при каждой попытке, пока не удастся
+            await sql.add_payment_stars(user_id, amount, payload, is_gift, payment_key)
         elif method in ('ton', 'usdt'):
             currency = method.upper()
         else:
@@ -70,33 +191,28 @@ async def process_confirmed_payment(payload):
             if white_flag:
                 user_id_str += '_white'
 
-            existing_user = await x3.get_user_by_username(user_id_str)
-
-            if existing_user and 'response' in existing_user and existing_user['response']:
-                logger.info(f"⏫ Обновляем {user_id_str} на {duration} дней")
-                response = await x3.updateClient(duration, user_id_str, user_id)
+            if processed is not None and processed.panel_expire_at is not None:
+                # Панель продлила прошлая попытка, второй раз дни не начисляем
+                existed = True
+                subscription_end_date = processed.panel_expire_at
+                sub_link = await x3.sublink(user_id_str)
             else:
-                logger.info(f"➕ Добавляем {user_id_str} на {duration} дней")
-                response = await x3.addClient(duration, user_id_str, user_id)
-
-            if not response:
-                logger.error(f"❌ Не удалось обновить клиента {user_id_str}")
-                return
-
-            result_active = await x3.activ(user_id_str)
-            subscription_time = result_active.get('time', '-')
+                extended = await x3.extend_subscription(user_id_str, user_id, duration)
+                if extended is None:
+                    logger.error(f"❌ Не удалось обновить клиента {user_id_str}")
+                    return False
+                existed, expire_at, sub_link = extended
+                # Дата в БД хранится в МСК, как и раньше
+                subscription_end_date = x3.to_msk(expire_at)
+                await sql.mark_payment_panel_done(payment_key, subscription_end_date)
 
             # Обновляем дату окончания подписки в БД
-            if subscription_time != '-':
-                try:
-                    subscription_end_date = datetime.strptime(subscription_time, '%d-%m-%Y %H:%M МСК')
-                    if white_flag:
-                        await sql.update_white_subscription_end_date(user_id, subscription_end_date)
-                    else:
-                        await sql.update_subscription_end_date(user_id, subscription_end_date)
-                    logger.info(f"✅ Дата подписки обновлена: {subscription_end_date}")
-                except ValueError as e:
-                    logger.error(f"❌ Ошибка парсинга даты: {e}")
+            subscription_time = subscription_end_date.strftime('%d-%m-%Y %H:%M МСК')
+            if white_flag:
+                await sql.update_white_subscription_end_date(user_id, subscription_end_date)
+            else:
+                await sql.update_subscription_end_date(user_id, subscription_end_date)
+            logger.info(f"✅ Дата подписки обновлена: {subscription_end_date}")
 
             # Реферальная система
             try:
@@ -113,37 +229,16 @@ async def process_confirmed_payment(payload):
                             if ref_data and len(ref_data) > 4:
                                 ref_is_pay_null = ref_data[4]
 
-                                if ref_is_pay_null:
-                                    logger.info(f"🎁 Начисляем 7 дней рефереру {ref_id} за приглашение")
-
-                                    # await x3.test_connect()
-                                    ref_existing = await x3.get_user_by_username(str(ref_id))
-
-                                    if ref_existing and 'response' in ref_existing and ref_existing['response']:
-                                        await x3.updateClient(7, str(ref_id), ref_id)
-                                        logger.info(f"✅ Обновлена подписка реферера {ref_id} на 7 дней")
-
-                                    ref_result_active = await x3.activ(str(ref_id))
-                                    ref_subscription_time = ref_result_active.get('time', '-')
-
-                                    if ref_subscription_time != '-':
-                                        try:
-                                            ref_subscription_end_date = datetime.strptime(ref_subscription_time,
-                                                                                          '%d-%m-%Y %H:%M МСК')
-                                            await sql.update_subscription_end_date(ref_id, ref_subscription_end_date)
-                                            logger.info(f"✅ Дата подписки реферера обновлена")
-                                        except ValueError as e:
-                                            logger.error(f"❌ Ошибка парсинга даты реферера: {e}")
-
+                                # Бонус занимается отдельной отметкой со своим payload: повтор обработки
+                                # не начислит его дважды, а неудачное начисление дообработает сверка
+                                ref_key = f"{REFERRAL_KEY_PREFIX}{payment_key}"
+                                ref_payload = f"ref_id:{ref_id},user_id:{user_id}"
+                                if ref_is_pay_null and await sql.claim_payment(ref_key, ref_id, ref_payload):
+                                    ref_success = False
                                     try:
-                                        await bot.send_message(
-                                            chat_id=ref_id,
-                                            text=lexicon['ref_success'].format(user_id),
-                                            reply_markup=create_kb(1, back_to_main='🔙 Назад')
-                                        )
-                                        logger.info(f"✅ Уведомление отправлено рефереру {ref_id}")
-                                    except Exception as e:
-                                        logger.error(f"❌ Ошибка отправки уведомления рефереру: {e}")
+                                        ref_success = await grant_referral_bonus(ref_payload, ref_key)
+                                    finally:
+                                        await sql.finish_payment(ref_key, 'done' if ref_success else 'failed')
 
                         except (ValueError, Exception) as e:
                             logger.error(f"❌ Ошибка при обработке реферальной системы: {e}")
@@ -159,8 +254,7 @@ async def process_confirmed_payment(payload):
 
             # Отправляем уведомление пользователю
             try:
-                sub_link = await x3.sublink(user_id_str)
-                marker = 'продлена' if existing_user else 'активирована'
+                marker = 'продлена' if existed else 'активирована'
                 message_text = lexicon['payment_success'].format(marker, subscription_time, amount, currency, duration, sub_link)
 
                 await bot.send_message(
@@ -176,5 +270,8 @@ async def process_confirmed_payment(payload):
             except Exception as e:
                 logger.error(f"❌ Ошибка отправки уведомления: {e}")
 
+        return True
+
     except Exception as e:
         logger.error(f"❌ Ошибка обработки подтвержденного платежа: {e}")
+        return False
@@ -0,0 +1,61 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import Callable, Optional
+
+from aiogram.types import Message
+
+from config import REPORT_MAX_CONCURRENT, REPORT_PROCESS_WORKERS
+from logging_config import logger
+
+
+class ReportExecutor:
+    """
+    Выполняет тяжёлые отчёты вне event loop.
+    Чистые функции над уже собранными данными (report_builders) уходят в пул процессов,
+    потоковая запись, которая чередуется с чтением из БД, — в пул потоков.
+    Одновременно строится не больше max_concurrent отчётов, остальные ждут в очереди.
+    """
+
+    def __init__(self, max_concurrent: int = REPORT_MAX_CONCURRENT, process_workers: int = REPORT_PROCESS_WORKERS):
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._process_workers = process_workers
+        self._process_pool: Optional[ProcessPoolExecutor] = None
+        self._thread_pool = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix='report')
+
+    def _get_process_pool(self) -> ProcessPoolExecutor:
+        # Пул создаётся при первом отчёте, чтобы не держать процессы без дела
+        if self._process_pool is None:
+            # spawn: fork копировал бы работающий event loop, пулы соединений с БД и потоки бота.
+            # Дочерний процесс при этом заново импортирует main.py (как __mp_main__): создаются объекты
+            # бота, движков БД и X3, но соединения у них ленивые и в процессе отчёта не открываются
+            self._process_pool = ProcessPoolExecutor(max_workers=self._process_workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+        return self._process_pool
+
+    @asynccontextmanager
+    async def slot(self, message: Message, title: str):
+        """Ограничивает число одновременных отчётов и сообщает админу, если отчёт встал в очередь."""
+        if self._semaphore.locked():
+            await message.answer(f"⏳ Сейчас формируются другие отчёты, {title} начнётся после них...")
+        async with self._semaphore:
+            yield
+
+    async def run_in_process(self, func: Callable, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_process_pool(), partial(func, *args))
+
+    async def run_in_thread(self, func: Callable, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._thread_pool, partial(func, *args))
+
+    def shutdown(self) -> None:
+        self._thread_pool.shutdown(wait=False, cancel_futures=True)
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=False, cancel_futures=True)
+        logger.info("Report executor stopped")
+
+
+report_executor = ReportExecutor()
@@ -1,16 +1,17 @@
+from typing import Set
+
 from bot import bot, sql
-from config import CRYPTOBOT_API_TOKEN
 from keyboard import keyboard_payment_cancel
 from lexicon import lexicon
 from logging_config import logger
-from payments.pay_cryptobot import CryptoBotPayment
-from payments.process_payload import process_confirmed_payment
+from payments.pay_cryptobot import cryptobot
+from payments.process_payload import process_payment_once
+
+_in_progress: Set[int] = set()  # id платежей, статус которых сейчас обрабатывается
 
 
 async def check_cryptobot_payments():
     """Проверка статусов платежей Cryptobot и их обработка"""
-    cryptobot = CryptoBotPayment(CRYPTOBOT_API_TOKEN)
-
     try:
         # Получаем все платежи со статусом 'active' через асинхронный метод
         pending_payments = await sql.get_active_cryptobot_payments()
@@ -38,25 +39,13 @@ async def check_cryptobot_payments():
                     processed += 1
                     continue
 
-                # Обновляем статус в БД через асинхронный метод
-                await sql.update_cryptobot_payment_status(payment.id, status)
-
-                logger.info(f"Payment {payment.id} status updated to {status}")
+                if not await apply_cryptobot_status(payment, status):
+                    continue
 
                 if status == 'paid':
-                    if payment.payload:
-                        await process_confirmed_payment(payment.payload)
-                    else:
-                        logger.error(f"No payload for payment {payment.id}")
                     confirmed += 1
                 elif status == 'expired':
                     expired += 1
-                    try:
-                        user_id = payment.user_id
-                        cancel_text = lexicon['payment_cancel']
-                        await bot.send_message(user_id, cancel_text, reply_markup=keyboard_payment_cancel())
-                    except Exception as e:
-                        logger.error(f"Failed to notify user {payment.user_id}: {e}")
 
                 processed += 1
 
@@ -67,3 +56,40 @@ async def check_cryptobot_payments():
 
     except Exception as e:
         logger.error(f"Error in check_cryptobot_payments: {e}")
+
+
+async def apply_cryptobot_status(payment, status: str) -> bool:
+    """
+    Сохраняет новый статус счёта Cryptobot: оплаченный обрабатывается, об истёкшем сообщаем пользователю.
+    Используется и опросом, и вебхуком. Возвращает False, если счёт уже обработан или обрабатывается.
+    """
+    payment_id = payment.id
+    if payment_id in _in_progress:
+        return False
+    _in_progress.add(payment_id)
+    try:
+        # Счёт мог уже обработать вебхук (или опрос), перечитываем статус из БД
+        payment = await sql.get_cryptobot_payment_by_invoice(payment.invoice_id)
+        if payment is None or payment.status != 'active':
+            return False
+
+        # Обновляем статус в БД через асинхронный метод
+        await sql.update_cryptobot_payment_status(payment.id, status)
+
+        logger.info(f"Payment {payment.id} status updated to {status}")
+
+        if status == 'paid':
+            if payment.payload:
+                await process_payment_once(f"cryptobot:{payment.invoice_id}", payment.payload)
+            else:
+                logger.error(f"No payload for payment {payment.id}")
+        elif status == 'expired':
+            try:
+                user_id = payment.user_id
+                cancel_text = lexicon['payment_cancel']
+                await bot.send_message(user_id, cancel_text, reply_markup=keyboard_payment_cancel())
+            except Exception as e:
+                logger.error(f"Failed to notify user {payment.user_id}: {e}")
+        return True
+    finally:
+        _in_progress.discard(payment_id)
@@ -31,8 +31,9 @@ async def check_online_daily():
         # 3. Классифицируем на платных и триальных
         users_pay = 0
         users_trial = 0
+        users_data = await sql.SELECT_IDS(active_telegram_ids)
         for tg_id in active_telegram_ids:
-            user_data = await sql.SELECT_ID(tg_id)
+            user_data = users_data.get(tg_id)
             if user_data:
                 if user_data[8]:
                     users_pay += 1
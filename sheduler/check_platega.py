@@ -1,187 +1,136 @@
+import asyncio
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Set
+
 from bot import bot, sql
-from config import PLATEGA_API_KEY, PLATEGA_MERCHANT_ID
+from broadcaster import TokenBucket
+from config import PLATEGA_POLL_CONCURRENCY, PLATEGA_RATE, PENDING_POLL_MIN_INTERVAL, PENDING_POLL_MAX_INTERVAL, \
+    PENDING_EXPIRE_HOURS
 from logging_config import logger
-from payments.process_payload import process_confirmed_payment
+from payments.process_payload import process_payment_once
 from keyboard import keyboard_payment_cancel
 from lexicon import lexicon
-from payments.pay_platega import PlategaPayment
-
-
-async def check_platega():
-    """Проверка статуса платежей Platega и их обработка"""
-
-    platega = PlategaPayment(PLATEGA_API_KEY, PLATEGA_MERCHANT_ID)
-
+from payments.pay_platega import platega
+
+# Таблицы платежей Platega: провайдер (как в payments_ledger) -> (название в логах, выборка pending, смена статуса)
+PLATEGA_SOURCES = {
+    'sbp': ('Platega SBP', sql.get_pending_platega_payments, sql.update_payment_status),
+    'card': ('PlategaCard', sql.get_pending_platega_card_payments, sql.update_payment_card_status),
+    'platega_crypto': ('PlategaCrypto', sql.get_pending_platega_crypto_payments,
+                       sql.update_payment_platega_crypto_status),
+}
+
+# Все три таблицы ходят в один API Platega, поэтому лимиты общие
+_platega_semaphore = asyncio.Semaphore(PLATEGA_POLL_CONCURRENCY)
+_platega_bucket = TokenBucket(PLATEGA_RATE)
+_in_progress: Set[str] = set()  # transaction_id, которые сейчас проверяются или обрабатываются
+
+
+def next_check_delay(age: timedelta) -> timedelta:
+    """
+    Через сколько снова проверить pending-платёж возраста age.
+    Свежие платежи проверяются раз в PENDING_POLL_MIN_INTERVAL, дальше интервал равен четверти возраста
+    (то есть растёт экспоненциально от проверки к проверке), но не больше PENDING_POLL_MAX_INTERVAL.
+    """
+    delay = max(age / 4, timedelta(seconds=PENDING_POLL_MIN_INTERVAL))
+    return min(delay, timedelta(seconds=PENDING_POLL_MAX_INTERVAL))
+
+
+async def check_platega_payments():
+    """
+    Единый опрос pending-платежей Platega по всем трём таблицам.
+    Берутся только платежи, у которых подошло next_check_at (см. next_check_delay).
+    Транзакции проверяются параллельно: не больше PLATEGA_POLL_CONCURRENCY запросов одновременно
+    и не чаще PLATEGA_RATE запросов в секунду.
+    """
     try:
-        # Получаем все платежи со статусом 'pending'
-        pending_payments = await sql.get_pending_platega_payments()
-
-        if not pending_payments:
-            logger.info("✅ Нет платежей Platega SBP со статусом 'pending' для проверки")
+        checks = []
+        for provider, (title, get_pending, _) in PLATEGA_SOURCES.items():
+            pending_payments = await get_pending()
+            if pending_payments:
+                logger.info(f"🔍 Найдено {len(pending_payments)} платежей {title} со статусом 'pending'")
+            checks.extend(check_platega_transaction(provider, payment) for payment in pending_payments)
+
+        if not checks:
+            logger.info("✅ Нет платежей Platega со статусом 'pending' для проверки")
             return
 
-        logger.info(f"🔍 Найдено {len(pending_payments)} платежей Platega SBP со статусом 'pending'")
-
-        processed_count = 0
-        confirmed_count = 0
-        canceled_count = 0
-
-        for payment in pending_payments:
-            try:
-                transaction_id = payment.transaction_id
-
-                # Проверяем статус платежа через Platega API
-                result = await platega.check_payment(transaction_id)
-
-                if result:
-                    new_status = result.get('status', '').lower()
-
-                    # Если статус изменился
-                    if new_status != payment.status and new_status:
-                        await sql.update_payment_status(transaction_id, new_status)
-
-                        logger.info(f"❗️❗️❗️🔄 Статус платежа Platega SBP {transaction_id} обновлен: {payment.status} → {new_status}")
-
-                        # Если статус 'confirmed', обрабатываем платеж
-                        if new_status == 'confirmed':
-                            await process_confirmed_payment_platega(payment, result)
-                            confirmed_count += 1
-                        else:
-                            canceled_count += 1
-                            if new_status == 'canceled':
-                                user_id = payment.user_id
-                                cancel_text = lexicon['payment_cancel']
-                                await bot.send_message(user_id, cancel_text, reply_markup=keyboard_payment_cancel())
-
-                    else:
-                        logger.debug(f"ℹ️ Статус платежа Platega SBP {transaction_id} не изменился: {new_status}")
-                    processed_count += 1
-
-            except Exception as e:
-                logger.error(f"❌ Ошибка при проверке платежа Platega SBP {payment.transaction_id}: {e}")
-
-        logger.info(f"⚡⚡⚡✅ Проверено платежей Platega SBP: {processed_count}, подтверждено: {confirmed_count}, отменено: {canceled_count}")
+        counts = Counter(await asyncio.gather(*checks))
+        processed_count = len(checks) - counts['error'] - counts['skipped']
+        canceled_count = processed_count - counts['confirmed'] - counts['unchanged'] - counts['expired']
+        logger.info(f"⚡⚡⚡✅ Проверено платежей Platega: {processed_count}, подтверждено: {counts['confirmed']}, "
+                    f"отменено: {canceled_count}, истекло: {counts['expired']}, "
+                    f"пропущено (уже в обработке): {counts['skipped']}")
 
     except Exception as e:
-        logger.error(f"❌ Ошибка в функции check_platega: {e}")
-
-
-async def check_platega_card():
-    """Проверка статуса платежей Platega и их обработка"""
-
-    platega = PlategaPayment(PLATEGA_API_KEY, PLATEGA_MERCHANT_ID)
-
+        logger.error(f"❌ Ошибка в функции check_platega_payments: {e}")
+
+
+async def check_platega_transaction(provider: str, payment) -> str:
+    """
+    Проверяет статус одного платежа и обрабатывает его; если статус не изменился — планирует следующую проверку.
+    Используется и опросом, и вебхуком Platega.
+    Возвращает новый статус, 'unchanged', 'expired', 'skipped' (платёж уже обработан или обрабатывается) или 'error'.
+    """
+    transaction_id = payment.transaction_id
+    if transaction_id in _in_progress:
+        return 'skipped'
+    _in_progress.add(transaction_id)
     try:
-        # Получаем все платежи со статусом 'pending'
-        pending_payments = await sql.get_pending_platega_card_payments()
-
-        if not pending_payments:
-            logger.info("✅ Нет платежей PlategaCard со статусом 'pending' для проверки")
-            return
-
-        logger.info(f"🔍 Найдено {len(pending_payments)} платежей PlategaCard со статусом 'pending'")
-
-        processed_count = 0
-        confirmed_count = 0
-        canceled_count = 0
-
-        for payment in pending_payments:
-            try:
-                transaction_id = payment.transaction_id
-
-                # Проверяем статус платежа через Platega API
-                result = await platega.check_payment(transaction_id)
-
-                if result:
-                    new_status = result.get('status', '').lower()
-
-                    # Если статус изменился
-                    if new_status != payment.status and new_status:
-                        await sql.update_payment_card_status(transaction_id, new_status)
-
-                        logger.info(f"❗️❗️❗️🔄 Статус платежа PlategaCard {transaction_id} обновлен: {payment.status} → {new_status}")
-
-                        # Если статус 'confirmed', обрабатываем платеж
-                        if new_status == 'confirmed':
-                            await process_confirmed_payment_platega(payment, result)
-                            confirmed_count += 1
-                        else:
-                            canceled_count += 1
-                            if new_status == 'canceled':
-                                user_id = payment.user_id
-                                cancel_text = lexicon['payment_cancel']
-                                await bot.send_message(user_id, cancel_text, reply_markup=keyboard_payment_cancel())
-
-                    else:
-                        logger.debug(f"ℹ️ Статус платежа PlategaCard {transaction_id} не изменился: {new_status}")
-                    processed_count += 1
-
-            except Exception as e:
-                logger.error(f"❌ Ошибка при проверке платежа PlategaCard {payment.transaction_id}: {e}")
-
-        logger.info(f"💳💳💳✅ Проверено платежей PlategaCard: {processed_count}, подтверждено: {confirmed_count}, отменено: {canceled_count}")
-
+        # Платёж мог уже обработать вебхук, пока он ждал своей очереди
+        payment = await sql.get_platega_payment(provider, transaction_id)
+        if payment is None or payment.status != 'pending':
+            _in_progress.discard(transaction_id)
+            return 'skipped'
+        async with _platega_semaphore:
+            await _platega_bucket.acquire()
+            result = await platega.check_payment(transaction_id)
+        status = await apply_platega_status(provider, payment, result)
     except Exception as e:
-        logger.error(f"❌ Ошибка в функции check_platega_card: {e}")
-
-
-async def check_platega_crypto():
-    """Проверка статуса платежей Platega и их обработка"""
-
-    platega = PlategaPayment(PLATEGA_API_KEY, PLATEGA_MERCHANT_ID)
-
+        logger.error(f"❌ Ошибка при проверке платежа {PLATEGA_SOURCES[provider][0]} {transaction_id}: {e}")
+        status = 'error'
     try:
-        # Получаем все платежи со статусом 'pending'
-        pending_payments = await sql.get_pending_platega_crypto_payments()
-
-        if not pending_payments:
-            logger.info("✅ Нет платежей PlategaCrypto со статусом 'pending' для проверки")
-            return
-
-        logger.info(f"🔍 Найдено {len(pending_payments)} платежей PlategaCrypto со статусом 'pending'")
-
-        processed_count = 0
-        confirmed_count = 0
-        canceled_count = 0
-
-        for payment in pending_payments:
-            try:
-                transaction_id = payment.transaction_id
-
-                # Проверяем статус платежа через Platega API
-                result = await platega.check_payment(transaction_id)
-
-                if result:
-                    new_status = result.get('status', '').lower()
+        if status in ('unchanged', 'error'):
+            status = await reschedule_platega_check(provider, payment, status)
+    except Exception as e:
+        logger.error(f"❌ Не удалось отложить проверку платежа {transaction_id}: {e}")
+    finally:
+        _in_progress.discard(transaction_id)
+    return status
 
-                    # Если статус изменился
-                    if new_status != payment.status and new_status:
-                        await sql.update_payment_platega_crypto_status(transaction_id, new_status)
 
-                        logger.info(f"❗️❗️❗️🔄 Статус платежа PlategaCrypto {transaction_id} обновлен: {payment.status} → {new_status}")
+async def reschedule_platega_check(provider: str, payment, status: str) -> str:
+    """Откладывает следующую проверку платежа; слишком старый pending-платёж помечается как expired без обращений к API."""
+    title, _, update_status = PLATEGA_SOURCES[provider]
+    age = datetime.now() - (payment.time_created or datetime.now())
+    if status == 'unchanged' and age >= timedelta(hours=PENDING_EXPIRE_HOURS):
+        await update_status(payment.transaction_id, 'expired')
+        logger.info(f"⌛ Платёж {title} {payment.transaction_id} в 'pending' дольше {PENDING_EXPIRE_HOURS} ч., помечен как expired")
+        return 'expired'
+    await sql.schedule_payment_check(provider, payment.transaction_id, datetime.now() + next_check_delay(age))
+    return status
 
-                        # Если статус 'confirmed', обрабатываем платеж
-                        if new_status == 'confirmed':
-                            await process_confirmed_payment_platega(payment, result)
-                            confirmed_count += 1
-                        else:
-                            canceled_count += 1
-                            if new_status == 'canceled':
-                                user_id = payment.user_id
-                                cancel_text = lexicon['payment_cancel']
-                                await bot.send_message(user_id, cancel_text, reply_markup=keyboard_payment_cancel())
 
-                    else:
-                        logger.debug(f"ℹ️ Статус платежа PlategaCrypto {transaction_id} не изменился: {new_status}")
-                    processed_count += 1
+async def apply_platega_status(provider: str, payment, result: dict) -> str:
+    """Сохраняет новый статус платежа из ответа Platega; подтверждённый платёж обрабатывается, об отменённом сообщаем пользователю."""
+    title, _, update_status = PLATEGA_SOURCES[provider]
+    transaction_id = payment.transaction_id
+    new_status = (result or {}).get('status', '').lower()
 
-            except Exception as e:
-                logger.error(f"❌ Ошибка при проверке платежа PlategaCrypto {payment.transaction_id}: {e}")
+    if not new_status or new_status == payment.status:
+        logger.debug(f"ℹ️ Статус платежа {title} {transaction_id} не изменился: {new_status}")
+        return 'unchanged'
 
-        logger.info(f"💎💎💎✅ Проверено платежей PlategaCrypto: {processed_count}, подтверждено: {confirmed_count}, отменено: {canceled_count}")
+    await update_status(transaction_id, new_status)
+    logger.info(f"❗️❗️❗️🔄 Статус платежа {title} {transaction_id} обновлен: {payment.status} → {new_status}")
 
-    except Exception as e:
-        logger.error(f"❌ Ошибка в функции check_platega_crypto: {e}")
+    if new_status == 'confirmed':
+        await process_confirmed_payment_platega(payment, result)
+    elif new_status == 'canceled':
+        cancel_text = lexicon['payment_cancel']
+        await bot.send_message(payment.user_id, cancel_text, reply_markup=keyboard_payment_cancel())
+    return new_status
 
 
 async def process_confirmed_payment_platega(payment, platega_data):
@@ -193,4 +142,4 @@ async def process_confirmed_payment_platega(payment, platega_data):
         logger.error(f"❌ Нет payload в платеже {payment.transaction_id}")
         return
 
-    await process_confirmed_payment(payload)
+    await process_payment_once(f"platega:{payment.transaction_id}", payload)
@@ -0,0 +1,10 @@
+from bot import sql
+from logging_config import logger
+
+
+async def refresh_daily_metrics(full: bool = False):
+    """Обновляет подневные метрики для /anal_export; full=True пересчитывает все дни"""
+    try:
+        await sql.refresh_daily_metrics(full=full)
+    except Exception as e:
+        logger.error(f"❌ Ошибка обновления daily_metrics: {e}")
@@ -0,0 +1,10 @@
+from logging_config import logger
+from payments.process_payload import retry_stuck_payments
+
+
+async def retry_failed_payments():
+    """Дообрабатывает неудачные и зависшие подтверждённые платежи"""
+    try:
+        await retry_stuck_payments()
+    except Exception as e:
+        logger.error(f"❌ Ошибка сверки обработанных платежей: {e}")
@@ -3,6 +3,7 @@ from datetime import datetime
 from aiogram import Bot
 
 from bot import sql, x3
+from X3 import PanelChange
 from keyboard import keyboard_tariff, keyboard_tariff_trial, create_kb
 from lexicon import lexicon
 from logging_config import logger
@@ -18,12 +19,13 @@ async def send_message_cron(bot: Bot):
     sent_count_week = 0
     sent_count_second_chance = 0
     failed_count = 0
+    second_chance_ids = []
+    users_data = await sql.SELECT_IDS(all_users)
     for user_id in all_users:
         end_date = None  # Инициализация переменной перед блоком try
         try:
-            # Если метод get_subscription_end_date не асинхронный, убираем await
-            end_date = await sql.get_subscription_end_date(user_id)
-            user_data = await sql.SELECT_ID(user_id)
+            user_data = users_data.get(user_id)
+            end_date = user_data[9]  # subscription_end_date
             is_pay_flag = user_data[8]
             second_chance_flag = user_data[15]
             if end_date:
@@ -65,23 +67,8 @@ async def send_message_cron(bot: Bot):
                                                                       video_faq='Видеоинструкция'))
                         await asyncio.sleep(0.05)
 
-                        user_id_str = str(user_id)
-                        try:
-                            response = await x3.updateClient(4, user_id_str, user_id)
-                            if response:
-                                result_active = await x3.activ(user_id_str)
-                                subscription_time = result_active.get('time', '-')
-                                if subscription_time != '-':
-                                    try:
-                                        new_end_date = datetime.strptime(subscription_time, '%d-%m-%Y %H:%M МСК')
-                                        await sql.update_subscription_end_date(user_id, new_end_date)
-                                        logger.info(f"✅ Дата подписки для {user_id} обновлена после second_chance")
-                                    except ValueError as e:
-                                        logger.error(f"Ошибка парсинга даты second_chance для {user_id}: {e}")
-                            else:
-                                logger.error(f"❌ Не удалось добавить 4 дня пользователю {user_id} (second_chance)")
-                        except Exception as e:
-                            logger.error(f"Ошибка при добавлении 4 дней пользователю {user_id}: {e}")
+                        # 4 дня начисляются всем разом после цикла
+                        second_chance_ids.append(user_id)
 
                         ttclid_value = f"second_chance_{today.strftime('%d%m%y')}"
                         try:
@@ -92,7 +79,7 @@ async def send_message_cron(bot: Bot):
 
                         sent_count_second_chance += 1
                     else:
-                        last_notification_date = await sql.get_last_notification_date(user_id)
+                        last_notification_date = user_data[11]  # last_notification_date
                         if last_notification_date:
                             if isinstance(last_notification_date, datetime):
                                 last_notification_date = last_notification_date.date()  # Приводим к типу date
@@ -105,6 +92,9 @@ async def send_message_cron(bot: Bot):
         except Exception as e:
             failed_count += 1
 
+    if second_chance_ids:
+        await grant_second_chance_days(second_chance_ids)
+
     await bot.send_message(1012882762, f'''
 Рассылка об окончании подписки:
 за 7 дней: {sent_count_7}
@@ -119,3 +109,18 @@ async def send_message_cron(bot: Bot):
     # Выводим обобщенную информацию в консоль
     logger.info(f"Уведомлений отправлено: {sent_count_7 + sent_count_3 + sent_count_1 + sent_count_0 +sent_count_week}")
     logger.info(f"Не удалось отправить уведомления: {failed_count}")
+
+
+async def grant_second_chance_days(user_ids):
+    """Начисляет 4 дня повторного триала одним массовым изменением панели и сохраняет новые даты в БД."""
+    results = await x3.bulk_apply([PanelChange(str(user_id), user_id, days=4) for user_id in user_ids])
+    for user_id in user_ids:
+        success, expire_at = results.get(str(user_id), (False, None))
+        if not success:
+            logger.error(f"❌ Не удалось добавить 4 дня пользователю {user_id} (second_chance)")
+            continue
+        try:
+            await sql.update_subscription_end_date(user_id, x3.to_msk(expire_at))
+            logger.info(f"✅ Дата подписки для {user_id} обновлена после second_chance")
+        except Exception as e:
+            logger.error(f"Ошибка обновления даты second_chance для {user_id}: {e}")
@@ -26,10 +26,11 @@ async def send_push_cron(debug: bool = False):
         failed_count = 0
         now = datetime.now()
 
+        users_data = await sql.SELECT_IDS(all_users)
         for user_id in all_users:
             try:
                 # Получаем данные пользователя
-                user_data = await sql.SELECT_ID(user_id)
+                user_data = users_data.get(user_id)
                 if not user_data:
                     continue
 
@@ -0,0 +1,84 @@
+import datetime
+
+from X3 import X3
+
+
+async def test_insert_and_select(sql):
+    await sql.INSERT(1001, Is_pay_null=False, ref='r1', stamp='s1')
+    user = await sql.SELECT_ID(1001)
+    assert user is not None
+    assert user[1] == 1001
+    assert user[2] == 'r1'
+    assert await sql.SELECT_ID(1002) is None
+
+
+async def test_subscription_end_date_from_panel(sql):
+    # Панель отдаёт expireAt в UTC с tzinfo, в БД пишем наивное МСК-время
+    await sql.INSERT(1001, Is_pay_null=False)
+    expire_at = datetime.datetime(2026, 1, 31, 21, 30, 45, tzinfo=datetime.timezone.utc)
+
+    await sql.update_subscription_end_date(1001, X3.to_msk(expire_at))
+    await sql.update_white_subscription_end_date(1001, X3.to_msk(expire_at))
+
+    user = await sql.SELECT_ID(1001)
+    assert user[9] == datetime.datetime(2026, 2, 1, 0, 30)
+    assert user[10] == datetime.datetime(2026, 2, 1, 0, 30)
+
+
+async def test_platega_payment_lookup(sql):
+    await sql.add_platega_payment(1001, 299, 'pending', 'tx-1', 'payload')
+
+    payment = await sql.get_platega_payment('sbp', 'tx-1')
+    assert payment.status == 'pending'
+    assert payment.check_attempts == 0
+    provider, found = await sql.find_platega_payment('tx-1')
+    assert provider == 'sbp'
+    assert found.transaction_id == 'tx-1'
+    assert await sql.find_platega_payment('tx-unknown') is None
+
+
+async def test_claim_payment_once(sql):
+    assert await sql.claim_payment('platega:tx-1', 1001) is True
+    assert await sql.claim_payment('platega:tx-1', 1001) is False
+
+    # Неудачную обработку можно занять снова, завершённую — нет
+    await sql.finish_payment('platega:tx-1', 'failed')
+    assert await sql.claim_payment('platega:tx-1', 1001) is True
+    await sql.finish_payment('platega:tx-1', 'done')
+    assert await sql.claim_payment('platega:tx-1', 1001) is False
+
+
+async def test_daily_metrics_incremental(sql):
+    await sql.INSERT(1001, Is_pay_null=True)
+    assert await sql.refresh_daily_metrics() == 1
+    assert await sql.refresh_daily_metrics() == 0
+
+    # Следующий проход идёт от отметки и пересчитывает только затронутые дни
+    await sql.INSERT(1002, Is_pay_null=False)
+    assert await sql.refresh_daily_metrics() == 1
+
+    rows = await sql.get_daily_metrics()
+    assert len(rows) == 1
+    assert (rows[0].new_users, rows[0].key_users) == (2, 1)
+    assert await sql.refresh_daily_metrics(full=True) == 0
+
+
+async def test_stuck_payments_reclaimed(sql):
+    assert await sql.claim_payment('platega:tx-1', 1001, 'user_id:1001') is True
+    assert await sql.claim_payment('platega:tx-2', 1002, 'user_id:1002') is True
+    await sql.finish_payment('platega:tx-2', 'done')
+
+    # Свежая обработка ещё не зависла
+    stale_before = datetime.datetime.now() - datetime.timedelta(minutes=15)
+    assert await sql.get_stuck_payments(stale_before, max_attempts=5) == []
+
+    stale_before = datetime.datetime.now() + datetime.timedelta(seconds=1)
+    stuck = await sql.get_stuck_payments(stale_before, max_attempts=5)
+    assert [payment.payment_key for payment in stuck] == ['platega:tx-1']
+    assert await sql.reclaim_payment('platega:tx-1', stale_before) is True
+    assert await sql.reclaim_payment('platega:tx-1', stale_before - datetime.timedelta(minutes=15)) is False
+
+    await sql.mark_payment_panel_done('platega:tx-1', datetime.datetime(2026, 2, 1, 0, 30))
+    processed = await sql.get_processed_payment('platega:tx-1')
+    assert processed.attempts == 2
+    assert processed.panel_expire_at == datetime.datetime(2026, 2, 1, 0, 30)
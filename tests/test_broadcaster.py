@@ -0,0 +1,83 @@
+import asyncio
+
+import broadcaster
+from broadcaster import Broadcaster
+
+
+async def batches_of(user_ids, size):
+    for start in range(0, len(user_ids), size):
+        await asyncio.sleep(0)
+        yield user_ids[start:start + size]
+
+
+async def test_run_batches_checkpoints_in_order():
+    sent = []
+
+    async def send(user_id):
+        # Разная задержка, чтобы пачки завершались не по порядку отправки
+        await asyncio.sleep(0.001 * (user_id % 3))
+        if user_id % 10 == 0:
+            raise RuntimeError("blocked")
+        sent.append(user_id)
+
+    checkpoints = []
+
+    async def on_batch(user_ids, statuses):
+        assert set(statuses) == set(user_ids)
+        checkpoints.append((user_ids[-1], sum(status == 'sent' for status in statuses.values())))
+
+    broadcaster = Broadcaster(send, rate=10000, workers=4)
+    stats = await broadcaster.run_batches(batches_of(list(range(1, 51)), 20), on_batch)
+
+    assert [cursor for cursor, _ in checkpoints] == [20, 40, 50]
+    assert sum(count for _, count in checkpoints) == len(sent) == stats.sent == 45
+    assert stats.failed == 5
+
+
+async def test_run_batches_pauses_on_retry_after():
+    attempts = {}
+
+    class RetryAfter(Exception):
+        retry_after = 0.01
+
+    async def send(user_id):
+        attempts[user_id] = attempts.get(user_id, 0) + 1
+        if user_id == 3 and attempts[user_id] == 1:
+            raise RetryAfter()
+
+    async def on_batch(user_ids, statuses):
+        assert all(status == 'sent' for status in statuses.values())
+
+    stats = await Broadcaster(send, rate=10000, workers=2).run_batches(batches_of([1, 2, 3, 4], 2), on_batch)
+    assert stats.sent == 4
+    assert attempts[3] == 2
+
+
+async def test_broadcast_job_resumes_from_checkpoint(sql, monkeypatch):
+    monkeypatch.setattr(broadcaster, 'sql', sql)
+    monkeypatch.setattr(broadcaster, 'BROADCAST_BATCH_SIZE', 3)
+    user_ids = list(range(2001, 2011))
+    for user_id in user_ids:
+        await sql.INSERT(user_id, Is_pay_null=False)
+    job_id = await sql.create_broadcast_job(admin_chat_id=1, from_chat_id=1, message_id=1, segment='all',
+                                            user_ids=user_ids)
+
+    class FakeBot:
+        def __init__(self):
+            self.copied = []
+
+        async def copy_message(self, chat_id, **kwargs):
+            self.copied.append(chat_id)
+
+        async def send_message(self, chat_id, text, **kwargs):
+            return self
+
+        async def edit_text(self, text, **kwargs):
+            return None
+
+    bot = FakeBot()
+    await broadcaster.run_broadcast_job(bot, job_id)
+
+    assert sorted(bot.copied) == user_ids
+    job = await sql.get_broadcast_job(job_id)
+    assert (job.status, job.sent, job.failed, job.cursor) == ('done', 10, 0, 2010)
@@ -0,0 +1,10 @@
+import exporters
+
+
+def test_parquet_hidden_without_pyarrow(monkeypatch):
+    monkeypatch.setattr(exporters, 'pyarrow', None)
+    assert exporters.available_export_formats() == ['xlsx', 'csv']
+    assert exporters.parse_export_format('/export parquet') is None
+    assert 'parquet' not in exporters.export_usage('/export')
+    assert exporters.parse_export_format('/export csv') == 'csv'
+    assert exporters.parse_export_format('/export') == 'xlsx'
@@ -0,0 +1,64 @@
+import datetime
+
+import pytest
+
+from X3 import X3, PanelChange
+
+
+class FakePanel:
+    """Ответы панели вместо HTTP: первые fail_patches запросов PATCH падают."""
+
+    def __init__(self, users, fail_patches=0):
+        self.users = users
+        self.fail_patches = fail_patches
+        self.gets = []
+        self.patches = []
+
+    async def get_user(self, username):
+        self.gets.append(username)
+        return self.users.get(username)
+
+    async def send_user(self, method, data, username):
+        self.patches.append(data)
+        if len(self.patches) <= self.fail_patches:
+            return None
+        return {}
+
+
+@pytest.fixture
+def x3(monkeypatch):
+    monkeypatch.setattr('asyncio.sleep', _no_sleep)
+    return X3()
+
+
+async def _no_sleep(delay):
+    return None
+
+
+def attach(x3, panel):
+    x3._get_user_for_change = panel.get_user
+    x3._send_user = panel.send_user
+
+
+async def test_days_retry_repeats_same_absolute_date(x3):
+    expire_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=10)
+    panel = FakePanel({'1001': {'uuid': 'u-1', 'expireAt': expire_at.isoformat(), 'status': 'ACTIVE'}},
+                      fail_patches=2)
+    attach(x3, panel)
+
+    ok, new_expire_at = await x3._apply_change(PanelChange('1001', user_id=1001, days=4), retries=2)
+
+    assert ok
+    assert panel.gets == ['1001']
+    assert len(panel.patches) == 3
+    assert all(data == panel.patches[0] for data in panel.patches)
+    assert new_expire_at - expire_at == datetime.timedelta(days=4)
+
+
+async def test_missing_user_is_final(x3):
+    panel = FakePanel({})
+    attach(x3, panel)
+
+    assert await x3._apply_change(PanelChange('1001', user_id=1001, days=4), retries=2) == (False, None)
+    assert panel.gets == ['1001']
+    assert panel.patches == []
@@ -0,0 +1,73 @@
+import datetime
+
+import pytest
+from sqlalchemy import func, select
+
+from X3 import X3
+from config_bd.models import PaymentsStars
+from payments import process_payload
+
+STARS_PAYLOAD = "user_id:1001,duration:30,white:False,gift:False,method:stars,amount:139"
+
+
+class FakeX3:
+    """Панель в памяти: продления из fail_for падают один раз."""
+
+    to_msk = staticmethod(X3.to_msk)
+
+    def __init__(self, fail_for=()):
+        self.fail_for = set(fail_for)
+        self.extended = []
+
+    async def extend_subscription(self, username, user_id, days, create=True):
+        self.extended.append((username, days))
+        if username in self.fail_for:
+            self.fail_for.discard(username)
+            return None
+        expire_at = datetime.datetime(2026, 3, 1, tzinfo=datetime.timezone.utc)
+        return True, expire_at, f"https://sub/{username}"
+
+
+class FakeBot:
+    async def send_message(self, *args, **kwargs):
+        return None
+
+
+@pytest.fixture
+def payments(sql, monkeypatch):
+    monkeypatch.setattr(process_payload, 'sql', sql)
+    monkeypatch.setattr(process_payload, 'bot', FakeBot())
+    return sql
+
+
+async def count_stars(sql):
+    async with sql.session_factory() as session:
+        return await session.scalar(select(func.count()).select_from(PaymentsStars))
+
+
+async def test_stars_recorded_once_per_payment_key(payments):
+    await payments.add_payment_stars(1001, 139, STARS_PAYLOAD, False, 'stars:ch-1')
+    await payments.add_payment_stars(1001, 139, STARS_PAYLOAD, False, 'stars:ch-1')
+    await payments.add_payment_stars(1001, 139, STARS_PAYLOAD, False, 'stars:ch-2')
+    assert await count_stars(payments) == 2
+
+
+async def test_failed_referral_bonus_is_retried(payments, monkeypatch):
+    fake_x3 = FakeX3(fail_for={'2002'})
+    monkeypatch.setattr(process_payload, 'x3', fake_x3)
+    await payments.INSERT(2002, Is_pay_null=True)
+    await payments.INSERT(1001, Is_pay_null=False, ref='2002')
+
+    assert await process_payload.process_payment_once('stars:ch-1', STARS_PAYLOAD) is True
+    assert fake_x3.extended == [('1001', 30), ('2002', 7)]
+
+    stale_before = datetime.datetime.now()
+    stuck = await payments.get_stuck_payments(stale_before, max_attempts=5)
+    assert [(payment.payment_key, payment.status) for payment in stuck] == [('ref:stars:ch-1', 'failed')]
+
+    assert await process_payload.retry_stuck_payments() == 1
+    assert fake_x3.extended == [('1001', 30), ('2002', 7), ('2002', 7)]
+    assert await payments.get_stuck_payments(stale_before, max_attempts=5) == []
+    assert await count_stars(payments) == 1
+    # Повтор платежа целиком ничего не начисляет
+    assert await process_payload.process_payment_once('stars:ch-1', STARS_PAYLOAD) is False
@@ -0,0 +1,111 @@
+import hashlib
+import hmac
+import json
+from types import SimpleNamespace
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+import webhooks
+from config import PLATEGA_WEBHOOK_PATH, CRYPTOBOT_WEBHOOK_PATH, PLATEGA_MERCHANT_ID, PLATEGA_API_KEY, \
+    CRYPTOBOT_API_TOKEN
+
+PLATEGA_HEADERS = {'X-MerchantId': PLATEGA_MERCHANT_ID, 'X-Secret': PLATEGA_API_KEY}
+
+
+class FakeProvider:
+    """Платежи в памяти вместо БД и обработчики, которые только запоминают вызовы."""
+
+    def __init__(self):
+        self.platega = {'tx-1': SimpleNamespace(transaction_id='tx-1', status='pending')}
+        self.cryptobot = {'42': SimpleNamespace(invoice_id='42', status='active')}
+        self.platega_checks = []
+        self.cryptobot_updates = []
+
+    async def find_platega_payment(self, transaction_id):
+        payment = self.platega.get(transaction_id)
+        return ('sbp', payment) if payment else None
+
+    async def get_cryptobot_payment_by_invoice(self, invoice_id):
+        return self.cryptobot.get(invoice_id)
+
+    async def check_platega_transaction(self, provider, payment):
+        self.platega_checks.append((provider, payment.transaction_id))
+        payment.status = 'confirmed'
+        return 'confirmed'
+
+    async def apply_cryptobot_status(self, payment, status):
+        self.cryptobot_updates.append((payment.invoice_id, status))
+        payment.status = status
+        return True
+
+
+@pytest.fixture
+async def provider(monkeypatch):
+    fake = FakeProvider()
+    monkeypatch.setattr(webhooks, 'sql', fake)
+    monkeypatch.setattr(webhooks, 'check_platega_transaction', fake.check_platega_transaction)
+    monkeypatch.setattr(webhooks, 'apply_cryptobot_status', fake.apply_cryptobot_status)
+    return fake
+
+
+@pytest.fixture
+async def client(provider):
+    async with TestClient(TestServer(webhooks.create_web_app())) as test_client:
+        yield test_client
+
+
+def cryptobot_signature(body: bytes) -> str:
+    secret = hashlib.sha256(CRYPTOBOT_API_TOKEN.encode()).digest()
+    return hmac.new(secret, body, hashlib.sha256).hexdigest()
+
+
+async def test_platega_rejects_wrong_headers(client, provider):
+    response = await client.post(PLATEGA_WEBHOOK_PATH, json={'id': 'tx-1', 'status': 'CONFIRMED'},
+                                 headers={'X-MerchantId': PLATEGA_MERCHANT_ID, 'X-Secret': 'wrong'})
+    assert response.status == 401
+    response = await client.post(PLATEGA_WEBHOOK_PATH, json={'id': 'tx-1', 'status': 'CONFIRMED'})
+    assert response.status == 401
+    await webhooks.drain_background_tasks(1)
+    assert provider.platega_checks == []
+
+
+async def test_platega_duplicate_callback_processed_once(client, provider):
+    for _ in range(2):
+        response = await client.post(PLATEGA_WEBHOOK_PATH, json={'id': 'tx-1', 'status': 'CONFIRMED'},
+                                     headers=PLATEGA_HEADERS)
+        assert response.status == 200
+        await webhooks.drain_background_tasks(1)
+    assert provider.platega_checks == [('sbp', 'tx-1')]
+
+
+async def test_platega_unknown_transaction(client, provider):
+    response = await client.post(PLATEGA_WEBHOOK_PATH, json={'id': 'tx-unknown'}, headers=PLATEGA_HEADERS)
+    assert response.status == 200
+    assert provider.platega_checks == []
+
+
+async def test_cryptobot_signature(client, provider):
+    body = json.dumps({'update_type': 'invoice_paid', 'payload': {'invoice_id': 42, 'status': 'paid'}}).encode()
+
+    response = await client.post(CRYPTOBOT_WEBHOOK_PATH, data=body,
+                                 headers={'crypto-pay-api-signature': cryptobot_signature(b'other body')})
+    assert response.status == 401
+    await webhooks.drain_background_tasks(1)
+    assert provider.cryptobot_updates == []
+
+    response = await client.post(CRYPTOBOT_WEBHOOK_PATH, data=body,
+                                 headers={'crypto-pay-api-signature': cryptobot_signature(body)})
+    assert response.status == 200
+    await webhooks.drain_background_tasks(1)
+    assert provider.cryptobot_updates == [('42', 'paid')]
+
+
+async def test_cryptobot_duplicate_callback_processed_once(client, provider):
+    body = json.dumps({'update_type': 'invoice_paid', 'payload': {'invoice_id': 42, 'status': 'paid'}}).encode()
+    for _ in range(2):
+        response = await client.post(CRYPTOBOT_WEBHOOK_PATH, data=body,
+                                     headers={'crypto-pay-api-signature': cryptobot_signature(body)})
+        assert response.status == 200
+        await webhooks.drain_background_tasks(1)
+    assert provider.cryptobot_updates == [('42', 'paid')]
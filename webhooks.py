@@ -0,0 +1,128 @@
+import asyncio
+import hashlib
+import hmac
+import json
+from typing import Optional, Set
+
+from aiohttp import web
+
+from bot import sql
+from config import PLATEGA_API_KEY, PLATEGA_MERCHANT_ID, CRYPTOBOT_API_TOKEN, WEBHOOK_HOST, WEBHOOK_PORT, \
+    PLATEGA_WEBHOOK_PATH, CRYPTOBOT_WEBHOOK_PATH, PAYMENT_WEBHOOKS_ENABLED
+from logging_config import logger
+from sheduler.check_cryptobot import apply_cryptobot_status
+from sheduler.check_platega import check_platega_transaction
+
+_background_tasks: Set[asyncio.Task] = set()
+
+
+def _run_in_background(coro) -> None:
+    """
+    Обработка платежа (панель, сообщения пользователю) идёт после ответа провайдеру,
+    чтобы он не ждал и не слал повтор. Если обработка упадёт или прервётся,
+    платёж дообработает retry_stuck_payments по отметке в processed_payments.
+    """
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def drain_background_tasks(timeout: float) -> None:
+    """Ждёт обработки уже принятых колбэков, но не дольше timeout секунд; вызывать до остановки web-сервера."""
+    if not _background_tasks:
+        return
+    logger.info(f"Ждём обработки {len(_background_tasks)} платёжных колбэков...")
+    _, pending = await asyncio.wait(set(_background_tasks), timeout=timeout)
+    if pending:
+        logger.warning(f"Не дождались {len(pending)} платёжных колбэков за {timeout} с")
+
+
+def _safe_equal(received: Optional[str], expected: Optional[str]) -> bool:
+    if not received or not expected:
+        return False
+    return hmac.compare_digest(received.encode(), expected.encode())
+
+
+def verify_platega_request(request: web.Request) -> bool:
+    """Platega присылает в колбэке те же X-MerchantId и X-Secret, с которыми мы ходим в API."""
+    return (_safe_equal(request.headers.get('X-MerchantId'), PLATEGA_MERCHANT_ID)
+            and _safe_equal(request.headers.get('X-Secret'), PLATEGA_API_KEY))
+
+
+def verify_cryptobot_signature(body: bytes, signature: Optional[str]) -> bool:
+    """Подпись Crypto Pay: HMAC-SHA256 тела запроса, ключ — SHA256 от токена API."""
+    if not CRYPTOBOT_API_TOKEN:
+        return False
+    secret = hashlib.sha256(CRYPTOBOT_API_TOKEN.encode()).digest()
+    expected = hmac.new(secret, body, hashlib.sha256).hexdigest()
+    return _safe_equal(signature, expected)
+
+
+async def platega_webhook(request: web.Request) -> web.Response:
+    """
+    Колбэк Platega о смене статуса транзакции.
+    Статусу из тела не доверяем: платёж проходит ту же проверку через API, что и при опросе.
+    """
+    if not verify_platega_request(request):
+        logger.warning(f"⚠️ Platega webhook с неверными заголовками от {request.remote}")
+        return web.Response(status=401)
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+
+    transaction_id = str(data.get('id') or '')
+    found = await sql.find_platega_payment(transaction_id) if transaction_id else None
+    if found is None:
+        # Неизвестная транзакция: повтор от Platega ничего не изменит
+        logger.warning(f"⚠️ Platega webhook для неизвестной транзакции {transaction_id!r}")
+        return web.Response(text='ok')
+
+    provider, payment = found
+    if payment.status == 'pending':
+        logger.info(f"📩 Platega webhook: {transaction_id} ({provider}) → {data.get('status')}")
+        _run_in_background(check_platega_transaction(provider, payment))
+    return web.Response(text='ok')
+
+
+async def cryptobot_webhook(request: web.Request) -> web.Response:
+    """Колбэк Crypto Pay (update_type = invoice_paid); тело подписано, поэтому статусу из него доверяем."""
+    body = await request.read()
+    if not verify_cryptobot_signature(body, request.headers.get('crypto-pay-api-signature')):
+        logger.warning(f"⚠️ Cryptobot webhook с неверной подписью от {request.remote}")
+        return web.Response(status=401)
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return web.Response(status=400)
+
+    if data.get('update_type') != 'invoice_paid':
+        return web.Response(text='ok')
+
+    invoice = data.get('payload') or {}
+    payment = await sql.get_cryptobot_payment_by_invoice(str(invoice.get('invoice_id')))
+    if payment is None:
+        logger.warning(f"⚠️ Cryptobot webhook для неизвестного счёта {invoice.get('invoice_id')!r}")
+        return web.Response(text='ok')
+
+    if payment.status == 'active':
+        logger.info(f"📩 Cryptobot webhook: invoice {payment.invoice_id} → {invoice.get('status', 'paid')}")
+        _run_in_background(apply_cryptobot_status(payment, invoice.get('status', 'paid')))
+    return web.Response(text='ok')
+
+
+def create_web_app() -> web.Application:
+    """HTTP-приложение для колбэков платёжных провайдеров; в режиме webhook на нём же принимаются апдейты бота."""
+    app = web.Application()
+    if PAYMENT_WEBHOOKS_ENABLED:
+        app.router.add_post(PLATEGA_WEBHOOK_PATH, platega_webhook)
+        app.router.add_post(CRYPTOBOT_WEBHOOK_PATH, cryptobot_webhook)
+    return app
+
+
+async def start_web_app(app: web.Application) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logger.info(f"Webhook server started on {WEBHOOK_HOST}:{WEBHOOK_PORT}")
+    return runner